@@ -13,18 +13,21 @@ from flask import \
 from flask_login import current_user
 
 from animeu.app import db
+from animeu.api import error_response
 from animeu.models import (User,
                            WaifuPickBattle,
                            FavouritedWaifu,
                            ELORankingCalculation)
-from .queries import (get_base_datatables_query,
-                      apply_pagination_parameters_to_datatables_query)
+from .queries import invalidate_table_row_count
 from .logic import (ELO_LOCK_NAME,
                     SEED_BATTLES_LOCK_NAME,
+                    MODERATION_LOCK_NAME,
                     try_get_existing_lock,
                     handle_locking_action_request,
-                    update_rankings_with_lock,
-                    seed_battles_with_lock)
+                    handle_lock_progress_events_request,
+                    get_datatables_response,
+                    get_bulk_delete_arguments,
+                    get_export_response)
 
 # pylint: disable=invalid-name
 admin_bp = Blueprint("admin_bp",
@@ -52,11 +55,13 @@ def admin_page():
         .order_by(ELORankingCalculation.date.desc())\
         .first()
     maybe_seed_lock = try_get_existing_lock(SEED_BATTLES_LOCK_NAME)
+    maybe_moderation_lock = try_get_existing_lock(MODERATION_LOCK_NAME)
     active_tab = request.args.get("tab", "elo")
     return render_template("admin.html",
                            maybe_elo_lock=maybe_elo_lock,
                            maybe_elo_calc=maybe_elo_calc,
                            maybe_seed_lock=maybe_seed_lock,
+                           maybe_moderation_lock=maybe_moderation_lock,
                            active_tab=active_tab)
 
 @admin_bp.route("/dt/users", methods=["POST"])
@@ -64,56 +69,46 @@ def admin_page():
 def users_datatable():
     """Respond to the user datatables ajax calls."""
     parameters = json.loads(request.get_data())
-    base_query = get_base_datatables_query(User,
+    return jsonify(get_datatables_response(User,
                                            parameters,
-                                           ignore_columns=["password_hash"])
-    records_total = User.query.count()
-    records_filtered = db.engine.scalar(base_query.alias().count())
-    data_query = \
-        apply_pagination_parameters_to_datatables_query(base_query, parameters)
-    data = list(map(dict, db.engine.execute(data_query).fetchall()))
-    return jsonify({
-        "draw": str(int(parameters["draw"])),
-        "recordsTotal": records_total,
-        "recordsFiltered": records_filtered,
-        "data": data
-    })
+                                           ignore_columns=["password_hash"]))
 
 @admin_bp.route("/dt/battles", methods=["POST"])
 @admin_required
 def battles_datatable():
     """Respond to the battle datatables ajax calls."""
     parameters = json.loads(request.get_data())
-    base_query = get_base_datatables_query(WaifuPickBattle, parameters)
-    records_total = WaifuPickBattle.query.count()
-    records_filtered = db.engine.scalar(base_query.alias().count())
-    data_query = \
-        apply_pagination_parameters_to_datatables_query(base_query, parameters)
-    data = list(map(dict, db.engine.execute(data_query).fetchall()))
-    return jsonify({
-        "draw": str(int(parameters["draw"])),
-        "recordsTotal": records_total,
-        "recordsFiltered": records_filtered,
-        "data": data
-    })
+    return jsonify(get_datatables_response(WaifuPickBattle, parameters))
 
 @admin_bp.route("/dt/favourites", methods=["POST"])
 @admin_required
 def favourited_waifus():
     """Respond to the favourited waifu datatables ajax calls."""
     parameters = json.loads(request.get_data())
-    base_query = get_base_datatables_query(FavouritedWaifu, parameters)
-    records_total = FavouritedWaifu.query.count()
-    records_filtered = db.engine.scalar(base_query.alias().count())
-    data_query = \
-        apply_pagination_parameters_to_datatables_query(base_query, parameters)
-    data = list(map(dict, db.engine.execute(data_query).fetchall()))
-    return jsonify({
-        "draw": str(int(parameters["draw"])),
-        "recordsTotal": records_total,
-        "recordsFiltered": records_filtered,
-        "data": data
-    })
+    return jsonify(get_datatables_response(FavouritedWaifu, parameters))
+
+@admin_bp.route("/export/users", methods=["GET"])
+@admin_required
+def export_users():
+    """Export the users as csv or ndjson."""
+    return get_export_response(User,
+                               request,
+                               "users",
+                               ignore_columns=["password_hash",
+                                               "api_token",
+                                               "api_token_expiry"])
+
+@admin_bp.route("/export/battles", methods=["GET"])
+@admin_required
+def export_battles():
+    """Export the battles as csv or ndjson."""
+    return get_export_response(WaifuPickBattle, request, "battles")
+
+@admin_bp.route("/export/favourites", methods=["GET"])
+@admin_required
+def export_favourited_waifus():
+    """Export the favourited waifus as csv or ndjson."""
+    return get_export_response(FavouritedWaifu, request, "favourites")
 
 @admin_bp.route("/users/<user_id>", methods=["DELETE"])
 @admin_required
@@ -121,6 +116,7 @@ def delete_user(user_id):
     """Delete a user."""
     User.query.filter_by(id=user_id).delete()
     db.session.commit()
+    invalidate_table_row_count(User)
     return Response(status=HTTPStatus.NO_CONTENT)
 
 @admin_bp.route("/battles/<battle_id>", methods=["DELETE"])
@@ -129,6 +125,7 @@ def delete_battle(battle_id):
     """Delete a battle."""
     WaifuPickBattle.query.filter_by(id=battle_id).delete()
     db.session.commit()
+    invalidate_table_row_count(WaifuPickBattle)
     return Response(status=HTTPStatus.NO_CONTENT)
 
 @admin_bp.route("/favourited-waifus/<favourited_waifu_id>", methods=["DELETE"])
@@ -137,21 +134,53 @@ def delete_favourited_waifu(favourited_waifu_id):
     """Delete a favourited waifu."""
     FavouritedWaifu.query.filter_by(id=favourited_waifu_id).delete()
     db.session.commit()
+    invalidate_table_row_count(FavouritedWaifu)
     return Response(status=HTTPStatus.NO_CONTENT)
 
 @admin_bp.route("/action/elo", methods=["GET", "POST", "DELETE"])
 @admin_required
 def maybe_update_elo_rankings():
     """Maybe update the ELO rankings if they aren't already updating."""
-    return handle_locking_action_request(request,
-                                         ELO_LOCK_NAME,
-                                         update_rankings_with_lock)
+    return handle_locking_action_request(request, ELO_LOCK_NAME)
+
+@admin_bp.route("/action/elo/events", methods=["GET"])
+@admin_required
+def elo_rankings_progress_events():
+    """Stream the progress of updating the ELO rankings."""
+    return handle_lock_progress_events_request(ELO_LOCK_NAME)
 
 @admin_bp.route("/action/seed", methods=["GET", "POST", "DELETE"])
 @admin_required
 def maybe_seed_battles():
     """Maybe seed the database with a number of battles."""
+    return handle_locking_action_request(
+        request,
+        SEED_BATTLES_LOCK_NAME,
+        iterations=int(request.form.get("number", 1000))
+    )
+
+@admin_bp.route("/action/seed/events", methods=["GET"])
+@admin_required
+def seed_battles_progress_events():
+    """Stream the progress of seeding the database with battles."""
+    return handle_lock_progress_events_request(SEED_BATTLES_LOCK_NAME)
+
+@admin_bp.route("/action/moderation", methods=["GET", "POST", "DELETE"])
+@admin_required
+def maybe_bulk_delete():
+    """Maybe delete the battles and favourites matching some filters."""
+    arguments = {}
+    if request.method == "POST":
+        try:
+            arguments = get_bulk_delete_arguments(request.form)
+        except ValueError as error:
+            return error_response(HTTPStatus.BAD_REQUEST, str(error))
     return handle_locking_action_request(request,
-                                         SEED_BATTLES_LOCK_NAME,
-                                         seed_battles_with_lock,
-                                         int(request.form.get("number", 1000)))
+                                         MODERATION_LOCK_NAME,
+                                         **arguments)
+
+@admin_bp.route("/action/moderation/events", methods=["GET"])
+@admin_required
+def bulk_delete_progress_events():
+    """Stream the progress of a bulk delete."""
+    return handle_lock_progress_events_request(MODERATION_LOCK_NAME)
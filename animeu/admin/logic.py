@@ -4,97 +4,275 @@
 #
 # See /LICENCE.md for Copyright information
 """Controller logic for the admin module."""
-import sys
-import threading
+import io
+import csv
+import json
 import time
-from math import ceil
 from datetime import datetime
 from http import HTTPStatus
 
-from flask import Response
-from sqlalchemy.exc import IntegrityError
+from flask import Response, stream_with_context
+from sqlalchemy.sql import select, func
 
 from animeu.app import db
-from animeu.models import Lock
 from animeu.api import error_response
-from animeu.elo.elo_leaderboard_updater import update_rankings
+from animeu.models import WaifuPickBattle, FavouritedWaifu
+from animeu.elo.elo_leaderboard_updater import update_rankings, rewind_rankings
 from animeu.seed_battles import seed_battles
+from animeu.jobs.locks import get_held_lock
+from animeu.jobs.queries import (JOB_RUNNING,
+                                 enqueue_job,
+                                 cancel_job,
+                                 get_active_job)
+from .queries import (get_base_datatables_query,
+                      get_datatables_columns,
+                      get_moderation_condition,
+                      delete_in_batches,
+                      apply_keyset_pagination_to_datatables_query,
+                      get_datatables_keyset,
+                      get_table_row_count,
+                      is_datatables_query_filtered)
 
 ELO_LOCK_NAME = "elo-update"
 SEED_BATTLES_LOCK_NAME = "seed-battles"
-LOCK_NAMES = [ELO_LOCK_NAME, SEED_BATTLES_LOCK_NAME]
-
-def try_take_out_lock(name):
-    """Try take out a lock."""
-    try:
-        lock = Lock(name=name, date=datetime.now(), progress=0)
-        db.session.add(lock)
-        db.session.commit()
-        return lock
-    except IntegrityError:
-        return None
+MODERATION_LOCK_NAME = "moderation"
+LOCK_NAMES = [ELO_LOCK_NAME, SEED_BATTLES_LOCK_NAME, MODERATION_LOCK_NAME]
+# the tables a bulk moderation can delete from.
+MODERATED_MODELS = {"battles": WaifuPickBattle, "favourites": FavouritedWaifu}
+RERANK_POLL_INTERVAL = 1.0
+# how long to wait for a running rankings update before giving up.
+RERANK_TIMEOUT = 300.0
+# the rows fetched from the cursor at a time when exporting a table.
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MIMETYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+# the web server's workers are synchronous, so rather than holding one for
+# as long as an action runs each stream sends the current progress and is
+# closed, the browser's EventSource then reconnects after this interval.
+PROGRESS_POLL_INTERVAL = 1.0
 
 def try_get_existing_lock(name):
-    """Try get an existing lock."""
-    return Lock.query.get(name)
-
-def update_rankings_with_lock(lock_name):
-    """Update rankings using lock and record progress."""
-    lock = Lock.query.get(lock_name)
-    try:
-        def _update_progress(i, total):
-            print(f"elo: updating lock with progress {i}/{total}",
-                  file=sys.stderr)
-            lock.progress = ceil((i / total) * 100)
-            db.session.commit()
-        update_rankings(progress_callback=_update_progress)
-        time.sleep(10)
-        # pylint: disable=bare-except
-        try:
-            db.session.delete(lock)
-            db.session.commit()
-        except:
-            pass
-    except:
-        db.session.delete(lock)
-        db.session.commit()
-        raise
-
-def seed_battles_with_lock(lock_name, iterations):
-    """Seed the database with battles using a lock."""
-    lock = Lock.query.get(lock_name)
-    try:
-        def _update_progress(i, total):
-            print(f"seed: seeding battles with progress {i}/{total}",
-                  file=sys.stderr)
-            lock.progress = ceil((i / total) * 100)
-            db.session.commit()
-        seed_battles(iterations, _update_progress)
-        time.sleep(10)
-        # pylint: disable=bare-except
-        try:
-            db.session.delete(lock)
-            db.session.commit()
-        except:
-            pass
-    except:
-        db.session.delete(lock)
-        db.session.commit()
-        raise
+    """Try get an existing lock whose lease hasn't expired."""
+    return get_held_lock(name)
 
+def update_rankings_action(progress_callback):
+    """Update the rankings, the job of the ELO lock."""
+    update_rankings(progress_callback=progress_callback)
+
+def seed_battles_action(progress_callback, iterations):
+    """Seed the database with battles, the job of the seed battles lock."""
+    seed_battles(iterations, progress_callback)
+
+def rewind_rankings_when_idle(battle_id, timeout=RERANK_TIMEOUT):
+    """Rewind the rankings to before a battle once no update is running.
+
+    An update which is running may have read the battle, so it has to
+    finish first. Returns the queued update if there is one, or raises
+    TimeoutError if the running update doesn't finish in time.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        maybe_elo_job = get_active_job(ELO_LOCK_NAME)
+        if maybe_elo_job is None or maybe_elo_job.status != JOB_RUNNING:
+            rewind_rankings(battle_id)
+            return maybe_elo_job
+        db.session.rollback()
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"The rankings update (job {maybe_elo_job.id})"
+                               f" didn't finish within {timeout}s.")
+        time.sleep(RERANK_POLL_INTERVAL)
+
+def rerank_from_battle(battle_id, timeout=RERANK_TIMEOUT):
+    """Rewind the rankings to before a battle and queue them to be updated."""
+    deadline = time.monotonic() + timeout
+    while True:
+        maybe_elo_job = rewind_rankings_when_idle(
+            battle_id,
+            max(deadline - time.monotonic(), 0)
+        )
+        if maybe_elo_job is not None or enqueue_job(ELO_LOCK_NAME):
+            return
+        # someone else took the lock since it was checked.
+        if time.monotonic() > deadline:
+            raise TimeoutError("Unable to queue a rankings update within "
+                               f"{timeout}s.")
+        time.sleep(RERANK_POLL_INTERVAL)
+
+# pylint: disable=too-many-arguments,too-many-locals,invalid-name
+def bulk_delete_action(progress_callback,
+                       tables,
+                       *,
+                       user_id=None,
+                       start_date=None,
+                       end_date=None,
+                       character_name=None):
+    """Delete the rows matching some filters, the job of the moderation lock.
+
+    The ranking calculations refer to the last battle they included, so
+    the rankings are rewound to before the earliest of the battles before
+    any are deleted, and replayed once they have been.
+    """
+    conditions = [
+        (MODERATED_MODELS[name],
+         get_moderation_condition(
+             MODERATED_MODELS[name],
+             user_id=user_id,
+             start_date=start_date and datetime.fromisoformat(start_date),
+             end_date=end_date and datetime.fromisoformat(end_date),
+             character_name=character_name
+         ))
+        for name in tables
+    ]
+    earliest_battle_id = None
+    for Model, condition in conditions:
+        if Model is WaifuPickBattle:
+            earliest_battle_id = db.session.query(func.min(Model.id))\
+                .filter(condition)\
+                .scalar()
+    if earliest_battle_id is not None:
+        rewind_rankings_when_idle(earliest_battle_id)
+    total = sum(Model.query.filter(condition).count()
+                for Model, condition in conditions)
+    deleted = 0
+    for Model, condition in conditions:
+        deleted += len(delete_in_batches(
+            Model,
+            condition,
+            lambda n, done=deleted: progress_callback(done + n, total)
+        ))
+    progress_callback(1, 1)
+    # an update started while the battles were deleted is rewound again.
+    if earliest_battle_id is not None:
+        rerank_from_battle(earliest_battle_id)
+
+def get_bulk_delete_arguments(form):
+    """Get the arguments of a bulk delete from a form, or raise ValueError."""
+    arguments = {
+        "tables": [name for name in MODERATED_MODELS
+                   if form.get(name) not in (None, "", "false", "0")]
+    }
+    if not arguments["tables"]:
+        raise ValueError("Choose the battles and/or favourites to delete.")
+    if form.get("user_id"):
+        arguments["user_id"] = int(form["user_id"])
+    for date_name in ("start_date", "end_date"):
+        if form.get(date_name):
+            arguments[date_name] = \
+                datetime.fromisoformat(form[date_name]).isoformat()
+    if form.get("character_name", "").strip():
+        arguments["character_name"] = form["character_name"].strip()
+    if len(arguments) == 1:
+        raise ValueError("At least one filter is required.")
+    return arguments
+
+# the actions the worker runs for the jobs queued with each lock.
+JOB_ACTIONS = {
+    ELO_LOCK_NAME: update_rankings_action,
+    SEED_BATTLES_LOCK_NAME: seed_battles_action,
+    MODERATION_LOCK_NAME: bulk_delete_action
+}
+
+# pylint: disable=invalid-name
+def get_datatables_response(Model, parameters, ignore_columns=None):
+    """Get the response to a datatables ajax call for a table."""
+    base_query = get_base_datatables_query(Model,
+                                           parameters,
+                                           ignore_columns=ignore_columns)
+    records_total = get_table_row_count(Model)
+    records_filtered = records_total
+    if is_datatables_query_filtered(parameters):
+        records_filtered = db.session.execute(
+            select([func.count()]).select_from(base_query.alias())
+        ).scalar()
+    data_query = apply_keyset_pagination_to_datatables_query(
+        Model,
+        base_query,
+        list(base_query.inner_columns),
+        parameters
+    )
+    data = list(map(dict, db.session.execute(data_query).fetchall()))
+    return {
+        "draw": str(int(parameters["draw"])),
+        "recordsTotal": records_total,
+        "recordsFiltered": records_filtered,
+        "data": data,
+        "keyset": get_datatables_keyset(parameters, data)
+    }
+
+# pylint: disable=invalid-name
+def stream_datatables_export(Model,
+                             parameters,
+                             export_format,
+                             ignore_columns=None):
+    """Yield the rows a datatables query matches as csv or ndjson.
+
+    The rows are read from a server side cursor (where the database has
+    them) a batch at a time, so only a batch is ever held in memory.
+    """
+    query = get_base_datatables_query(Model,
+                                      parameters,
+                                      ignore_columns=ignore_columns)
+    with db.engine.connect() as connection, connection.begin():
+        result = connection\
+            .execution_options(stream_results=True)\
+            .execute(query)
+        column_names = list(result.keys())
+        if export_format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(column_names)
+        while True:
+            rows = result.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            if export_format == "csv":
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            else:
+                yield "".join(json.dumps(dict(zip(column_names, row)),
+                                         default=str) + "\n"
+                              for row in rows)
+        if export_format == "csv" and buffer.tell():
+            yield buffer.getvalue()
+
+# pylint: disable=invalid-name
+def get_export_response(Model, request, name, ignore_columns=None):
+    """Get a response streaming the rows of a table the admin filtered to."""
+    export_format = request.args.get("format", "csv")
+    if export_format not in EXPORT_MIMETYPES:
+        return error_response(HTTPStatus.BAD_REQUEST,
+                              f"Unknown export format: {export_format}")
+    if "parameters" in request.args:
+        parameters = json.loads(request.args["parameters"])
+    else:
+        parameters = {"columns": [{"name": name}
+                                  for name in get_datatables_columns(Model)]}
+    return Response(
+        stream_with_context(stream_datatables_export(
+            Model,
+            parameters,
+            export_format,
+            ignore_columns=ignore_columns
+        )),
+        mimetype=EXPORT_MIMETYPES[export_format],
+        headers={
+            "Content-Disposition":
+                f"attachment; filename={name}.{export_format}",
+            "X-Accel-Buffering": "no"
+        }
+    )
 
 # pylint: disable=too-many-return-statements
-def handle_locking_action_request(request, lock_name, action, *args):
-    """Handle a request made to a action which locks resource."""
+def handle_locking_action_request(request, lock_name, **arguments):
+    """Handle a request made to an action which is run as a locking job."""
     if lock_name not in LOCK_NAMES:
         return error_response(HTTPStatus.BAD_REQUEST,
                               f"Unkown lock name: {lock_name}")
     maybe_existing_lock = try_get_existing_lock(lock_name)
-    if maybe_existing_lock and request.method == "DELETE":
-        db.session.delete(maybe_existing_lock)
-        db.session.commit()
-        return Response(status=HTTPStatus.OK)
     if request.method == "DELETE":
+        if cancel_job(lock_name):
+            return Response(status=HTTPStatus.OK)
         return Response(status=HTTPStatus.NOT_MODIFIED)
     if maybe_existing_lock and request.method == "GET":
         return Response(str(maybe_existing_lock.progress),
@@ -102,11 +280,28 @@ def handle_locking_action_request(request, lock_name, action, *args):
     if request.method == "GET":
         return Response(status=HTTPStatus.NO_CONTENT)
     if request.method == "POST":
-        maybe_lock = try_take_out_lock(lock_name)
-        if not maybe_lock:
+        maybe_job = enqueue_job(lock_name, **arguments)
+        if not maybe_job:
             return error_response(HTTPStatus.SERVICE_UNAVAILABLE,
                                   f"Failed to take out lock: {lock_name}")
-        thread = threading.Thread(target=action, args=(maybe_lock.name, *args))
-        thread.start()
-        return Response(str(maybe_lock.progress), status=HTTPStatus.CREATED)
+        return Response(str(maybe_job.progress), status=HTTPStatus.CREATED)
     return error_response(HTTPStatus.BAD_REQUEST)
+
+def stream_lock_progress(lock_name, poll_interval=PROGRESS_POLL_INTERVAL):
+    """Yield server-sent events of a lock's current progress."""
+    yield f"retry: {int(poll_interval * 1000)}\n\n"
+    maybe_lock = try_get_existing_lock(lock_name)
+    if maybe_lock is None or maybe_lock.progress is None:
+        yield "event: done\ndata: 100\n\n"
+    else:
+        yield f"data: {maybe_lock.progress}\n\n"
+
+def handle_lock_progress_events_request(lock_name):
+    """Handle a request for the stream of a locking action's progress."""
+    if lock_name not in LOCK_NAMES:
+        return error_response(HTTPStatus.BAD_REQUEST,
+                              f"Unkown lock name: {lock_name}")
+    return Response(stream_with_context(stream_lock_progress(lock_name)),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache",
+                             "X-Accel-Buffering": "no"})
@@ -4,11 +4,30 @@
 #
 # See /LICENCE.md for Copyright information
 """Query functions used to populate the admin page."""
-from sqlalchemy.sql import select, or_
+import json
+import time
+from hashlib import md5
+from functools import lru_cache
+
+from sqlalchemy import sql, inspect
+from sqlalchemy.sql import select, or_, and_, func, text, alias
 
 from animeu.app import db
+from animeu.models import Character, CharacterNameComparator
 
 DATATABLES_NO_LIMIT = -1
+# how long an exact count of a table's rows is reused for.
+ROW_COUNT_CACHE_DURATION = 60
+# the size above which postgres' estimate of a table's rows is used.
+ESTIMATED_ROW_COUNT_THRESHOLD = 100000
+
+# the trigram indexes can't find anything shorter than a trigram.
+MIN_INDEXED_SEARCH_LENGTH = 3
+# the most rows deleted in each transaction of a bulk delete.
+BULK_DELETE_BATCH_SIZE = 1000
+
+# maps a table's name to its (max id, count, time counted).
+_ROW_COUNT_CACHE = {}
 
 def maybe_get(indexable, *keys, default=None):
     """Maybe get a nested value via a series of indexes."""
@@ -29,32 +48,154 @@ def apply_pagination_parameters_to_datatables_query(query, parameters):
         query = query.limit(limit)
     return query
 
+@lru_cache(maxsize=None)
+def get_sqlite_search_table_columns(table_name):
+    """Get the columns of a table's full text search table, if it has one.
+
+    On sqlite the searchable columns of a table are indexed by a fts5 table
+    named ```<table>_search```, which is only made by the migrations if the
+    sqlite it was run with has fts5's trigram tokenizer.
+    """
+    if db.engine.dialect.name != "sqlite":
+        return frozenset()
+    search_table_name = f"{table_name}_search"
+    if not db.session.execute(
+            text("select 1 from sqlite_master "
+                 "where type = 'table' and name = :name"),
+            {"name": search_table_name}
+    ).scalar():
+        return frozenset()
+    return frozenset(
+        row[1] for row in
+        db.session.execute(text(f"pragma table_info({search_table_name})"))
+    )
+
+# pylint: disable=invalid-name
+def get_character_name_comparators(Model):
+    """Get the comparators of the character names of a table, by name."""
+    comparators = {
+        name: getattr(getattr(Model, name), "comparator", None)
+        for name in inspect(Model).all_orm_descriptors.keys()
+    }
+    return {name: comparator for name, comparator in comparators.items()
+            if isinstance(comparator, CharacterNameComparator)}
+
+# pylint: disable=invalid-name
+@lru_cache(maxsize=None)
+def get_character_name_joins(Model):
+    """Get the join to the characters table of each character name, by name.
+
+    Each character name is read from its own alias of the characters table
+    (as a ```(name column, join condition)```), so that sorting by a name
+    reads a column rather than looking up the name of every row. The same
+    columns are returned every time so they can be compared to each other.
+    """
+    joins = {}
+    for name, comparator in get_character_name_comparators(Model).items():
+        characters = alias(Character.__table__, name=f"{name}_characters")
+        joins[name] = (characters.c.name.label(name),
+                       characters.c.id == comparator.id_column)
+    return joins
+
+# pylint: disable=invalid-name
+def get_datatables_columns(Model):
+    """Get the columns of a table which a datatable can show, by name.
+
+    Along with the table's own columns are the names of the characters in
+    its character id columns (e.g ```winner_name``` for ```winner_id```).
+    """
+    columns = dict(Model.__table__.columns.items())
+    for name, (column, _) in get_character_name_joins(Model).items():
+        columns[name] = column
+    return columns
+
+# pylint: disable=invalid-name
+def get_datatables_from_clause(Model, select_columns):
+    """Get the table a datatables query selects from, with its characters.
+
+    Only the characters tables of the selected character names are joined.
+    """
+    from_clause = Model.__table__
+    for column, on_clause in get_character_name_joins(Model).values():
+        if column in select_columns:
+            from_clause = from_clause.outerjoin(column.element.table,
+                                                on_clause)
+    return from_clause
+
+# pylint: disable=invalid-name
+def get_search_conditions(Model, search_columns, search_text):
+    """Get the conditions matching rows whose columns contain some text.
+
+    The columns which are indexed in the table's full text search table are
+    searched with a single trigram match, and any others with a LIKE. On
+    postgres the LIKE is served by the trigram indexes on the columns. The
+    name of a character is searched for in the (much smaller) characters
+    table, and the rows are then matched by the ids of the characters found.
+    """
+    name_comparators = get_character_name_comparators(Model)
+    character_id_columns = [name_comparators[c.name].id_column
+                            for c in search_columns
+                            if c.name in name_comparators]
+    if character_id_columns:
+        matching_character_ids = select([Character.id]).where(or_(
+            *get_search_conditions(Character,
+                                   [Character.__table__.c.name],
+                                   search_text)
+        ))
+        return [c.in_(matching_character_ids)
+                for c in character_id_columns] + \
+            get_search_conditions(Model,
+                                  [c for c in search_columns
+                                   if c.name not in name_comparators],
+                                  search_text)
+    search_table_columns = \
+        get_sqlite_search_table_columns(Model.__table__.name)
+    indexed_columns = [c for c in search_columns
+                       if c.name in search_table_columns]
+    if len(search_text) < MIN_INDEXED_SEARCH_LENGTH or not indexed_columns:
+        return [c.contains(search_text) for c in search_columns]
+    search_table_name = f"{Model.__table__.name}_search"
+    search_table = sql.table(search_table_name, sql.column("rowid"))
+    indexed_column_names = " ".join(c.name for c in indexed_columns)
+    quoted_search_text = search_text.replace('"', '""')
+    matching_ids = select([search_table.c.rowid]).where(
+        sql.column(search_table_name).match(
+            f'{{{indexed_column_names}}} : "{quoted_search_text}"'
+        )
+    )
+    return [Model.__table__.c.id.in_(matching_ids)] + \
+        [c.contains(search_text) for c in search_columns
+         if c not in indexed_columns]
+
 # pylint: disable=invalid-name
 def apply_filtering_parameters_to_datatables_query(Model,
                                                    query,
                                                    allowed_columns,
                                                    parameters):
     """Apply the filtering parameters to a datatables query."""
+    columns = get_datatables_columns(Model)
     column_parameters = maybe_get(parameters, "columns", default=[])
     maybe_search_text = maybe_get(parameters, "search", "value")
     inclusion_conditions = []
     if maybe_search_text:
-        for column in allowed_columns:
-            if not isinstance(column.type, db.String):
-                continue
-            inclusion_conditions.append(column.contains(maybe_search_text))
+        inclusion_conditions.extend(get_search_conditions(
+            Model,
+            [c for c in allowed_columns if isinstance(c.type, db.String)],
+            maybe_search_text
+        ))
     for column_parameter in column_parameters:
         maybe_column_name = maybe_get(column_parameter, "name")
-        if maybe_column_name is None or \
-                maybe_column_name not in Model.__table__.columns:
+        if maybe_column_name is None or maybe_column_name not in columns:
             continue
         maybe_search_text = maybe_get(column_parameter, "search", "value")
         if not maybe_search_text:
             continue
-        column = Model.__table__.columns[maybe_column_name]
+        column = columns[maybe_column_name]
         if column not in allowed_columns:
             continue
-        inclusion_conditions.append(column.contains(maybe_search_text))
+        inclusion_conditions.extend(
+            get_search_conditions(Model, [column], maybe_search_text)
+        )
     return query.where(or_(*inclusion_conditions))
 
 # pylint: disable=invalid-name
@@ -63,16 +204,16 @@ def apply_ordering_parameters_to_datatables_query(Model,
                                                   allowed_columns,
                                                   parameters):
     """Apply ordering parameters to a datatables query."""
+    columns = get_datatables_columns(Model)
     for order_parameter in maybe_get(parameters, "order", default=[]):
         maybe_column_index = maybe_get(order_parameter, "column")
         if maybe_column_index is None:
             continue
         maybe_column_name = \
             maybe_get(parameters, "columns", maybe_column_index, "name")
-        if maybe_column_name is None or \
-                maybe_column_name not in Model.__table__.columns:
+        if maybe_column_name is None or maybe_column_name not in columns:
             continue
-        column = Model.__table__.columns[maybe_column_name]
+        column = columns[maybe_column_name]
         if column not in allowed_columns:
             continue
         order_direction = maybe_get(order_parameter, "dir")
@@ -80,22 +221,189 @@ def apply_ordering_parameters_to_datatables_query(Model,
             query = query.order_by(column)
         elif order_direction == "desc":
             query = query.order_by(column.desc())
+    # the rows are ordered by their id last so that the order of rows with
+    # equal values is stable between pages.
+    primary_key = Model.__table__.c.id
+    if primary_key in allowed_columns:
+        keyset_ordering = \
+            get_keyset_ordering(Model, allowed_columns, parameters)
+        descending = keyset_ordering is not None and keyset_ordering[1]
+        query = query.order_by(primary_key.desc() if descending
+                               else primary_key)
     return query
 
+# pylint: disable=invalid-name
+def get_keyset_ordering(Model, allowed_columns, parameters):
+    """Get the (column, descending) a query can be paginated by keyset on.
+
+    A query can only be paginated by keyset if it is ordered by a single
+    column which can't be null, and it selects the table's id to break any
+    ties between rows with the same value.
+    """
+    primary_key = Model.__table__.c.id
+    if primary_key not in allowed_columns:
+        return None
+    order_parameters = maybe_get(parameters, "order", default=[])
+    if not order_parameters:
+        return primary_key, False
+    if len(order_parameters) != 1:
+        return None
+    maybe_column_name = maybe_get(parameters,
+                                  "columns",
+                                  maybe_get(order_parameters, 0, "column"),
+                                  "name")
+    if maybe_column_name is None or \
+            maybe_column_name not in Model.__table__.columns:
+        return None
+    column = Model.__table__.columns[maybe_column_name]
+    order_direction = maybe_get(order_parameters, 0, "dir")
+    if column not in allowed_columns or column.nullable or \
+            order_direction not in ("asc", "desc"):
+        return None
+    return column, order_direction == "desc"
+
+def get_datatables_query_signature(parameters):
+    """Get a hash of the parameters which decide the rows of a query."""
+    column_parameters = maybe_get(parameters, "columns", default=[])
+    return md5(json.dumps([
+        [maybe_get(c, "name") for c in column_parameters],
+        [maybe_get(c, "search", "value") for c in column_parameters],
+        maybe_get(parameters, "search", "value"),
+        maybe_get(parameters, "order", default=[])
+    ], sort_keys=True).encode("utf8")).hexdigest()
+
+def is_datatables_query_filtered(parameters):
+    """Test if a datatables query has any search filters."""
+    column_parameters = maybe_get(parameters, "columns", default=[])
+    return bool(maybe_get(parameters, "search", "value")) or \
+        any(maybe_get(c, "search", "value") for c in column_parameters)
+
+def get_datatables_keyset(parameters, data):
+    """Get the keyset the client sends back to seek from the page of data."""
+    if not data or "id" not in data[0]:
+        return None
+    return {
+        "signature": get_datatables_query_signature(parameters),
+        "start": maybe_get(parameters, "start", default=0),
+        "length": len(data),
+        "first_id": data[0]["id"],
+        "last_id": data[-1]["id"]
+    }
+
+# pylint: disable=invalid-name,too-many-locals
+def apply_keyset_pagination_to_datatables_query(Model,
+                                                query,
+                                                allowed_columns,
+                                                parameters):
+    """Apply the pagination parameters to a datatables query by keyset.
+
+    When the client asks for the page after, before or the same as the page
+    it was last sent, the rows are seeked to from the ids at the edges of
+    that page (which the client sends back as its ```keyset```) instead of
+    offsetting past every earlier row. Any other page is offset to.
+    """
+    start = maybe_get(parameters, "start", default=0)
+    length = maybe_get(parameters, "length", default=DATATABLES_NO_LIMIT)
+    keyset = maybe_get(parameters, "keyset")
+    keyset_ordering = get_keyset_ordering(Model, allowed_columns, parameters)
+    if not start or not keyset or keyset_ordering is None or \
+            length == DATATABLES_NO_LIMIT or \
+            keyset.get("signature") != \
+            get_datatables_query_signature(parameters):
+        return apply_pagination_parameters_to_datatables_query(query,
+                                                               parameters)
+    if start == keyset["start"] + keyset["length"]:
+        boundary_id, forwards, inclusive = keyset["last_id"], True, False
+    elif start == keyset["start"]:
+        boundary_id, forwards, inclusive = keyset["first_id"], True, True
+    elif start == keyset["start"] - length:
+        boundary_id, forwards, inclusive = keyset["first_id"], False, False
+    else:
+        return apply_pagination_parameters_to_datatables_query(query,
+                                                               parameters)
+    column, descending = keyset_ordering
+    primary_key = Model.__table__.c.id
+    boundary_value = db.session.execute(
+        select([column]).where(primary_key == boundary_id)
+    ).scalar()
+    if boundary_value is None:
+        # the row at the edge of the page has since been deleted.
+        return apply_pagination_parameters_to_datatables_query(query,
+                                                               parameters)
+    if forwards != descending:
+        seek_condition = or_(column > boundary_value,
+                             and_(column == boundary_value,
+                                  primary_key >= boundary_id if inclusive
+                                  else primary_key > boundary_id))
+    else:
+        seek_condition = or_(column < boundary_value,
+                             and_(column == boundary_value,
+                                  primary_key <= boundary_id if inclusive
+                                  else primary_key < boundary_id))
+    query = query.where(seek_condition).limit(length)
+    if forwards:
+        return query
+    # the page before is found by reading backwards from the current page
+    # and then put back into the requested order.
+    ordering = [(column, descending), (primary_key, descending)]
+    page = query\
+        .order_by(None)\
+        .order_by(*[c if d else c.desc() for c, d in ordering])\
+        .alias()
+    return select([page])\
+        .order_by(*[page.c[c.name].desc() if d else page.c[c.name]
+                    for c, d in ordering])
+
+# pylint: disable=invalid-name
+def get_table_row_count(Model):
+    """Get the number of rows in a table, which is estimated if it's large.
+
+    On postgres the planner's estimate of a table's size is used once it is
+    large enough that an exact count would be slow. Otherwise an exact count
+    is cached until the table's maximum id changes, or it's invalidated or
+    expires.
+    """
+    table = Model.__table__
+    if db.engine.dialect.name == "postgresql":
+        estimate = db.session.execute(
+            text("select reltuples::bigint from pg_class "
+                 "where oid = cast(:table as regclass)"),
+            {"table": table.name}
+        ).scalar()
+        if estimate is not None and estimate >= ESTIMATED_ROW_COUNT_THRESHOLD:
+            return estimate
+    max_id = db.session.execute(select([func.max(table.c.id)])).scalar()
+    now = time.monotonic()
+    cached = _ROW_COUNT_CACHE.get(table.name)
+    if cached is not None and cached[0] == max_id and \
+            now - cached[2] < ROW_COUNT_CACHE_DURATION:
+        return cached[1]
+    count = db.session.execute(select([func.count()]).select_from(table))\
+        .scalar()
+    _ROW_COUNT_CACHE[table.name] = (max_id, count, now)
+    return count
+
+# pylint: disable=invalid-name
+def invalidate_table_row_count(Model):
+    """Forget the cached count of a table's rows, as some were deleted."""
+    _ROW_COUNT_CACHE.pop(Model.__table__.name, None)
+
 # pylint: disable=invalid-name
 def get_base_datatables_query(Model, parameters, ignore_columns=None):
     """Query the users table using the datatables style parameters."""
+    columns = get_datatables_columns(Model)
     column_parameters = maybe_get(parameters, "columns", default=[])
     select_columns = []
     for column_parameter in column_parameters:
         maybe_column_name = maybe_get(column_parameter, "name")
         if maybe_column_name is None or \
                 (ignore_columns is not None and maybe_column_name in ignore_columns) \
-                or maybe_column_name not in Model.__table__.columns:
+                or maybe_column_name not in columns:
             continue
-        column = Model.__table__.columns[maybe_column_name]
+        column = columns[maybe_column_name]
         select_columns.append(column)
-    query = select(select_columns)
+    query = select(select_columns)\
+        .select_from(get_datatables_from_clause(Model, select_columns))
     query = apply_filtering_parameters_to_datatables_query(Model,
                                                            query,
                                                            select_columns,
@@ -105,3 +413,54 @@ def get_base_datatables_query(Model, parameters, ignore_columns=None):
                                                           select_columns,
                                                           parameters)
     return query
+
+# pylint: disable=invalid-name
+def get_moderation_condition(Model,
+                             *,
+                             user_id=None,
+                             start_date=None,
+                             end_date=None,
+                             character_name=None):
+    """Get the condition matching the rows moderated by some filters."""
+    conditions = []
+    if user_id is not None:
+        conditions.append(Model.user_id == user_id)
+    if start_date is not None:
+        conditions.append(Model.date >= start_date)
+    if end_date is not None:
+        conditions.append(Model.date < end_date)
+    if character_name is not None:
+        name_comparators = get_character_name_comparators(Model)
+        conditions.append(or_(*[c == character_name
+                                for c in name_comparators.values()]))
+    return and_(*conditions)
+
+# pylint: disable=invalid-name
+def delete_in_batches(Model,
+                      condition,
+                      progress_callback=None,
+                      batch_size=BULK_DELETE_BATCH_SIZE):
+    """Delete the rows matching a condition, committing after each batch.
+
+    Returns the ids of the deleted rows.
+    """
+    deleted_ids = []
+    while True:
+        batch_ids = [
+            row_id for (row_id,) in db.session.query(Model.id)
+            .filter(condition,
+                    Model.id > (deleted_ids[-1] if deleted_ids else 0))
+            .order_by(Model.id)
+            .limit(batch_size)
+        ]
+        if not batch_ids:
+            break
+        Model.query\
+            .filter(Model.id.in_(batch_ids))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+        deleted_ids.extend(batch_ids)
+        if progress_callback:
+            progress_callback(len(deleted_ids))
+    invalidate_table_row_count(Model)
+    return deleted_ids
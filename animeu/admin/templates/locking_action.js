@@ -2,6 +2,7 @@
     function LockingAction({
             el,
             actionUrl,
+            eventsUrl = null,
             startOptsFactory = () => {},
             pollOptsFactory = () => {},
             deleteOptsFactory = () => {},
@@ -13,14 +14,39 @@
         const status = el.querySelector(".action-status");
         let IS_POLLING = false;
 
+        function markActionComplete() {
+            progressBar.style = `width: 100%`;
+            performActionBtn.textContent = "Complete";
+            status.textContent = "Completed just now.";
+            progressBar.classList.remove("progress-bar-animated");
+            progressBar.classList.remove("progress-bar-striped ");
+            IS_POLLING = false;
+        }
+
+        /* the progress is pushed by the server when the browser supports it */
+        function streamActionProgress() {
+            const events = new EventSource(eventsUrl);
+            events.onmessage = (event) => {
+                progressBar.style = `width: ${escape(event.data)}%`;
+            };
+            events.addEventListener("done", () => {
+                events.close();
+                markActionComplete();
+            });
+        }
+
         function pollActionProgress() {
             if (IS_POLLING) {
                 return;
             }
+            IS_POLLING = true;
+            progressBar.classList.add("progress-bar-animated");
+            progressBar.classList.add("progress-bar-striped");
+            if (eventsUrl && window.EventSource) {
+                streamActionProgress();
+                return;
+            }
             const interval = setInterval(() => {
-                IS_POLLING = true;
-                progressBar.classList.add("progress-bar-animated");
-                progressBar.classList.add("progress-bar-striped");
                 $.ajax({
                     url: actionUrl,
                     method: "GET",
@@ -31,12 +57,7 @@
                     }
                     if ((xhr.status === 200 && data >= 98) || xhr.status === 204) {
                         clearInterval(interval);
-                        progressBar.style = `width: 100%`;
-                        performActionBtn.textContent = "Complete";
-                        status.textContent = "Completed just now.";
-                        progressBar.classList.remove("progress-bar-animated");
-                        progressBar.classList.remove("progress-bar-striped ");
-                        IS_POLLING = false;
+                        markActionComplete();
                     }
                 });
             }, pollingInterval);
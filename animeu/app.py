@@ -23,6 +23,8 @@ from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 
+from animeu.common.database_helpers import get_engine_options
+
 def force_https(wsgi_app):
     """Force the use of HTTPS."""
     def wrapper(environ, start_response):
@@ -53,6 +55,8 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = \
     os.environ.get("DATABASE",
                    os.environ.get("DATABASE_URL", "sqlite:///../app.db"))
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = \
+    get_engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 if app.debug:
     print(f"USING DATABASE = {app.config['SQLALCHEMY_DATABASE_URI']}",
           file=sys.stderr)
@@ -0,0 +1,64 @@
+# /animeu/common/database_helpers.py
+#
+# Helper functions for configuring the database engine.
+#
+# See /LICENCE.md for Copyright information
+"""Helper functions for configuring the database engine."""
+import os
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+def get_environ_int(name, default, environ=None):
+    """Get an integer from an environment variable, or a default."""
+    value = (environ or os.environ).get(name)
+    return int(value) if value not in (None, "") else default
+
+def get_engine_options(database_uri, environ=None):
+    """Get the SQLALCHEMY_ENGINE_OPTIONS for a database from the environment.
+
+    The connection pool of a postgres engine is sized by
+    ```DATABASE_POOL_SIZE``` and ```DATABASE_MAX_OVERFLOW```, its connections
+    are pinged before they are used (unless ```DATABASE_POOL_PRE_PING=0```)
+    and replaced every ```DATABASE_POOL_RECYCLE``` seconds, and every
+    statement is cancelled after ```DATABASE_STATEMENT_TIMEOUT```
+    milliseconds. A sqlite connection waits (its busy timeout)
+    ```SQLITE_BUSY_TIMEOUT``` milliseconds for the database to be unlocked.
+    """
+    environ = environ or os.environ
+    if database_uri.startswith("sqlite"):
+        busy_timeout = get_environ_int("SQLITE_BUSY_TIMEOUT", 5000, environ)
+        return {"connect_args": {"timeout": busy_timeout / 1000}}
+    options = {
+        "pool_size": get_environ_int("DATABASE_POOL_SIZE", 5, environ),
+        "max_overflow": get_environ_int("DATABASE_MAX_OVERFLOW", 10, environ),
+        "pool_timeout": get_environ_int("DATABASE_POOL_TIMEOUT", 30, environ),
+        "pool_recycle":
+            get_environ_int("DATABASE_POOL_RECYCLE", 1800, environ),
+        "pool_pre_ping":
+            bool(get_environ_int("DATABASE_POOL_PRE_PING", 1, environ))
+    }
+    if database_uri.startswith("postgres"):
+        statement_timeout = \
+            get_environ_int("DATABASE_STATEMENT_TIMEOUT", 30000, environ)
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={statement_timeout}"
+        }
+    return options
+
+# pylint: disable=unused-argument
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Put every sqlite database into write ahead logging mode.
+
+    In WAL mode readers no longer block the writer (or the writer readers),
+    so the web server's workers and the job worker can use the database at
+    once without waiting on each other's locks.
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("pragma journal_mode = wal")
+    cursor.execute("pragma synchronous = normal")
+    cursor.close()
@@ -4,13 +4,137 @@
 #
 # See /LICENCE.md for Copyright information
 """Helpers for dealing with files."""
+import os
+import io
 import sys
+import gzip
+import time
 import codecs
 import re
 import json
+import argparse
+from array import array
 from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain
 
 import cchardet as chardet
+try:
+    import ijson.backends.yajl2_cffi as ijson
+except ImportError:
+    sys.stderr.write("""Falling back to slower pure-python ijson\n""")
+    import ijson
+
+# only the start of a file is used to guess its encoding, there is no need
+# to run the detector over an entire (possibly very large) file.
+DETECT_BUFFER_SIZE = int(1e6)
+UTF8_PREFIX_SIZE = 64 * 1024
+
+# the encodings previously detected for each group of files.
+_GROUP_ENCODINGS = {}
+
+def guess_encoding(data, fallback_enc="utf8"):
+    """Guess the encoding of some bytes, using a fallback if it is unknown."""
+    return chardet.detect(data)["encoding"] or fallback_enc
+
+def has_utf8_prefix(data, prefix_size=UTF8_PREFIX_SIZE):
+    """Test if the start of some bytes is strictly valid utf8."""
+    decoder = codecs.getincrementaldecoder("utf8")(errors="strict")
+    try:
+        # a multi-byte character cut off by the end of the prefix is
+        # left in the decoder rather than being treated as an error.
+        decoder.decode(data[:prefix_size], final=len(data) <= prefix_size)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def is_decodable(data, encoding):
+    """Test if some bytes can be strictly decoded with an encoding."""
+    try:
+        data.decode(encoding)
+    except (UnicodeDecodeError, LookupError):
+        return False
+    return True
+
+@lru_cache(maxsize=None)
+def is_multibyte_encoding(encoding):
+    """Test if an encoding uses more than a single byte for some characters.
+
+    Almost any bytes can be decoded with a single byte encoding, so only a
+    multi-byte encoding can be checked by strictly decoding some bytes.
+    """
+    try:
+        return len("\u3042".encode(encoding, errors="ignore")) > 1
+    except LookupError:
+        return False
+
+def detect_encoding(data,
+                    fallback_enc="utf8",
+                    cached_enc=None,
+                    detect_buffer_size=DETECT_BUFFER_SIZE):
+    """Detect the encoding of some bytes.
+
+    Bytes which start with valid utf8 are checked to see if they are utf8,
+    then the previously detected multi-byte ```cached_enc``` is tried before
+    finally guessing the encoding from the first ```detect_buffer_size```
+    bytes.
+    """
+    if data.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if has_utf8_prefix(data) and is_decodable(data, "utf8"):
+        return "utf8"
+    if cached_enc is not None and is_multibyte_encoding(cached_enc) and \
+            is_decodable(data, cached_enc):
+        return cached_enc
+    return guess_encoding(data[:detect_buffer_size], fallback_enc=fallback_enc)
+
+def detect_group_encoding(group,
+                          data,
+                          fallback_enc="utf8",
+                          detect_buffer_size=DETECT_BUFFER_SIZE):
+    """Detect the encoding of some bytes which belong to a group of files.
+
+    Files in the same group (such as the pages of a crawl) are assumed to
+    usually share an encoding, so the last encoding detected in the group is
+    tried before guessing. A group of None is never cached.
+    """
+    encoding = detect_encoding(data,
+                               fallback_enc=fallback_enc,
+                               cached_enc=_GROUP_ENCODINGS.get(group),
+                               detect_buffer_size=detect_buffer_size)
+    if group is not None and is_multibyte_encoding(encoding) and \
+            codecs.lookup(encoding).name not in ("utf-8", "utf-8-sig"):
+        _GROUP_ENCODINGS[group] = encoding
+    return encoding
+
+def detect_file_encoding(filename,
+                         data,
+                         fallback_enc="utf8",
+                         detect_buffer_size=DETECT_BUFFER_SIZE):
+    """Detect the encoding of a file's content, grouped by its directory."""
+    return detect_group_encoding(os.path.dirname(os.path.abspath(filename)),
+                                 data,
+                                 fallback_enc=fallback_enc,
+                                 detect_buffer_size=detect_buffer_size)
+
+def decode_bytes(data,
+                 encoding=None,
+                 group=None,
+                 fallback_enc="utf8",
+                 errors="strict"):
+    """Decode some bytes in an encoding, detecting it if it isn't given.
+
+    If the encoding is one python doesn't know (or can't decode the
+    bytes) they are decoded as ```fallback_enc``` with the invalid bytes
+    replaced, rather than failing.
+    """
+    if encoding is None:
+        encoding = \
+            detect_group_encoding(group, data, fallback_enc=fallback_enc)
+    try:
+        return data.decode(encoding, errors)
+    except (LookupError, UnicodeDecodeError):
+        return data.decode(fallback_enc, errors="replace")
 
 # pylint: disable=too-many-arguments
 @contextmanager
@@ -20,17 +144,38 @@ def open_transcoded(filename,
                     target_enc="utf8",
                     errors="strict",
                     fallback_enc="utf8",
-                    detect_buffer_size=50 * int(10e6)):
-    """Open a file and transcode the content on the fly."""
+                    detect_buffer_size=DETECT_BUFFER_SIZE):
+    """Open a file and transcode the content on the fly.
+
+    Files opened for reading are read once and transcoded in memory.
+    """
     # ensure we open the file in a binary mode
     binary_mode = re.sub(r"([^b+]+)(?:b)?([+]?)", r"\1b\2", mode)
+    if binary_mode == "rb":
+        with open(filename, "rb") as file_obj:
+            data = file_obj.read()
+        if source_enc is None:
+            source_enc = detect_file_encoding(
+                filename,
+                data,
+                fallback_enc=fallback_enc,
+                detect_buffer_size=detect_buffer_size
+            )
+        text = decode_bytes(data,
+                            encoding=source_enc,
+                            fallback_enc=fallback_enc,
+                            errors=errors)
+        yield io.BytesIO(text.encode(target_enc, errors))
+        return
     if source_enc is None:
         # pylint: disable=broad-except
         try:
             # pylint: disable=unspecified-encoding
             with open(filename, "rb") as file_obj:
                 data = file_obj.read(detect_buffer_size)
-            source_enc = chardet.detect(data)["encoding"]
+            source_enc = detect_file_encoding(filename,
+                                              data,
+                                              fallback_enc=fallback_enc)
             del data
         except Exception as error:
             print("""Warning: an error occured while trying to guess the """
@@ -47,15 +192,127 @@ def open_transcoded(filename,
             yield recorder
 
 
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl")
+COMPRESSED_EXTENSION = ".gz"
+JSON_INDEX_EXTENSION = ".idx"
+
+def is_ndjson_filename(filename):
+    """Test if a (possibly compressed) file is newline delimited json."""
+    if filename.endswith(COMPRESSED_EXTENSION):
+        filename = filename[:-len(COMPRESSED_EXTENSION)]
+    return filename.endswith(NDJSON_EXTENSIONS)
+
+
+# pylint: disable=too-few-public-methods
+class CompressibleFileType(argparse.FileType):
+    """An ```argparse.FileType``` which gzips files ending in .gz."""
+
+    def __call__(self, string):
+        """Open the file named by an argument."""
+        if string == "-" or not string.endswith(COMPRESSED_EXTENSION):
+            return super().__call__(string)
+        mode = self._mode if "b" in self._mode else f"{self._mode}t"
+        try:
+            return gzip.open(string,
+                             mode,
+                             encoding=self._encoding,
+                             errors=self._errors)
+        except OSError as error:
+            raise argparse.ArgumentTypeError(
+                f"can't open '{string}': {error}"
+            )
+
+
+@contextmanager
+def closing_output(fileobj):
+    """Close an output file once it has been written, unless it is stdout."""
+    try:
+        yield fileobj
+    finally:
+        if fileobj in (sys.stdout, sys.stderr):
+            fileobj.flush()
+        else:
+            fileobj.close()
+
+
+def write_json_list_index(fileobj, extents):
+    """Write the (offset, length) extents of some entries to an index file."""
+    index = array("Q", chain.from_iterable(extents))
+    if sys.byteorder != "little":
+        index.byteswap()
+    index.tofile(fileobj)
+
+def read_json_list_index(fileobj):
+    """Read the (offset, length) extents of the entries in an index file."""
+    index = array("Q")
+    index.frombytes(fileobj.read())
+    if sys.byteorder != "little":
+        index.byteswap()
+    return index
+
+def iter_json_list_lines(fileobj, ndjson=False):
+    """Iterate over the offsets and bytes of the entries in a json list file.
+
+    This relies on each entry being on its own line, as they are in the
+    files written by ```JSONListStream```, and so doesn't parse any json.
+    """
+    offset = 0
+    for line in fileobj:
+        start, end = 0, len(line.rstrip(b"\r\n"))
+        if not ndjson and offset == 0 and line.startswith(b"["):
+            start = 1
+        if not ndjson and end > start and line[end - 1:end] in (b",", b"]"):
+            end -= 1
+        if end > start:
+            yield offset + start, line[start:end]
+        offset += len(line)
+
+
+# pylint: disable=too-many-instance-attributes
 class JSONListStream():
-    """A context-manager class to stream json objects to a file."""
+    """A context-manager class to stream json objects to a file.
+
+    Entries are serialized into a buffer which is written out once it holds
+    ```buffer_size``` characters or ```flush_interval``` seconds have passed
+    since it was last written. When ```ndjson``` is set (or ```None``` and
+    the file has a .ndjson or .jsonl name) entries are written one per line
+    rather than as a json list. When ```index``` is set the offset and
+    length of every entry is written to a sidecar .idx file, which
+    ```JSONListReader``` uses to seek to an entry.
+    """
 
-    def __init__(self, fileobj):
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 fileobj,
+                 buffer_size=64 * 1024,
+                 flush_interval=5.0,
+                 ndjson=False,
+                 index=False):
         """Initialize this JSONListStream with fileobj."""
         # pylint: disable=super-with-arguments
         super(JSONListStream, self).__init__()
         self._printed_first_entry = False
         self._fileobj = fileobj
+        self._buffer = []
+        self._buffered_size = 0
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._last_flush_time = time.monotonic()
+        if ndjson is None:
+            ndjson = is_ndjson_filename(str(getattr(fileobj, "name", "")))
+        self._ndjson = ndjson
+        self._index_filename = None
+        self._index_fileobj = None
+        self._offset = 0
+        self._extents = []
+        if index:
+            filename = getattr(fileobj, "name", None)
+            if not isinstance(filename, str) or \
+                    filename.endswith(COMPRESSED_EXTENSION) or \
+                    fileobj in (sys.stdout, sys.stderr):
+                raise ValueError("""An index can only be written for an """
+                                 """uncompressed file.""")
+            self._index_filename = f"{filename}{JSON_INDEX_EXTENSION}"
 
     def __enter__(self):
         """Context to start using this JSONListStream."""
@@ -67,19 +324,179 @@ class JSONListStream():
 
     def enter(self):
         """Start using this JSONListStream, printing the starting character."""
-        self._fileobj.write("[")
+        if self._index_filename is not None:
+            # pylint: disable=consider-using-with
+            self._index_fileobj = open(self._index_filename, "wb")
+        if not self._ndjson:
+            self._fileobj.write("[")
+            self._offset += 1
         return self
 
     def exit(self):
         """Stop using this JSONListStream, printing the ending character."""
-        self._fileobj.write("]")
+        if not self._ndjson:
+            self._buffer.append("]")
+        self.flush()
+        if self._index_fileobj is not None:
+            self._index_fileobj.close()
+            self._index_fileobj = None
         return self
 
+    def flush(self):
+        """Write the buffered entries out to the file."""
+        if self._buffer:
+            self._fileobj.write("".join(self._buffer))
+            self._buffer.clear()
+            self._buffered_size = 0
+        self._fileobj.flush()
+        # the index is only written once the entries it refers to are.
+        if self._index_fileobj is not None and self._extents:
+            write_json_list_index(self._index_fileobj, self._extents)
+            self._index_fileobj.flush()
+            self._extents.clear()
+        self._last_flush_time = time.monotonic()
+
     def write(self, entry):
         """Write a new entry to this JSONListStream."""
-        if not self._printed_first_entry:
+        # json.dumps escapes all non-ascii characters, so the length of
+        # the serialized entry is also the number of bytes it takes up.
+        serialized_entry = json.dumps(entry)
+        entry_length = len(serialized_entry)
+        entry_offset = self._offset
+        if self._ndjson:
+            serialized_entry = f"{serialized_entry}\n"
+        elif not self._printed_first_entry:
             self._printed_first_entry = True
         else:
-            self._fileobj.write(",\n")
+            serialized_entry = f",\n{serialized_entry}"
+            entry_offset += 2
+        self._buffer.append(serialized_entry)
+        self._buffered_size += len(serialized_entry)
+        self._offset += len(serialized_entry)
+        if self._index_fileobj is not None:
+            self._extents.append((entry_offset, entry_length))
+        if self._buffered_size >= self._buffer_size or \
+                time.monotonic() - self._last_flush_time >= \
+                self._flush_interval:
+            self.flush()
+
+
+class JSONListReader():
+    """A context-manager class to read the entries of a json list file.
+
+    The entries of files written by ```JSONListStream``` (either as a json
+    list or ndjson, optionally gzipped) can be counted, indexed and sliced
+    without parsing the rest of the file. The offsets of the entries are
+    read from the sidecar .idx file when there is an up to date one,
+    otherwise they are found by scanning the lines of the file. Iterating
+    also works for any other json list, such as a pretty-printed one, which
+    is parsed with ijson if it isn't laid out one entry per line.
+    """
+
+    def __init__(self, filename):
+        """Initialize a JSONListReader for the file filename."""
+        self._filename = filename
+        self._fileobj = None
+        self._index = None
+
+    def __enter__(self):
+        """Context to start using this JSONListReader."""
+        return self
+
+    def __exit__(self, exc, exc_type, traceback):
+        """Context to stop using this JSONListReader."""
+        self.close()
+
+    def _open(self):
+        """Open the file, gzipped files can be read but seeking is slow."""
+        if self._fileobj is None:
+            # pylint: disable=consider-using-with
+            if self._filename.endswith(COMPRESSED_EXTENSION):
+                self._fileobj = gzip.open(self._filename, "rb")
+            else:
+                self._fileobj = open(self._filename, "rb")
+        return self._fileobj
+
+    def _has_index_file(self):
+        """Test if there is an up to date sidecar .idx file."""
+        index_filename = f"{self._filename}{JSON_INDEX_EXTENSION}"
+        return os.path.exists(index_filename) and \
+            os.path.getmtime(index_filename) >= \
+            os.path.getmtime(self._filename)
+
+    def _is_one_entry_per_line(self):
+        """Test if the file has the layout ```JSONListStream``` writes.
+
+        That is either ndjson, or a list whose first line is the opening
+        bracket followed by a whole entry.
+        """
+        if self._has_index_file() or is_ndjson_filename(self._filename):
+            return True
+        fileobj = self._open()
+        fileobj.seek(0)
+        first_line = fileobj.readline()
+        try:
+            _, entry = next(iter_json_list_lines(io.BytesIO(first_line)))
+            json.loads(entry)
+        except (StopIteration, ValueError):
+            return False
+        return first_line.startswith(b"[")
+
+    def _get_index(self):
+        """Get the flattened (offset, length) extents of the entries."""
+        if self._index is not None:
+            return self._index
+        if self._has_index_file():
+            index_filename = f"{self._filename}{JSON_INDEX_EXTENSION}"
+            with open(index_filename, "rb") as index_fileobj:
+                self._index = read_json_list_index(index_fileobj)
+        else:
+            fileobj = self._open()
+            fileobj.seek(0)
+            self._index = array("Q", chain.from_iterable(
+                (offset, len(entry))
+                for offset, entry in iter_json_list_lines(
+                    fileobj,
+                    ndjson=is_ndjson_filename(self._filename)
+                )
+            ))
+        return self._index
+
+    def __len__(self):
+        """Get the number of entries in the file."""
+        return len(self._get_index()) // 2
+
+    def _read_entry(self, index):
+        """Read and parse the entry at a (non-negative) index."""
+        offset, length = self._get_index()[2 * index:2 * index + 2]
+        fileobj = self._open()
+        fileobj.seek(offset)
+        return json.loads(fileobj.read(length))
+
+    def __getitem__(self, index):
+        """Get an entry, or a list of entries for a slice."""
+        if isinstance(index, slice):
+            return [self._read_entry(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("JSONListReader index out of range")
+        return self._read_entry(index)
+
+    def __iter__(self):
+        """Iterate over all the entries in the file."""
+        is_one_entry_per_line = self._is_one_entry_per_line()
+        fileobj = self._open()
+        fileobj.seek(0)
+        if not is_one_entry_per_line:
+            yield from ijson.items(fileobj, "item", use_float=True)
+            return
+        ndjson = is_ndjson_filename(self._filename)
+        for _, entry in iter_json_list_lines(fileobj, ndjson=ndjson):
+            yield json.loads(entry)
 
-        self._fileobj.write(json.dumps(entry))
+    def close(self):
+        """Close the file."""
+        if self._fileobj is not None:
+            self._fileobj.close()
+            self._fileobj = None
@@ -12,6 +12,7 @@ from datetime import datetime
 from animeu.elo import elo_algorithim
 from animeu.app import db
 from animeu.models import ELORankingCalculation, WaifuPickBattle
+from animeu.sync_characters import get_character_ids
 
 def get_elo_algorithim_hash():
     """Get the hash of the algorithim file."""
@@ -20,10 +21,33 @@ def get_elo_algorithim_hash():
         md5.update(fileobj.read().encode("utf8"))
     return md5.hexdigest()
 
+def query_latest_battle():
+    """Query the battle which was fought last."""
+    return WaifuPickBattle.query.order_by(WaifuPickBattle.date.desc())
+
+def query_new_battles(start_battle_id):
+    """Query the battles after a battle, or every battle if it's 0."""
+    query = WaifuPickBattle.query
+    if start_battle_id:
+        query = query.filter(WaifuPickBattle.id > start_battle_id)
+    return query
+
+def query_last_new_battle(start_battle_id):
+    """Query the new battle which was fought last."""
+    return query_new_battles(start_battle_id)\
+        .order_by(WaifuPickBattle.date.desc())\
+        .limit(1)
+
+def query_ordered_new_games(start_battle_id, end_battle_id):
+    """Query the winner and loser of the new battles in the order fought."""
+    return query_new_battles(start_battle_id)\
+        .filter(WaifuPickBattle.id <= end_battle_id)\
+        .order_by(WaifuPickBattle.date)\
+        .with_entities(WaifuPickBattle.winner_id, WaifuPickBattle.loser_id)
+
 def update_rankings(progress_callback=None, callback_rate=1000):
     """Update the ELO ranking board."""
-    latest_battle = \
-        WaifuPickBattle.query.order_by(WaifuPickBattle.date.desc()).first()
+    latest_battle = query_latest_battle().first()
     # if there are no battles don't bother updating the rankings.
     if not latest_battle:
         print("elo: no battles found skipping ranking", file=sys.stderr)
@@ -32,31 +56,28 @@ def update_rankings(progress_callback=None, callback_rate=1000):
     latest_ranking_calc = ELORankingCalculation.query\
         .order_by(ELORankingCalculation.date.desc())\
         .first()
+    # the rankings are stored by name but calculated by character id.
+    name_to_id = get_character_ids()
     # check we used the same algorithim to update the rankings
     player_to_current_rank = {}
     if latest_ranking_calc:
         if latest_ranking_calc.algorithim_hash == current_algo_hash:
-            player_to_current_rank = json.loads(latest_ranking_calc.rankings)
+            player_to_current_rank = {
+                name_to_id[name]: rank for name, rank
+                in json.loads(latest_ranking_calc.rankings).items()
+            }
         else:
             latest_ranking_calc = None
             print("elo: ranking algorithim change detected", file=sys.stderr)
     # run the algorithim to determine the new rankings
-    new_games_query = WaifuPickBattle.query
     start_battle_id = \
         latest_ranking_calc.latest_battle_id if latest_ranking_calc else 0
-    if start_battle_id:
-        new_games_query = \
-            new_games_query.filter(WaifuPickBattle.id > start_battle_id)
-    end_battle_id = new_games_query\
-        .order_by(WaifuPickBattle.date.desc())\
-        .limit(1)\
+    end_battle_id = query_last_new_battle(start_battle_id)\
         .value(WaifuPickBattle.id) or start_battle_id
     print(f"elo: updating using battles {start_battle_id} - {end_battle_id}",
           file=sys.stderr)
-    ordered_games = new_games_query\
-        .filter(WaifuPickBattle.id <= end_battle_id)\
-        .order_by(WaifuPickBattle.date)\
-        .all()
+    ordered_games = \
+        query_ordered_new_games(start_battle_id, end_battle_id).all()
     def _progressable_ordered_games():
         for i, game in enumerate(ordered_games):
             yield game
@@ -68,9 +89,11 @@ def update_rankings(progress_callback=None, callback_rate=1000):
     new_rankings = elo_algorithim.calculate_elo_rankings(
         ordered_games=_progressable_ordered_games(),
         player_to_current_rank=player_to_current_rank,
-        game_to_winner=lambda g: g.winner_name,
-        game_to_loser=lambda g: g.loser_name
+        game_to_winner=lambda g: g.winner_id,
+        game_to_loser=lambda g: g.loser_id
     )
+    id_to_name = {i: name for name, i in name_to_id.items()}
+    new_rankings = {id_to_name[i]: rank for i, rank in new_rankings.items()}
     print(json.dumps(new_rankings, indent=2), file=sys.stderr)
     db.session.add(ELORankingCalculation(
         date=datetime.now(),
@@ -79,3 +102,14 @@ def update_rankings(progress_callback=None, callback_rate=1000):
         algorithim_hash=current_algo_hash
     ))
     db.session.commit()
+
+def rewind_rankings(battle_id):
+    """Forget the ranking calculations which included a battle onwards.
+
+    The next update of the rankings then replays the battles from the last
+    calculation made before the battle, e.g after the battle was deleted.
+    """
+    ELORankingCalculation.query\
+        .filter(ELORankingCalculation.latest_battle_id >= battle_id)\
+        .delete(synchronize_session=False)
+    db.session.commit()
@@ -4,65 +4,79 @@
 #
 # See /LICENCE.md for Copyright information
 """Query functions used to populate the feed."""
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import select, func, expression
 from animeu.app import db
-from animeu.models import WaifuPickBattle
+from animeu.models import WaifuPickBattle, Character
 
 def get_battle_appearences_cte():
     """Create a sqlaclhemy subquery of the battle appearences."""
     wins = select([
         WaifuPickBattle.date,
-        WaifuPickBattle.winner_name.label("name"),
+        WaifuPickBattle.winner_id.label("character_id"),
         expression.literal_column("1").label("was_winner"),
         expression.literal_column("0").label("was_loser")
     ])
     losses = select([
         WaifuPickBattle.date,
-        WaifuPickBattle.loser_name.label("name"),
+        WaifuPickBattle.loser_id.label("character_id"),
         expression.literal_column("0").label("was_winner"),
         expression.literal_column("1").label("was_loser")
     ])
     return wins.union_all(losses).cte("battle_appearence")
 
+def query_named_win_loss_counts(counts_query, order_by):
+    """Look up the names of the characters in a win/loss counts query.
+
+    The counts are grouped by character id, and only the names of the
+    characters which made the cut are joined on afterwards.
+    """
+    counts = counts_query.alias()
+    return db.session.query(Character.name, counts.c.wins, counts.c.losses)\
+        .join(counts, counts.c.character_id == Character.id)\
+        .order_by(order_by(counts).desc())\
+        .all()
+
 def query_most_winning_waifus(from_date=None, limit=20):
     """Find the waifus with the most wins in a given date range."""
     appearence_cte = get_battle_appearences_cte()
     query = \
         select([
-            appearence_cte.c.name,
+            appearence_cte.c.character_id,
             func.sum(appearence_cte.c.was_winner).label("wins"),
             func.sum(appearence_cte.c.was_loser).label("losses"),
         ])
     if from_date:
         query = query.where(appearence_cte.c.date >= from_date)
     query = query\
-        .group_by(appearence_cte.c.name)\
+        .group_by(appearence_cte.c.character_id)\
         .order_by(func.sum(appearence_cte.c.was_winner).desc())\
-        .limit(limit)\
-        .alias()
-    return db.session.query(query).all()
+        .limit(limit)
+    return query_named_win_loss_counts(query, lambda c: c.c.wins)
 
 def query_most_battled_waifus(from_date=None, limit=20):
     """Find the waifus with the most battles in a given date range."""
     appearence_cte = get_battle_appearences_cte()
     query = \
         select([
-            appearence_cte.c.name,
+            appearence_cte.c.character_id,
             func.sum(appearence_cte.c.was_winner).label("wins"),
             func.sum(appearence_cte.c.was_loser).label("losses"),
         ])
     if from_date:
         query = query.where(appearence_cte.c.date >= from_date)
     query = query\
-        .group_by(appearence_cte.c.name)\
+        .group_by(appearence_cte.c.character_id)\
         .order_by(func.count().desc())\
-        .limit(limit)\
-        .alias()
-    return db.session.query(query).all()
+        .limit(limit)
+    return query_named_win_loss_counts(query,
+                                       lambda c: c.c.wins + c.c.losses)
 
 def query_most_recent_battles(limit=20):
     """Find the most recent battles."""
     return WaifuPickBattle.query\
+        .options(joinedload(WaifuPickBattle.winner),
+                 joinedload(WaifuPickBattle.loser))\
         .order_by(WaifuPickBattle.id.desc())\
         .limit(limit)\
         .all()
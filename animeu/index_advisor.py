@@ -0,0 +1,141 @@
+# /animeu/index_advisor.py
+#
+# CLI app to check the hot queries are served by indexes.
+#
+# See /LICENCE.md for Copyright information
+"""CLI app to check the hot queries are served by indexes."""
+import sys
+import argparse
+
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import select
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
+
+from animeu.app import db
+from animeu.models import WaifuPickBattle, FavouritedWaifu
+from animeu.elo.elo_leaderboard_updater import \
+    query_latest_battle, query_last_new_battle, query_ordered_new_games
+
+class Explain(Executable, ClauseElement):
+    """An EXPLAIN of a statement."""
+
+    def __init__(self, statement, prefix):
+        """Initialize an Explain of a statement with a database's prefix."""
+        self.statement = statement
+        self.prefix = prefix
+
+# pylint: disable=unused-argument
+@compiles(Explain)
+def compile_explain(element, compiler, **kwargs):
+    """Compile an EXPLAIN of a statement."""
+    return f"{element.prefix} {compiler.process(element.statement)}"
+
+# the queries run by the pages and jobs which have to be served by an index,
+# each with the function it mirrors.
+HOT_QUERIES = {
+    "profile.queries.get_recent_waifu_battles":
+        lambda: select([WaifuPickBattle.date,
+                        WaifuPickBattle.winner_name,
+                        WaifuPickBattle.loser_name])
+        .where(WaifuPickBattle.user_id == 1)
+        .order_by(WaifuPickBattle.date.desc())
+        .limit(10),
+    "profile.queries.get_favourite_waifu_list":
+        lambda: FavouritedWaifu.query
+        .options(joinedload(FavouritedWaifu.character))
+        .filter_by(user_id=1)
+        .order_by(FavouritedWaifu.id.desc())
+        .limit(10),
+    "profile.queries.query_has_favourited_waifus":
+        lambda: select([FavouritedWaifu.character_name])
+        .where(FavouritedWaifu.character_name.in_(["a", "b"]))
+        .where(FavouritedWaifu.user_id == 1),
+    "profile.logic.maybe_get_favourited_waifu":
+        lambda: FavouritedWaifu.query
+        .filter(FavouritedWaifu.user_id == 1,
+                FavouritedWaifu.character_name == "a")
+        .limit(1),
+    "profile.logic.get_next_favourited_waifu_order_for_user":
+        lambda: select([FavouritedWaifu.order])
+        .where(FavouritedWaifu.user_id == 1)
+        .order_by(FavouritedWaifu.order)
+        .limit(1),
+    "feed.queries.query_most_recent_battles":
+        lambda: WaifuPickBattle.query
+        .options(joinedload(WaifuPickBattle.winner),
+                 joinedload(WaifuPickBattle.loser))
+        .order_by(WaifuPickBattle.id.desc())
+        .limit(20),
+    # the ranking update's queries are built by the same functions it uses.
+    "elo_leaderboard_updater.update_rankings (latest battle)":
+        lambda: query_latest_battle().limit(1),
+    "elo_leaderboard_updater.update_rankings (last new battle)":
+        lambda: query_last_new_battle(1),
+    "elo_leaderboard_updater.update_rankings (new battles)":
+        lambda: query_ordered_new_games(1, 2),
+}
+
+def get_plan_details(statement):
+    """Get the steps of a statement's query plan, one per line."""
+    dialect = db.engine.dialect.name
+    if dialect == "sqlite":
+        return [row[-1] for row in
+                db.session.execute(Explain(statement, "EXPLAIN QUERY PLAN"))]
+    if dialect == "postgresql":
+        return [row[0] for row in
+                db.session.execute(Explain(statement, "EXPLAIN"))]
+    raise ValueError(f"Unable to explain queries on {dialect}")
+
+def find_plan_problems(plan_details, is_limited=False):
+    """Find the steps of a query plan which scan or sort a whole table.
+
+    A limited query which reads a table in the order it was asked for (e.g
+    by its primary key) stops after the first rows, so its scan is fine.
+    """
+    steps = [d.strip().lstrip("->").strip() for d in plan_details]
+    sort_steps = [s for s in steps
+                  if "TEMP B-TREE FOR ORDER BY" in s or s.startswith("Sort ")]
+    problems = [f"sort: {s}" for s in sort_steps]
+    for step in steps:
+        # sqlite: "SCAN waifu_battles" without "USING ... INDEX" is a full
+        # scan, postgres: "Seq Scan on waifu_battles".
+        is_full_scan = (step.startswith("SCAN ") and "INDEX" not in step) or \
+            step.startswith("Seq Scan")
+        if is_full_scan and (sort_steps or not is_limited):
+            problems.append(f"full scan: {step}")
+    return problems
+
+def main(argv=None):
+    """Entry point to the index advisor."""
+    argv = argv or sys.argv[1:]
+    parser = argparse.ArgumentParser("""Explain the hot queries.""")
+    parser.add_argument("--verbose",
+                        action="store_true",
+                        help="""Print the plan of every query.""")
+    result = parser.parse_args(argv)
+    flagged = 0
+    for name, make_query in HOT_QUERIES.items():
+        query = make_query()
+        statement = getattr(query, "statement", query)
+        plan_details = get_plan_details(statement)
+        # pylint: disable=protected-access
+        problems = find_plan_problems(
+            plan_details,
+            is_limited=statement._limit_clause is not None
+        )
+        flagged += bool(problems)
+        print(f"{'FLAG' if problems else 'OK':4} {name}")
+        for problem in problems:
+            print(f"     {problem}")
+        if result.verbose:
+            for detail in plan_details:
+                print(f"       | {detail}")
+    if flagged:
+        print(f"{flagged} queries are not fully served by an index. Note "
+              f"that postgres prefers a sequential scan of a small table.",
+              file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
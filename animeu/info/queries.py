@@ -8,18 +8,20 @@ import json
 from sqlalchemy.sql import select, func
 
 from animeu.app import db
-from animeu.models import ELORankingCalculation
+from animeu.models import ELORankingCalculation, Character
 from animeu.feed.queries import get_battle_appearences_cte
 
 def query_character_win_loss_counts(character_name):
     """Get the number of wins/losses of a character."""
     appearence_cte = get_battle_appearences_cte()
-    return db.engine.execute(
+    return db.session.execute(
         select([
             func.sum(appearence_cte.c.was_winner).label("wins"),
             func.sum(appearence_cte.c.was_loser).label("losses"),
         ])\
-        .where(appearence_cte.c.name == character_name)
+        .where(appearence_cte.c.character_id == select([Character.id])
+               .where(Character.name == character_name)
+               .as_scalar())
     ).first()
 
 def query_character_elo(character_name):
@@ -0,0 +1,6 @@
+# /animeu/jobs/__init__.py
+#
+# Background jobs which are run by worker processes instead of the site.
+#
+# See /LICENCE.md for Copyright information
+"""Background jobs which are run by worker processes instead of the site."""
@@ -0,0 +1,106 @@
+# /animeu/jobs/locks.py
+#
+# Leases on named locks which expire unless they are renewed.
+#
+# See /LICENCE.md for Copyright information
+"""Leases on named locks which expire unless they are renewed."""
+from datetime import datetime
+from collections import namedtuple
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from animeu.app import db
+from animeu.models import Lock
+
+LockLease = namedtuple("LockLease",
+                       ["name", "owner", "fencing_token", "lease_expiry"])
+
+def get_held_lock(name, now=None):
+    """Get a lock if someone holds an unexpired lease on it."""
+    now = now or datetime.now()
+    return Lock.query\
+        .filter(Lock.name == name,
+                Lock.owner.isnot(None),
+                Lock.lease_expiry >= now)\
+        .first()
+
+def acquire_lock(name, owner, lease_duration, now=None):
+    """Acquire a lease on a lock if it is free or its lease has expired.
+
+    Every time a lock is acquired its fencing token is incremented, the
+    writes made by the holder of a lease are made conditional on its token
+    so that a holder whose lease expired and was taken over can't clobber
+    the writes of the new holder. Returns a LockLease, or None if someone
+    else holds the lock.
+    """
+    now = now or datetime.now()
+    lease_expiry = now + lease_duration
+    # the lock is taken over in a single update so that only one of any
+    # racing acquirers can succeed.
+    acquired = Lock.query\
+        .filter(Lock.name == name,
+                or_(Lock.owner.is_(None), Lock.lease_expiry < now))\
+        .update({"owner": owner,
+                 "lease_expiry": lease_expiry,
+                 "fencing_token": Lock.fencing_token + 1,
+                 "date": now,
+                 "progress": 0},
+                synchronize_session=False)
+    if not acquired:
+        if db.session.query(Lock.name).filter_by(name=name).scalar():
+            db.session.commit()
+            return None
+        try:
+            db.session.add(Lock(name=name,
+                                owner=owner,
+                                lease_expiry=lease_expiry,
+                                fencing_token=1,
+                                date=now,
+                                progress=0))
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            return None
+    fencing_token = db.session.query(Lock.fencing_token)\
+        .filter_by(name=name)\
+        .scalar()
+    db.session.commit()
+    return LockLease(name, owner, fencing_token, lease_expiry)
+
+def _filter_by_lease(lease):
+    """Filter the locks to the one a lease is still held on."""
+    return Lock.query.filter(Lock.name == lease.name,
+                             Lock.owner == lease.owner,
+                             Lock.fencing_token == lease.fencing_token)
+
+def renew_lock(lease, lease_duration, now=None):
+    """Extend a lease, returning the new lease or None if it was lost."""
+    lease_expiry = (now or datetime.now()) + lease_duration
+    renewed = _filter_by_lease(lease)\
+        .update({"lease_expiry": lease_expiry}, synchronize_session=False)
+    db.session.commit()
+    return lease._replace(lease_expiry=lease_expiry) if renewed else None
+
+def update_lock_progress(lease, progress):
+    """Record the progress of the holder of a lease, False if it was lost."""
+    updated = _filter_by_lease(lease)\
+        .update({"progress": progress}, synchronize_session=False)
+    db.session.commit()
+    return bool(updated)
+
+def release_lock(lease):
+    """Release a lease, unless it has already been taken over."""
+    _filter_by_lease(lease)\
+        .update({"owner": None, "lease_expiry": None},
+                synchronize_session=False)
+    db.session.commit()
+
+def force_release_lock(name):
+    """Release whoever holds a lock, returning False if it wasn't held."""
+    released = Lock.query\
+        .filter(Lock.name == name, Lock.owner.isnot(None))\
+        .update({"owner": None, "lease_expiry": None},
+                synchronize_session=False)
+    db.session.commit()
+    return bool(released)
@@ -0,0 +1,88 @@
+# /animeu/jobs/progress.py
+#
+# Throttled reporting of the progress of a running job.
+#
+# See /LICENCE.md for Copyright information
+"""Throttled reporting of the progress of a running job."""
+import sys
+import time
+from math import ceil
+
+from sqlalchemy import select, and_
+
+from animeu.app import db
+from animeu.models import Job, Lock
+from animeu.jobs.queries import JOB_RUNNING, JobCancelled, get_job_lease
+
+PROGRESS_INTERVAL = 1.0
+
+class ProgressReporter():
+    """A progress callback which records a job's progress every so often.
+
+    The progress is written on a connection of its own rather than through
+    the job's session, so that reporting it doesn't flush or commit any of
+    the job's own pending changes. As the lock's progress is written with
+    the job's fencing token, a job which has lost its lease (or been asked
+    to cancel) finds out the next time its progress is recorded and a
+    JobCancelled is raised from the callback.
+    """
+
+    def __init__(self, job, min_interval=PROGRESS_INTERVAL):
+        """Initialize a ProgressReporter for a running job."""
+        self._job_id = job.id
+        self._lease = get_job_lease(job)
+        self._min_interval = min_interval
+        self._last_report_time = None
+        self._last_progress = None
+        self._connection = None
+
+    def __enter__(self):
+        """Context to open the connection the progress is written on."""
+        self._connection = db.engine.connect()
+        return self
+
+    def __exit__(self, exc, exc_type, traceback):
+        """Context to close the connection the progress is written on."""
+        self._connection.close()
+        self._connection = None
+
+    def __call__(self, i, total):
+        """Report that i of total steps are done, if it's been long enough."""
+        progress = ceil((i / total) * 100) if total else 100
+        now = time.monotonic()
+        if progress == self._last_progress:
+            return
+        if self._last_report_time is not None and \
+                now - self._last_report_time < self._min_interval and \
+                progress < 100:
+            return
+        self._last_report_time = now
+        self._last_progress = progress
+        self.write_progress(progress)
+
+    def write_progress(self, progress):
+        """Record a job's progress, raising JobCancelled if it should stop."""
+        print(f"job {self._job_id}: {self._lease.name} progress {progress}%",
+              file=sys.stderr)
+        jobs, locks, lease = Job.__table__, Lock.__table__, self._lease
+        with self._connection.begin():
+            self._connection.execute(
+                jobs.update()
+                .where(jobs.c.id == self._job_id)
+                .values(progress=progress)
+            )
+            lock_updated = self._connection.execute(
+                locks.update()
+                .where(and_(locks.c.name == lease.name,
+                            locks.c.owner == lease.owner,
+                            locks.c.fencing_token == lease.fencing_token))
+                .values(progress=progress)
+            ).rowcount
+            should_run = self._connection.execute(
+                select([jobs.c.id])
+                .where(and_(jobs.c.id == self._job_id,
+                            jobs.c.status == JOB_RUNNING,
+                            jobs.c.cancel_requested.is_(False)))
+            ).scalar()
+        if not lock_updated or should_run is None:
+            raise JobCancelled()
@@ -0,0 +1,154 @@
+# /animeu/jobs/queries.py
+#
+# Database queries to queue, claim and finish jobs.
+#
+# See /LICENCE.md for Copyright information
+"""Database queries to queue, claim and finish jobs."""
+import json
+from uuid import uuid4
+from datetime import datetime, timedelta
+
+from animeu.app import db
+from animeu.models import Job
+from animeu.jobs.locks import (LockLease,
+                               acquire_lock,
+                               renew_lock,
+                               release_lock,
+                               force_release_lock)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+ACTIVE_JOB_STATUSES = [JOB_QUEUED, JOB_RUNNING]
+
+HEARTBEAT_INTERVAL = timedelta(seconds=5)
+HEARTBEAT_TIMEOUT = timedelta(seconds=30)
+# the lease of a running job is renewed by every heartbeat, a queued job's
+# lease has to last until a worker is free to claim it.
+RUNNING_LOCK_LEASE = HEARTBEAT_TIMEOUT
+QUEUED_LOCK_LEASE = timedelta(minutes=5)
+
+class JobCancelled(Exception):
+    """Raised in a job when it has been asked to stop."""
+
+def get_active_job(lock_name):
+    """Get the queued or running job holding a lock."""
+    return Job.query\
+        .filter(Job.lock_name == lock_name,
+                Job.status.in_(ACTIVE_JOB_STATUSES))\
+        .order_by(Job.id.desc())\
+        .first()
+
+def get_job_lease(job):
+    """Get the lease a job holds on its lock."""
+    return LockLease(job.lock_name, job.lock_owner, job.fencing_token, None)
+
+def enqueue_job(lock_name, **arguments):
+    """Take out a lock and queue a job to run while holding it."""
+    lease = acquire_lock(lock_name, f"job-{uuid4().hex}", QUEUED_LOCK_LEASE)
+    if lease is None:
+        return None
+    job = Job(lock_name=lock_name,
+              lock_owner=lease.owner,
+              fencing_token=lease.fencing_token,
+              arguments=json.dumps(arguments),
+              status=JOB_QUEUED,
+              progress=0,
+              cancel_requested=False,
+              created=datetime.now())
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def finish_job(job_id, status, error=None):
+    """Record that a job has finished and release its lock."""
+    job = Job.query.get(job_id)
+    if job is None or job.status not in ACTIVE_JOB_STATUSES:
+        return
+    job.status = status
+    job.error = error
+    job.finished = datetime.now()
+    if status == JOB_SUCCEEDED:
+        job.progress = 100
+    db.session.commit()
+    release_lock(get_job_lease(job))
+
+def expire_stale_jobs(now=None):
+    """Fail the running jobs whose worker has stopped heartbeating."""
+    now = now or datetime.now()
+    stale_job_ids = [
+        job_id for (job_id,) in db.session.query(Job.id).filter(
+            Job.status == JOB_RUNNING,
+            Job.heartbeat < now - HEARTBEAT_TIMEOUT
+        )
+    ]
+    for job_id in stale_job_ids:
+        finish_job(job_id,
+                   JOB_FAILED,
+                   error="The worker running the job stopped heartbeating.")
+    return stale_job_ids
+
+def claim_next_job(worker_name):
+    """Claim the oldest queued job for a worker, or None if there are none."""
+    while True:
+        job_id = db.session.query(Job.id)\
+            .filter(Job.status == JOB_QUEUED)\
+            .order_by(Job.id)\
+            .limit(1)\
+            .scalar()
+        if job_id is None:
+            return None
+        now = datetime.now()
+        # the status is checked again in the update so that only one of any
+        # racing workers gets the job.
+        claimed = Job.query\
+            .filter(Job.id == job_id, Job.status == JOB_QUEUED)\
+            .update({"status": JOB_RUNNING,
+                     "worker": worker_name,
+                     "started": now,
+                     "heartbeat": now},
+                    synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            continue
+        job = Job.query.get(job_id)
+        # the job's lease may have expired while it was queued and the lock
+        # been taken over by a newer job.
+        if renew_lock(get_job_lease(job), RUNNING_LOCK_LEASE) is None:
+            finish_job(job_id,
+                       JOB_CANCELLED,
+                       error="The job's lock was taken over while queued.")
+            continue
+        return job
+
+def heartbeat_jobs(job_ids):
+    """Renew the leases of some running jobs, cancelling any which are lost."""
+    if not job_ids:
+        return
+    now = datetime.now()
+    jobs = Job.query\
+        .filter(Job.id.in_(job_ids), Job.status == JOB_RUNNING)\
+        .all()
+    for job in jobs:
+        job.heartbeat = now
+        if renew_lock(get_job_lease(job), RUNNING_LOCK_LEASE, now) is None:
+            job.cancel_requested = True
+    db.session.commit()
+
+def cancel_job(lock_name):
+    """Cancel the job holding a lock and release it, if either exist."""
+    job = get_active_job(lock_name)
+    cancelled = False
+    if job is not None and job.status == JOB_QUEUED:
+        job.status = JOB_CANCELLED
+        job.finished = datetime.now()
+        cancelled = True
+    elif job is not None and not job.cancel_requested:
+        # the job stops the next time it reports its progress.
+        job.cancel_requested = True
+        cancelled = True
+    db.session.commit()
+    lock_released = force_release_lock(lock_name)
+    return cancelled or lock_released
@@ -0,0 +1,138 @@
+# /animeu/jobs/worker.py
+#
+# A worker which runs the queued jobs in a pool of processes.
+#
+# See /LICENCE.md for Copyright information
+"""A worker which runs the queued jobs in a pool of processes."""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import traceback
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from animeu.app import app, db
+from animeu.models import Job
+from animeu.admin.logic import JOB_ACTIONS
+from animeu.jobs.queries import (JOB_SUCCEEDED,
+                                 JOB_FAILED,
+                                 JOB_CANCELLED,
+                                 HEARTBEAT_INTERVAL,
+                                 JobCancelled,
+                                 claim_next_job,
+                                 expire_stale_jobs,
+                                 finish_job,
+                                 heartbeat_jobs)
+from animeu.jobs.progress import ProgressReporter
+
+def run_job(job_id):
+    """Run a claimed job, recording its progress and outcome."""
+    with app.app_context():
+        job = Job.query.get(job_id)
+        action = JOB_ACTIONS[job.lock_name]
+        arguments = json.loads(job.arguments)
+        try:
+            with ProgressReporter(job) as report_progress:
+                action(report_progress, **arguments)
+        except JobCancelled:
+            db.session.rollback()
+            finish_job(job_id, JOB_CANCELLED)
+            return JOB_CANCELLED
+        # pylint: disable=broad-except
+        except Exception:
+            db.session.rollback()
+            finish_job(job_id, JOB_FAILED, error=traceback.format_exc())
+            return JOB_FAILED
+        finish_job(job_id, JOB_SUCCEEDED)
+        return JOB_SUCCEEDED
+
+def make_executor(processes):
+    """Make a pool of processes to run jobs in."""
+    # the job processes are spawned so they get their own database
+    # connections rather than sharing this process'.
+    return ProcessPoolExecutor(max_workers=processes,
+                               mp_context=get_context("spawn"))
+
+def run_worker(worker_name, processes=2, poll_interval=1.0, stop_event=None):
+    """Claim and run jobs until interrupted (or stop_event is set)."""
+    with app.app_context():
+        executor = make_executor(processes)
+        running = {}
+        last_heartbeat = 0
+        try:
+            while stop_event is None or not stop_event.is_set():
+                expire_stale_jobs()
+                while len(running) < processes:
+                    job = claim_next_job(worker_name)
+                    if job is None:
+                        break
+                    print(f"{worker_name}: running job {job.id} "
+                          f"({job.lock_name})",
+                          file=sys.stderr)
+                    running[executor.submit(run_job, job.id)] = job.id
+                if time.monotonic() - last_heartbeat >= \
+                        HEARTBEAT_INTERVAL.total_seconds():
+                    heartbeat_jobs(list(running.values()))
+                    last_heartbeat = time.monotonic()
+                if not running:
+                    time.sleep(poll_interval)
+                    continue
+                done, _ = wait(running,
+                               timeout=poll_interval,
+                               return_when=FIRST_COMPLETED)
+                is_broken = False
+                for future in done:
+                    job_id = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        print(f"{worker_name}: job {job_id} {future.result()}",
+                              file=sys.stderr)
+                        continue
+                    # the process running the job died, the job is failed
+                    # but the worker carries on with the other jobs.
+                    print(f"{worker_name}: job {job_id} died: {error!r}",
+                          file=sys.stderr)
+                    finish_job(job_id, JOB_FAILED, error=repr(error))
+                    is_broken |= isinstance(error, BrokenProcessPool)
+                if is_broken:
+                    # a broken pool fails all of its jobs and can't be used
+                    # again, so it's replaced by a new one.
+                    for job_id in running.values():
+                        finish_job(job_id,
+                                   JOB_FAILED,
+                                   error="The pool running the job broke.")
+                    running.clear()
+                    executor.shutdown(wait=False)
+                    executor = make_executor(processes)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+def main(argv=None):
+    """Entry point to the job worker."""
+    argv = argv or sys.argv[1:]
+    parser = argparse.ArgumentParser("""Run the queued background jobs.""")
+    parser.add_argument("--processes",
+                        type=int,
+                        default=2,
+                        help="""The most jobs to run at once.""")
+    parser.add_argument("--poll-interval",
+                        type=float,
+                        default=1.0,
+                        help="""Seconds to wait between checking for jobs.""")
+    parser.add_argument("--name",
+                        type=str,
+                        default=f"{socket.gethostname()}:{os.getpid()}")
+    result = parser.parse_args(argv)
+    try:
+        run_worker(result.name,
+                   processes=result.processes,
+                   poll_interval=result.poll_interval)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,9 @@
 # See /LICENCE.md for Copyright information
 """Database models for the animeu site."""
 from flask_login import UserMixin
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import select, operators
+from sqlalchemy.ext.hybrid import hybrid_property, Comparator
 
 from animeu.app import db, login_manager
 
@@ -26,25 +29,123 @@ def load_user(user_id):
     """Load a user object from the database given their ID."""
     return User.query.get(user_id)
 
+class Character(db.Model):
+    """Table which gives every character a stable integer id."""
+
+    __tablename__ = "characters"
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String, index=True, unique=True, nullable=False)
+
+def get_or_add_character(name):
+    """Get the character with a name, adding it if it's not been seen.
+
+    The character is added in a savepoint, so that if another request adds
+    it first only the savepoint is rolled back and theirs is used instead.
+    """
+    character = Character.query.filter_by(name=name).first()
+    if character is None:
+        try:
+            with db.session.begin_nested():
+                character = Character(name=name)
+                db.session.add(character)
+        except IntegrityError:
+            character = Character.query.filter_by(name=name).one()
+    return character
+
+class CharacterNameComparator(Comparator):
+    """Compares the name of the character in an id column.
+
+    Names are compared by looking up the ids of the named characters, so
+    that ```Model.character_name == name``` (or ```!=```, ```in_``` and
+    ```notin_```) is served by the id column's index rather than reading
+    the name of every row's character. Any other comparison falls back to a
+    subquery of the name of each row's character.
+    """
+
+    def __init__(self, id_column, label):
+        """Initialize a CharacterNameComparator of an id column."""
+        self.id_column = id_column
+        super().__init__(select([Character.name])
+                         .where(Character.id == id_column)
+                         .correlate_except(Character)
+                         .as_scalar()
+                         .label(label))
+
+    def operate(self, op, *other, **kwargs):
+        """Compare the character's name to some other value."""
+        if op is operators.eq:
+            return self.id_column == select([Character.id])\
+                .where(Character.name == other[0])\
+                .as_scalar()
+        if op is operators.in_op:
+            return self.id_column.in_(select([Character.id])
+                                      .where(Character.name.in_(other[0])))
+        # a name which isn't a character's doesn't exclude any rows.
+        if op is operators.ne:
+            return self.id_column.notin_(select([Character.id])
+                                         .where(Character.name == other[0]))
+        if op is operators.notin_op:
+            return self.id_column.notin_(select([Character.id])
+                                         .where(Character.name.in_(other[0])))
+        return op(self.expression, *other, **kwargs)
+
+    def reverse_operate(self, op, other, **kwargs):
+        """Compare some other value to the character's name."""
+        return op(other, self.expression, **kwargs)
+
+def character_name_property(id_column_name, relationship_name):
+    """Make a property of the name of the character in an id column."""
+    def get_name(self):
+        return getattr(self, relationship_name).name
+    def set_name(self, name):
+        setattr(self, relationship_name, get_or_add_character(name))
+    return hybrid_property(get_name, set_name).comparator(
+        lambda cls: CharacterNameComparator(getattr(cls, id_column_name),
+                                            f"{relationship_name}_name")
+    )
+
 class WaifuPickBattle(db.Model):
     """Table which represents a where one girl is chosen as a waifu."""
 
     __tablename__ = "waifu_battles"
+    __table_args__ = (
+        # a user's battles are listed most recent first on their profile.
+        db.Index("ix_waifu_battles_user_id_date", "user_id", "date"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    date = db.Column(db.DateTime, nullable=False)
-    winner_name = db.Column(db.String, index=True, nullable=False)
-    loser_name = db.Column(db.String, index=True, nullable=False)
+    date = db.Column(db.DateTime, index=True, nullable=False)
+    winner_id = db.Column(db.Integer, db.ForeignKey("characters.id"),
+                          index=True, nullable=False)
+    loser_id = db.Column(db.Integer, db.ForeignKey("characters.id"),
+                         index=True, nullable=False)
+    # the characters are only loaded when a name is read, the queries which
+    # read the names of every row join them with joinedload.
+    winner = db.relationship(Character, foreign_keys=[winner_id])
+    loser = db.relationship(Character, foreign_keys=[loser_id])
+    winner_name = character_name_property("winner_id", "winner")
+    loser_name = character_name_property("loser_id", "loser")
 
 class FavouritedWaifu(db.Model):
     """Table whose rows are an ordered collection of waifus."""
 
     __tablename__ = "favourited_waifu"
+    __table_args__ = (
+        # the favourites are looked up by user and character, or listed in
+        # the user's order.
+        db.Index("ix_favourited_waifu_user_id_character_id",
+                 "user_id",
+                 "character_id"),
+        db.Index("ix_favourited_waifu_user_id_order", "user_id", "order"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"),
                         index=True, nullable=False)
     date = db.Column(db.DateTime, nullable=False)
-    character_name = db.Column(db.String, index=True, nullable=False)
+    character_id = db.Column(db.Integer, db.ForeignKey("characters.id"),
+                             index=True, nullable=False)
+    character = db.relationship(Character)
+    character_name = character_name_property("character_id", "character")
     order = db.Column(db.Integer, index=True, nullable=False)
 
 class ELORankingCalculation(db.Model):
@@ -59,9 +160,32 @@ class ELORankingCalculation(db.Model):
     algorithim_hash = db.Column(db.String, nullable=False)
 
 class Lock(db.Model):
-    """Table which represents some lock on a resource."""
+    """Table which represents a leased lock on some resource."""
 
     __tablename__ = "locks"
     name = db.Column(db.String, primary_key=True)
     date = db.Column(db.DateTime, nullable=False)
     progress = db.Column(db.Integer, nullable=False)
+    owner = db.Column(db.String)
+    lease_expiry = db.Column(db.DateTime)
+    fencing_token = db.Column(db.Integer, nullable=False, default=0,
+                              server_default="0")
+
+class Job(db.Model):
+    """Table which represents an action queued to be run by a worker."""
+
+    __tablename__ = "jobs"
+    id = db.Column(db.Integer, primary_key=True)
+    lock_name = db.Column(db.String, index=True, nullable=False)
+    lock_owner = db.Column(db.String)
+    fencing_token = db.Column(db.Integer)
+    arguments = db.Column(db.String, nullable=False)
+    status = db.Column(db.String, index=True, nullable=False)
+    progress = db.Column(db.Integer, nullable=False)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    worker = db.Column(db.String)
+    error = db.Column(db.String)
+    created = db.Column(db.DateTime, nullable=False)
+    started = db.Column(db.DateTime)
+    heartbeat = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
@@ -26,7 +26,7 @@ def get_next_favourited_waifu_order_for_user(user_id):
         .where(FavouritedWaifu.user_id == user_id)\
         .order_by(FavouritedWaifu.order)\
         .limit(1)
-    maybe_current_order = db.engine.scalar(query)
+    maybe_current_order = db.session.scalar(query)
     if maybe_current_order is None:
         return 1
     return maybe_current_order + 1
@@ -4,6 +4,7 @@
 #
 # See /LICENCE.md for Copyright information
 """Query functions used to populate the profile."""
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import select, and_
 from animeu.app import db
 from animeu.models import FavouritedWaifu, WaifuPickBattle
@@ -20,7 +21,7 @@ def query_has_favourited_waifus(user_id, character_names):
                 FavouritedWaifu.user_id == user_id
             ))
     matched_names = \
-        set(r[0] for r in db.engine.execute(matched_names_query).fetchall())
+        set(r[0] for r in db.session.execute(matched_names_query).fetchall())
     return {n: n in matched_names for n in character_names}
 
 def get_favourite_waifu_list(user_id, limit=10):
@@ -28,6 +29,7 @@ def get_favourite_waifu_list(user_id, limit=10):
     if limit is None:
         raise TypeError("limit cannot be None")
     return FavouritedWaifu.query\
+        .options(joinedload(FavouritedWaifu.character))\
         .filter_by(user_id=user_id)\
         .order_by(FavouritedWaifu.id.desc())\
         .limit(limit)\
@@ -37,9 +39,11 @@ def get_recent_waifu_battles(user_id, limit=10):
     """Query the recent battles the user has participated in."""
     battles = \
         select([
-            WaifuPickBattle
+            WaifuPickBattle.date,
+            WaifuPickBattle.winner_name,
+            WaifuPickBattle.loser_name
         ])\
         .where(WaifuPickBattle.user_id == user_id)\
         .order_by(WaifuPickBattle.date.desc())\
         .limit(limit)
-    return db.engine.execute(battles).fetchall()
+    return db.session.execute(battles).fetchall()
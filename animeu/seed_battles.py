@@ -17,6 +17,7 @@ from animeu.data_loader import load_character_data
 from animeu.app import db
 from animeu.models import User, WaifuPickBattle
 from animeu.auth.logic import hash_password
+from animeu.sync_characters import sync_characters
 
 def get_seeding_user():
     """Add the seeding user to the database."""
@@ -92,6 +93,7 @@ def seed_battles(iterations, progress_callback=None, callback_rate=1000):
     """Seed the database with N iterations of battles."""
     user = get_seeding_user()
     characters = load_character_data()
+    name_to_id = sync_characters()
     ranking_functions = get_ranking_functions(characters)
 
     # pylint: disable=unused-variable
@@ -114,8 +116,8 @@ def seed_battles(iterations, progress_callback=None, callback_rate=1000):
         db.session.add(WaifuPickBattle(
             user_id=user.id,
             date=datetime.now(),
-            winner_name=winner["names"]["en"][0],
-            loser_name=loser["names"]["en"][0]
+            winner_id=name_to_id[winner["names"]["en"][0]],
+            loser_id=name_to_id[loser["names"]["en"][0]]
         ))
         if progress_callback:
             if iteration % callback_rate == 0 or iteration == iterations - 1:
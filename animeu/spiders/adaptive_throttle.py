@@ -0,0 +1,224 @@
+# /animeu/spiders/adaptive_throttle.py
+#
+# A downloader middleware which adapts the request rate to each site.
+#
+# See /LICENCE.md for Copyright information
+"""A downloader middleware which adapts the request rate to each site."""
+import time
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.settings.default_settings import RETRY_HTTP_CODES
+
+LOGGER = logging.getLogger(__name__)
+
+BACKOFF_HTTP_CODES = [429, 500, 502, 503, 504]
+
+def get_adaptive_throttle_settings(start_delay=1.0, max_concurrency=8):
+    """Get the scrapy settings which enable the adaptive throttle."""
+    return {
+        "DOWNLOADER_MIDDLEWARES": {
+            # the throttle has to see a response before the retry middleware
+            # turns it into a new request.
+            "animeu.spiders.adaptive_throttle.AdaptiveThrottleMiddleware": 560
+        },
+        "ADAPTIVE_THROTTLE_ENABLED": True,
+        "ADAPTIVE_THROTTLE_MAX_CONCURRENCY": max_concurrency,
+        "DOWNLOAD_DELAY": start_delay,
+        "CONCURRENT_REQUESTS_PER_DOMAIN": 1,
+        "RETRY_HTTP_CODES": sorted(set(RETRY_HTTP_CODES + [429])),
+        "RETRY_TIMES": 5
+    }
+
+def parse_retry_after(value, now=None):
+    """Parse a Retry-After header (in seconds or a http-date) into seconds."""
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode("latin-1")
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or datetime.now(timezone.utc)
+    return max(0.0, (retry_date - now).total_seconds())
+
+
+# pylint: disable=too-few-public-methods
+class SlotThrottle():
+    """The throughput counters of a single download slot."""
+
+    def __init__(self):
+        """Initialize a SlotThrottle."""
+        self.first_response_time = None
+        self.responses = 0
+        self.backoffs = 0
+        self.healthy_streak = 0
+        self.resume_delay = None
+        self.floor_delay = 0.0
+
+    def responses_per_second(self):
+        """Get the average rate of responses since the first one."""
+        if self.first_response_time is None:
+            return 0.0
+        elapsed = time.monotonic() - self.first_response_time
+        return self.responses / elapsed if elapsed > 0 else 0.0
+
+
+# pylint: disable=too-many-instance-attributes
+class AdaptiveThrottleMiddleware():
+    """Adapt the delay and concurrency of each download slot.
+
+    The concurrency of a slot is increased and its delay halved after every
+    ```ADAPTIVE_THROTTLE_INCREASE_EVERY``` consecutive responses which were
+    both successful and faster than the target latency. A 429, 5xx or failed
+    download halves the concurrency and doubles the delay (to at least
+    ```ADAPTIVE_THROTTLE_BACKOFF_DELAY```), after first pausing for the
+    response's Retry-After. The delay which led to backing off is then only
+    slowly approached again.
+    """
+
+    def __init__(self, crawler):
+        """Initialize an AdaptiveThrottleMiddleware from crawler's settings."""
+        settings = crawler.settings
+        if not settings.getbool("ADAPTIVE_THROTTLE_ENABLED"):
+            raise NotConfigured
+        self.crawler = crawler
+        self.min_delay = settings.getfloat("ADAPTIVE_THROTTLE_MIN_DELAY", 0.0)
+        self.max_delay = settings.getfloat("ADAPTIVE_THROTTLE_MAX_DELAY", 60.0)
+        self.target_latency = \
+            settings.getfloat("ADAPTIVE_THROTTLE_TARGET_LATENCY", 2.0)
+        self.max_concurrency = \
+            settings.getint("ADAPTIVE_THROTTLE_MAX_CONCURRENCY", 8)
+        self.increase_every = \
+            settings.getint("ADAPTIVE_THROTTLE_INCREASE_EVERY", 5)
+        self.backoff_delay = \
+            settings.getfloat("ADAPTIVE_THROTTLE_BACKOFF_DELAY", 0.25)
+        self.backoff_codes = set(
+            settings.getlist("ADAPTIVE_THROTTLE_BACKOFF_CODES",
+                             BACKOFF_HTTP_CODES)
+        )
+        self.slot_throttles = {}
+        crawler.signals.connect(self.spider_closed,
+                                signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Create an AdaptiveThrottleMiddleware for a crawler."""
+        return cls(crawler)
+
+    def _get_slot(self, request):
+        """Get the key and download slot a request was made from."""
+        key = request.meta.get("download_slot")
+        return key, self.crawler.engine.downloader.slots.get(key)
+
+    def _get_slot_throttle(self, key):
+        """Get the throughput counters of a download slot."""
+        if key not in self.slot_throttles:
+            self.slot_throttles[key] = SlotThrottle()
+        return self.slot_throttles[key]
+
+    def _record_slot(self, key, slot):
+        """Record the current delay and concurrency of a slot in the stats."""
+        stats = self.crawler.stats
+        stats.set_value(f"adaptive_throttle/{key}/delay", slot.delay)
+        stats.set_value(f"adaptive_throttle/{key}/concurrency",
+                        slot.concurrency)
+
+    def back_off(self, key, slot, retry_after=None):
+        """Slow down the requests made from a slot."""
+        slot_throttle = self._get_slot_throttle(key)
+        slot_throttle.backoffs += 1
+        slot_throttle.healthy_streak = 0
+        # the delay which was too short is remembered so that speeding up
+        # again only slowly approaches it.
+        slot_throttle.floor_delay = slot.delay * 1.25
+        delay = min(self.max_delay,
+                    max(slot.delay * 2, self.min_delay, self.backoff_delay))
+        slot.delay = delay
+        # the Retry-After is how long to pause for rather than a new delay,
+        # once a response has been received the doubled delay is used.
+        if retry_after is not None and retry_after > delay:
+            slot.delay = min(retry_after, self.max_delay)
+            slot_throttle.resume_delay = delay
+        slot.concurrency = max(1, slot.concurrency // 2)
+        self.crawler.stats.inc_value(f"adaptive_throttle/{key}/backoffs")
+        self._record_slot(key, slot)
+        LOGGER.debug("Backing off %s: delay=%.2fs concurrency=%d",
+                     key, slot.delay, slot.concurrency)
+
+    def speed_up(self, key, slot):
+        """Speed up the requests made from a slot."""
+        slot_throttle = self._get_slot_throttle(key)
+        # scrapy waits for the delay between every request of a slot, so the
+        # concurrency only makes a difference once the delay is (near) zero.
+        delay = slot.delay / 2
+        delay = max(self.min_delay,
+                    slot_throttle.floor_delay,
+                    delay if delay >= 0.01 else 0.0)
+        if delay >= slot.delay:
+            slot_throttle.floor_delay *= 0.9
+        slot.delay = delay
+        slot.concurrency = min(self.max_concurrency, slot.concurrency + 1)
+        self._record_slot(key, slot)
+
+    def process_response(self, request, response, spider):
+        """Adjust the slot of a request based on its response."""
+        # pylint: disable=unused-argument
+        key, slot = self._get_slot(request)
+        if slot is None:
+            return response
+        slot_throttle = self._get_slot_throttle(key)
+        if slot_throttle.first_response_time is None:
+            slot_throttle.first_response_time = time.monotonic()
+        slot_throttle.responses += 1
+        self.crawler.stats.inc_value(f"adaptive_throttle/{key}/responses")
+        if response.status in self.backoff_codes:
+            self.back_off(
+                key,
+                slot,
+                retry_after=parse_retry_after(
+                    response.headers.get("Retry-After")
+                )
+            )
+            return response
+        if slot_throttle.resume_delay is not None:
+            slot.delay = slot_throttle.resume_delay
+            slot_throttle.resume_delay = None
+        latency = request.meta.get("download_latency")
+        if latency is not None and latency > self.target_latency:
+            slot_throttle.healthy_streak = 0
+            return response
+        slot_throttle.healthy_streak += 1
+        if slot_throttle.healthy_streak >= self.increase_every:
+            slot_throttle.healthy_streak = 0
+            self.speed_up(key, slot)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        """Slow down the slot of a request which failed to download."""
+        # pylint: disable=unused-argument
+        key, slot = self._get_slot(request)
+        if slot is not None:
+            self.back_off(key, slot)
+
+    def spider_closed(self, spider):
+        """Record and log the throughput of every slot."""
+        # pylint: disable=unused-argument
+        for key, slot_throttle in self.slot_throttles.items():
+            responses_per_second = slot_throttle.responses_per_second()
+            self.crawler.stats.set_value(
+                f"adaptive_throttle/{key}/responses_per_second",
+                responses_per_second
+            )
+            LOGGER.info("%s: %d responses (%.2f/s), %d backoffs",
+                        key,
+                        slot_throttle.responses,
+                        responses_per_second,
+                        slot_throttle.backoffs)
@@ -6,7 +6,6 @@
 """Generate an anime database from an anime extract."""
 import sys
 import argparse
-import json
 import re
 from string import punctuation, ascii_lowercase
 from itertools import chain, product
@@ -20,7 +19,8 @@ from Levenshtein import jaro
 from tqdm import tqdm
 
 from animeu.common.func_helpers import compose
-from animeu.common.file_helpers import JSONListStream, open_transcoded
+from animeu.common.file_helpers import \
+    JSONListStream, JSONListReader, CompressibleFileType, closing_output
 
 SCHEMA_SQL = resource_string(__name__, "schema.sql").decode()
 MATCH_SQL = resource_string(__name__, "match.sql").decode()
@@ -132,9 +132,8 @@ def is_sensitive_metadata(metadata):
 
 def create_anime_db(database, anime_extract):
     """Create an anime database from an anime extract."""
-    with open_transcoded(anime_extract, "r", errors="ignore") as anime_fileobj:
-        anime_json = json.loads(anime_fileobj.read().decode("utf8"))
-    with Connection(database) as connection:
+    with JSONListReader(anime_extract) as anime_json, \
+            Connection(database) as connection:
         connection.createscalarfunction("lv_jaro",
                                         jaro,
                                         numargs=2,
@@ -182,29 +181,27 @@ def match_character_extracts(anime_database, character_extracts):
         cursor = connection.cursor()
         cursor.execute("delete from unmatched_character")
         for filename in tqdm(character_extracts):
-            # pylint: disable=line-too-long
-            with open_transcoded(filename, "r", errors="ignore") as character_fileobj:
-                character_json = json.loads(character_fileobj.read().decode("utf8"))
-            for character in tqdm(character_json):
-                reference_id = next_reference_id
-                reference_id_to_character[reference_id] = character
-                character_names = \
-                    list(chain.from_iterable(character["names"].values()))
-                anime_names = [a["name"] for a in character["anime_roles"]]
-                for character_name, anime_name in product(character_names,
-                                                          anime_names):
-                    cursor.execute("insert into unmatched_character ("
-                                   "character_name, normalized_character_name,"
-                                   "anime_name, normalized_anime_name, "
-                                   "reference_id) values (?, ?, ?, ?, ?)",
-                                   (
-                                       character_name,
-                                       normalize_character_name(character_name),
-                                       anime_name,
-                                       normalize_anime_name(anime_name),
-                                       reference_id
-                                   ))
-                next_reference_id += 1
+            with JSONListReader(filename) as character_json:
+                for character in tqdm(character_json):
+                    reference_id = next_reference_id
+                    reference_id_to_character[reference_id] = character
+                    character_names = \
+                        list(chain.from_iterable(character["names"].values()))
+                    anime_names = [a["name"] for a in character["anime_roles"]]
+                    for character_name, anime_name in product(character_names,
+                                                              anime_names):
+                        cursor.execute("insert into unmatched_character ("
+                                       "character_name, normalized_character_name,"
+                                       "anime_name, normalized_anime_name, "
+                                       "reference_id) values (?, ?, ?, ?, ?)",
+                                       (
+                                           character_name,
+                                           normalize_character_name(character_name),
+                                           anime_name,
+                                           normalize_anime_name(anime_name),
+                                           reference_id
+                                       ))
+                    next_reference_id += 1
     cursor.execute("REINDEX")
     for (reference_id_csv,) in cursor.execute(MATCH_SQL):
         reference_ids = list(map(int, reference_id_csv.split(",")))
@@ -236,11 +233,18 @@ def match_characters_cli(argv=None):
                         required=True)
     parser.add_argument("--output",
                         metavar="OUTPUT",
-                        type=argparse.FileType("w", encoding="utf8"),
+                        type=CompressibleFileType("w", encoding="utf8"),
                         default=sys.stdout)
+    parser.add_argument("--index",
+                        action="store_true",
+                        help="""Write a sidecar .idx file of the offsets of """
+                             """the entries in the output.""")
     result = parser.parse_args(argv)
     create_anime_db(result.database, result.anime_extract)
-    with JSONListStream(result.output) as json_stream:
+    with closing_output(result.output), \
+            JSONListStream(result.output,
+                           ndjson=None,
+                           index=result.index) as json_stream:
         for character in match_character_extracts(result.database,
                                                   result.character_extracts):
             json_stream.write(character)
@@ -15,6 +15,10 @@ from scrapy.linkextractors import LinkExtractor
 
 from animeu.common.file_helpers import JSONListStream
 from animeu.spiders.base64_helpers import base64_urlencode, base64_urldecode
+from animeu.spiders.page_store import open_page_store
+from animeu.spiders.adaptive_throttle import get_adaptive_throttle_settings
+from animeu.spiders.conditional_requests import \
+    get_validators, get_conditional_headers, with_saved_body
 
 try:
     import ijson.backends.yajl2_cffi as ijson
@@ -24,8 +28,14 @@ except ImportError:
 
 ANIME_PLANET_URL = "https://www.anime-planet.com"
 
-def make_anime_planet_spider_cls(previously_scraped_urls):
-    """Construct an AnimePlanetSpider class."""
+def make_anime_planet_spider_cls(previously_scraped_urls, validators=None):
+    """Construct an AnimePlanetSpider class.
+
+    The pages with an entry in validators are revisited with requests made
+    conditional on the entry's (etag, last_modified).
+    """
+    validators = validators or {}
+
     def _none_if_href_already_scraped(href):
         if href in previously_scraped_urls:
             return None
@@ -36,6 +46,8 @@ def make_anime_planet_spider_cls(previously_scraped_urls):
         """Scraper for anime-planet."""
 
         name = "animeplanet"
+        # a 304 is the response to revalidating an unchanged page.
+        handle_httpstatus_list = [304]
         start_urls = [f"{ANIME_PLANET_URL}/characters/all?gender_id=2&page=1"]
 
         rules = (
@@ -45,7 +57,8 @@ def make_anime_planet_spider_cls(previously_scraped_urls):
                     allow=r'/characters/(?!(tags|top-loved|top-hated)$)[^/?]+$',
                     process_value=_none_if_href_already_scraped
                 ),
-                callback="extract_character"
+                callback="extract_character",
+                process_request="add_revalidation_headers"
             ),
             Rule(
                 LinkExtractor(
@@ -58,25 +71,44 @@ def make_anime_planet_spider_cls(previously_scraped_urls):
         )
 
         # pylint: disable=line-too-long
-        def __init__(self, *args, manifest_file=None, pages_directory=None, **kwargs):
+        def __init__(self, *args, manifest_file=None, page_store=None, visited_urls=None, **kwargs):
             """Initialize a AnimePlanetSpider."""
             super().__init__(*args, **kwargs)
-            os.makedirs(pages_directory, exist_ok=True)
             self.manifest_file = manifest_file
-            self.pages_directory = pages_directory
+            self.page_store = page_store
+            self.visited_urls = visited_urls if visited_urls is not None else set()
+
+        def add_revalidation_headers(self, request, response):
+            """Make a request for an already downloaded page conditional."""
+            # pylint: disable=unused-argument
+            name = f"{base64_urlencode(request.url)}.html"
+            if request.url in validators and name in self.page_store:
+                request.headers.update(
+                    get_conditional_headers(*validators[request.url])
+                )
+            return request
 
         def extract_character(self, response):
-            """Save the character page to a file and write metadata entry."""
-            filename = os.path.join(self.pages_directory,
-                                    f"{base64_urlencode(response.url)}.html")
+            """Save the character page to the store and write metadata entry."""
+            name = f"{base64_urlencode(response.url)}.html"
+            if response.status == 200 and \
+                    (response.url in validators or name not in self.page_store):
+                self.page_store.put(name, response.body)
+            response = with_saved_body(response, self.page_store, name)
+            # a 304 need not repeat the validators of the page it revalidated.
+            previous_etag, previous_last_modified = \
+                validators.get(response.url, (None, None))
+            etag, last_modified = get_validators(response)
+            etag = etag or previous_etag
+            last_modified = last_modified or previous_last_modified
+            self.visited_urls.add(response.url)
             self.manifest_file.write({
                 "url": response.url,
                 "status": response.status,
-                "name": filename
+                "name": os.path.join(self.page_store.path, name),
+                "etag": etag,
+                "last_modified": last_modified
             })
-            if response.status == 200 and not os.path.exists(filename):
-                with open(filename, "wb") as html_fileobj:
-                    html_fileobj.write(response.body)
 
     return AnimePlanetSpider
 
@@ -88,6 +120,7 @@ def load_scraped_urls(manifest_filename):
         return set(item["url"] for item in ijson.items(fileobj, "item"))
 
 
+# pylint: disable=too-many-locals
 def main(argv=None):
     """Entry point to the anime planet link scraper."""
     argv = argv or sys.argv[1:]
@@ -100,7 +133,18 @@ def main(argv=None):
     parser.add_argument("--pages-directory",
                         metavar="PAGES",
                         type=str,
-                        required=True)
+                        required=True,
+                        help="""A directory or .pack file to save pages in.""")
+    parser.add_argument("--max-concurrency",
+                        type=int,
+                        default=8,
+                        help="""The most concurrent requests the throttle """
+                             """will make to the site.""")
+    parser.add_argument("--refresh",
+                        action="store_true",
+                        help="""Revisit the pages in the manifest, only """
+                             """downloading them again if they have changed """
+                             """since the validators recorded for them.""")
     result = parser.parse_args(argv)
 
     # maybe get the previous manifest entries (to write back out into the new
@@ -111,26 +155,49 @@ def main(argv=None):
     else:
         previous_manifest = []
 
-    with open(result.manifest or sys.stdout, "w", encoding="utf8") as manifest_fileobj, \
-             JSONListStream(manifest_fileobj) as json_stream:
+    # the new manifest only replaces the previous one once it's complete, so
+    # an interrupted crawl doesn't lose the previous entries.
+    temp_manifest = f"{result.manifest}.tmp" if result.manifest else None
+    with open(temp_manifest or sys.stdout, "w", encoding="utf8") as manifest_fileobj, \
+             JSONListStream(manifest_fileobj) as json_stream, \
+             open_page_store(result.pages_directory, writable=True) as page_store:
         previously_scraped_urls = set()
-        for item in previous_manifest:
-            json_stream.write(item)
-            previously_scraped_urls.add(item["url"])
-        for entry in os.scandir(result.pages_directory):
-            filename = os.path.basename(entry.path)
-            b64_url, ext = filename.split(".")
-            if ext != "html":
-                continue
-            previously_scraped_urls.add(base64_urldecode(b64_url))
+        validators = {}
+        if result.refresh:
+            # the entries are only written back out if they are not revisited.
+            validators = {item["url"]: (item.get("etag"),
+                                        item.get("last_modified"))
+                          for item in previous_manifest
+                          if item["status"] == 200}
+        else:
+            for item in previous_manifest:
+                json_stream.write(item)
+                previously_scraped_urls.add(item["url"])
+            for name in page_store:
+                b64_url, ext = name.split(".")
+                if ext != "html":
+                    continue
+                previously_scraped_urls.add(base64_urldecode(b64_url))
         spider_cls = \
-            make_anime_planet_spider_cls(previously_scraped_urls)
+            make_anime_planet_spider_cls(previously_scraped_urls, validators)
+        visited_urls = set()
         process = CrawlerProcess({
-            "COOKIES_ENABLED": False
+            "COOKIES_ENABLED": False,
+            **get_adaptive_throttle_settings(
+                start_delay=0.5,
+                max_concurrency=result.max_concurrency
+            )
         })
         process.crawl(spider_cls,
                       manifest_file=json_stream,
-                      pages_directory=result.pages_directory,
+                      page_store=page_store,
+                      visited_urls=visited_urls,
                       previously_scraped_urls=previously_scraped_urls)
         process.start()
         process.join()
+        if result.refresh:
+            for item in previous_manifest:
+                if item["url"] not in visited_urls:
+                    json_stream.write(item)
+    if temp_manifest:
+        os.replace(temp_manifest, result.manifest)
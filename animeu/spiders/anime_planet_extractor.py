@@ -4,19 +4,22 @@
 #
 # See /LICENCE.md for Copyright information
 """Metadata extractor for anime planet pages."""
-import os
 import sys
 import re
 import urllib.parse
-from functools import partial
+from contextlib import nullcontext
 
 import argparse
-import parmap
 import parsel
 
-from animeu.common.file_helpers import JSONListStream
+from animeu.common.file_helpers import \
+    JSONListStream, CompressibleFileType, closing_output, decode_bytes
+from animeu.spiders import xpath_helpers
 from animeu.spiders.anime_planet_downloader import ANIME_PLANET_URL
 from animeu.spiders.xpath_helpers import get_all_text
+from animeu.spiders.extraction_cache import \
+    ExtractionCache, get_extractor_version, map_extract_with_cache, hash_pages
+from animeu.spiders.page_store import get_page_store
 
 def strip_field_name(text):
     """Strip the field name section from a piece of text.
@@ -125,18 +128,20 @@ def optional(func, filename=None, default=None):
     return wrapped
 
 
-def extract_metadata_from_file(filename):
-    """Extract the metadata from a file."""
-    # pylint: disable=unspecified-encoding
-    with open(filename, "r", errors="ignore") as file_obj:
-        text = file_obj.read()
+def hash_page(name, pages_path):
+    """Hash the content of a character's page."""
+    return hash_pages(get_page_store(pages_path), [name])
+
+def extract_metadata_from_page(name, pages_path):
+    """Extract the metadata from a character's page."""
+    text = decode_bytes(get_page_store(pages_path).get(name), group=pages_path)
     sel = parsel.Selector(text=text)
     def list_optional(func, sel):
         return list(filter(bool,
-                           optional(func, filename=filename, default=[])(sel)))
+                           optional(func, filename=name, default=[])(sel)))
     return {
         "sources": ["anime-planet"],
-        "filenames": [os.path.basename(filename)],
+        "filenames": [name],
         "names": {
             "en": list_optional(extract_names, sel),
             "jp": []
@@ -169,23 +174,42 @@ def main(argv=None):
     parser.add_argument("--pages-directory",
                         metavar="PAGES",
                         type=str,
-                        required=False)
+                        required=False,
+                        help="""A directory or .pack file of pages.""")
     parser.add_argument("--output",
                         metavar="MANIFEST",
-                        type=argparse.FileType("w"),
+                        type=CompressibleFileType("w"),
                         default=sys.stdout)
+    parser.add_argument("--index",
+                        action="store_true",
+                        help="""Write a sidecar .idx file of the offsets of """
+                             """the entries in the output.""")
     parser.add_argument("--no-parallel",
                         action="store_true",
                         help="""Disable parallel processing.""")
+    parser.add_argument("--cache",
+                        metavar="CACHE",
+                        type=str,
+                        default=None,
+                        help="""A sqlite file to cache extracted metadata in """
+                             """so unchanged pages aren't re-extracted.""")
     result = parser.parse_args(argv)
-    basenames = os.listdir(result.pages_directory)
-    filenames = \
-        list(map(partial(os.path.join, result.pages_directory), basenames))
-    with JSONListStream(result.output) as extract_file:
-        for metadata in parmap.map(extract_metadata_from_file,
-                                   filenames,
-                                   pm_pbar=True,
-                                   pm_parallel=not result.no_parallel,
-                                   pm_chunksize=10):
+    names = list(get_page_store(result.pages_directory))
+    extractor_version = \
+        get_extractor_version(sys.modules[__name__], xpath_helpers)
+    maybe_cache = ExtractionCache(result.cache, extractor_version) \
+        if result.cache else nullcontext()
+    with closing_output(result.output), \
+            JSONListStream(result.output,
+                           ndjson=None,
+                           index=result.index) as extract_file, \
+            maybe_cache as cache:
+        for metadata in map_extract_with_cache(extract_metadata_from_page,
+                                               names,
+                                               result.pages_directory,
+                                               cache=cache,
+                                               hash_func=hash_page,
+                                               pm_pbar=True,
+                                               pm_parallel=not result.no_parallel,
+                                               pm_chunksize=10):
             extract_file.write(metadata)
-            result.output.flush()
@@ -0,0 +1,31 @@
+# /animeu/spiders/conditional_requests.py
+#
+# Helpers to revalidate previously downloaded pages.
+#
+# See /LICENCE.md for Copyright information
+"""Helpers to revalidate previously downloaded pages."""
+from http import HTTPStatus
+
+def get_validators(response):
+    """Get the ETag and Last-Modified validators of a response."""
+    def get_header(name):
+        value = response.headers.get(name)
+        return value.decode("latin-1") if value is not None else None
+    return get_header("ETag"), get_header("Last-Modified")
+
+def get_conditional_headers(etag, last_modified):
+    """Get the headers to make a request conditional on a page's validators."""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+def with_saved_body(response, page_store, name):
+    """Replace a 304 Not Modified response with the page it revalidated."""
+    if response.status != HTTPStatus.NOT_MODIFIED or name not in page_store:
+        return response
+    return response.replace(status=HTTPStatus.OK,
+                            body=page_store.get(name),
+                            flags=response.flags + ["revalidated"])
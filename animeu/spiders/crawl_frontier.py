@@ -0,0 +1,98 @@
+# /animeu/spiders/crawl_frontier.py
+#
+# A persistent record of the urls a downloader has visited.
+#
+# See /LICENCE.md for Copyright information
+"""A persistent record of the urls a downloader has visited."""
+import sqlite3
+import time
+from collections import namedtuple
+
+SCHEMA_SQL = """
+create table if not exists request (
+    url text not null primary key,
+    status integer not null,
+    filename text,
+    gallery_url text,
+    etag text,
+    last_modified text,
+    updated real not null
+);
+create index if not exists request_status on request (status);
+"""
+
+FrontierEntry = namedtuple("FrontierEntry",
+                           ["url", "status", "filename", "gallery_url",
+                            "etag", "last_modified"])
+
+class CrawlFrontier():
+    """A sqlite table of the visited urls, their statuses and gallery urls.
+
+    The frontier lets a restarted crawl decide which pages it can skip
+    without re-reading any of the pages it has already saved. Use the
+    filename ```:memory:``` for a frontier which only lasts a single crawl.
+    """
+
+    def __init__(self, filename, commit_every=100):
+        """Initialize a CrawlFrontier backed by the sqlite file filename."""
+        self._filename = filename
+        self._commit_every = commit_every
+        self._uncommitted = 0
+        self._connection = None
+
+    def __enter__(self):
+        """Context to start using this CrawlFrontier."""
+        # the spider callbacks run on scrapy's reactor thread.
+        self._connection = sqlite3.connect(self._filename,
+                                           check_same_thread=False)
+        self._connection.executescript(SCHEMA_SQL)
+        return self
+
+    def __exit__(self, exc, exc_type, traceback):
+        """Context to stop using this CrawlFrontier."""
+        self._connection.commit()
+        self._connection.close()
+        self._connection = None
+
+    def get(self, url):
+        """Get the entry for a url, or None if it has never been visited."""
+        row = self._connection.execute(
+            "select url, status, filename, gallery_url, etag, last_modified "
+            "from request where url = ?",
+            (url,)
+        ).fetchone()
+        return FrontierEntry(*row) if row is not None else None
+
+    def is_downloaded(self, url):
+        """Test if a url has been successfully downloaded."""
+        entry = self.get(url)
+        return entry is not None and entry.status == 200
+
+    # pylint: disable=too-many-arguments
+    def put(self,
+            url,
+            status,
+            *,
+            filename=None,
+            gallery_url=None,
+            etag=None,
+            last_modified=None):
+        """Record a visit to a url, keeping any previously known values."""
+        self._connection.execute(
+            "insert into request (url, status, filename, gallery_url, etag, "
+            "last_modified, updated) values (?, ?, ?, ?, ?, ?, ?) "
+            "on conflict (url) do update set "
+            "status = excluded.status, "
+            "filename = coalesce(excluded.filename, filename), "
+            "gallery_url = coalesce(excluded.gallery_url, gallery_url), "
+            "etag = coalesce(excluded.etag, etag), "
+            "last_modified = coalesce(excluded.last_modified, last_modified), "
+            "updated = excluded.updated",
+            (url, status, filename, gallery_url, etag, last_modified,
+             time.time())
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self._commit_every:
+            self._connection.commit()
+            self._uncommitted = 0
+        return self.get(url)
@@ -0,0 +1,154 @@
+# /animeu/spiders/extraction_cache.py
+#
+# A cache of the metadata previously extracted from downloaded pages.
+#
+# See /LICENCE.md for Copyright information
+"""A cache of the metadata previously extracted from downloaded pages."""
+import sqlite3
+import hashlib
+import json
+
+import parmap
+from tqdm import tqdm
+
+from animeu.common.iter_helpers import chunk
+
+SCHEMA_SQL = """
+create table if not exists extraction (
+    name text not null primary key,
+    content_hash text not null,
+    extractor_version text not null,
+    metadata text not null
+);
+"""
+
+def get_extractor_version(*modules):
+    """Get a version for an extractor by hashing the source of its modules."""
+    md5 = hashlib.md5()
+    for module in modules:
+        with open(module.__file__, "rb") as fileobj:
+            md5.update(fileobj.read())
+    return md5.hexdigest()
+
+def hash_pages(page_store, names):
+    """Hash the content of a group of pages, some of which may not exist."""
+    blake2b = hashlib.blake2b()
+    for name in names:
+        if name not in page_store:
+            blake2b.update(b"\0")
+            continue
+        content = page_store.get(name)
+        blake2b.update(len(content).to_bytes(8, "little"))
+        blake2b.update(content)
+    return blake2b.hexdigest()
+
+class ExtractionCache():
+    """A sqlite sidecar mapping a page's content to its extracted metadata.
+
+    Entries are keyed by the name of the page, the hash of its content
+    and the version of the extractor, if any of those change the page is
+    treated as if it had never been extracted.
+    """
+
+    def __init__(self, filename, extractor_version, commit_every=1000):
+        """Initialize an ExtractionCache backed by the sqlite file filename."""
+        self._filename = filename
+        self._extractor_version = extractor_version
+        self._commit_every = commit_every
+        self._uncommitted = 0
+        self._connection = None
+
+    def __enter__(self):
+        """Context to start using this ExtractionCache."""
+        self._connection = sqlite3.connect(self._filename)
+        self._connection.executescript(SCHEMA_SQL)
+        return self
+
+    def __exit__(self, exc, exc_type, traceback):
+        """Context to stop using this ExtractionCache."""
+        self._connection.commit()
+        self._connection.close()
+        self._connection = None
+
+    def get(self, name, content_hash, default=None):
+        """Get the cached metadata of a page if it is still valid."""
+        row = self._connection.execute(
+            "select metadata from extraction where name = ? and "
+            "content_hash = ? and extractor_version = ?",
+            (name, content_hash, self._extractor_version)
+        ).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def put(self, name, content_hash, metadata):
+        """Cache the metadata extracted from a page."""
+        self._connection.execute(
+            "insert or replace into extraction (name, content_hash, "
+            "extractor_version, metadata) values (?, ?, ?, ?)",
+            (name, content_hash, self._extractor_version,
+             json.dumps(metadata))
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self._commit_every:
+            self._connection.commit()
+            self._uncommitted = 0
+
+_CACHE_MISS = object()
+
+def map_extract_with_cache(extract_func,
+                           names,
+                           *args,
+                           cache=None,
+                           hash_func=None,
+                           chunk_size=1000,
+                           **parmap_kwargs):
+    """Map an extractor over some pages re-using any cached metadata.
+
+    Both `extract_func` and `hash_func` are invoked as ```f(name, *args)```
+    and the metadata is yielded in the same order as the names. Only the
+    pages whose hash has changed (or which have never been extracted) are
+    passed to the extractor, the results of which are then added to the cache.
+    The pages are extracted in chunks of ```chunk_size``` so only one chunk's
+    metadata is held in memory at a time.
+    """
+    pbar = tqdm(total=len(names)) if parmap_kwargs.pop("pm_pbar", False) \
+        else None
+    for names_chunk in chunk(names, chunk_size):
+        yield from _map_extract_chunk_with_cache(extract_func,
+                                                 names_chunk,
+                                                 *args,
+                                                 cache=cache,
+                                                 hash_func=hash_func,
+                                                 **parmap_kwargs)
+        if pbar is not None:
+            pbar.update(len(names_chunk))
+    if pbar is not None:
+        pbar.close()
+
+def _map_extract_chunk_with_cache(extract_func,
+                                  names,
+                                  *args,
+                                  cache,
+                                  hash_func,
+                                  **parmap_kwargs):
+    """Extract the metadata of a chunk of pages re-using any cached metadata."""
+    if cache is None:
+        return parmap.map(extract_func, names, *args, **parmap_kwargs)
+    content_hashes = parmap.map(hash_func, names, *args, **parmap_kwargs)
+    metadatas = [cache.get(name, content_hash, default=_CACHE_MISS)
+                 for name, content_hash in zip(names, content_hashes)]
+    changed_indexes = [i for i, m in enumerate(metadatas)
+                       if m is _CACHE_MISS]
+    if not changed_indexes:
+        return metadatas
+    changed_metadatas = parmap.map(extract_func,
+                                   [names[i] for i in changed_indexes],
+                                   *args,
+                                   **parmap_kwargs)
+    for index, metadata in zip(changed_indexes, changed_metadatas):
+        metadatas[index] = metadata
+        # failed extractions aren't cached so that they are retried.
+        if metadata is not None:
+            cache.put(names[index], content_hashes[index], metadata)
+    return metadatas
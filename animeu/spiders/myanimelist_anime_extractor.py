@@ -5,20 +5,24 @@
 # See /LICENCE.md for Copyright information
 """Extract the metadata of animes from anime myanimelist pages."""
 import sys
-import os
 import re
 import argparse
+from contextlib import nullcontext
 from fnmatch import filter as fnfilter
+from functools import partial
+from multiprocessing import Pool
 from typing import Iterable
 from collections import namedtuple
 
-from tqdm import tqdm
 from parsel import Selector
+from tqdm import tqdm
 
 from animeu.common.iter_helpers import lookahead
-from animeu.common.file_helpers import JSONListStream
+from animeu.common.file_helpers import \
+    JSONListStream, CompressibleFileType, closing_output
 from animeu.spiders.xpath_helpers import \
     xpath_slice_between, get_all_text, normalize_whitespace
+from animeu.spiders.page_store import get_page_store
 
 AnimeName = namedtuple("AnimeName", ["name", "is_primary"])
 AnimeCharacter = namedtuple("AnimeCharacter", ["name", "role", "url"])
@@ -119,25 +123,66 @@ def extract_anime_metadata(sel: Selector) -> dict:
         "picture": picture_url
     }
 
+def extract_anime_page(name: str, pages_path: str) -> dict:
+    """Extract all the metadata of the anime on a saved page."""
+    page = get_page_store(pages_path).get(name)
+    return extract_anime_metadata(Selector(text=page.decode("utf8")))
+
 def main(argv: list = None):
     """Entry point to the MAL anime metadata extractor."""
     argv = argv or sys.argv[1:]
     parser = argparse.ArgumentParser("""MAL Anime Extractor""")
-    parser.add_argument("--directory", type=str, required=True)
+    parser.add_argument("--directory",
+                        type=str,
+                        required=True,
+                        help="""A directory or .pack file of pages.""")
     parser.add_argument("--filter", type=str, default="*.anime.html")
     parser.add_argument("--output",
-                        type=argparse.FileType("w", encoding="utf8"),
+                        type=CompressibleFileType("w", encoding="utf8"),
                         default=sys.stdout)
+    parser.add_argument("--index",
+                        action="store_true",
+                        help="""Write a sidecar .idx file of the offsets of """
+                             """the entries in the output.""")
+    parser.add_argument("--no-parallel",
+                        action="store_true",
+                        help="""Disable parallel processing.""")
+    parser.add_argument("--unordered",
+                        action="store_true",
+                        help="""Write the animes in the order they are """
+                             """extracted rather than the order of the """
+                             """pages.""")
+    parser.add_argument("--chunksize",
+                        type=int,
+                        default=10,
+                        help="""The number of pages to send to a process """
+                             """at a time.""")
+    parser.add_argument("--processes",
+                        type=int,
+                        default=None,
+                        help="""The number of processes to extract with, """
+                             """defaults to the number of cores.""")
     result = parser.parse_args(argv)
-    anime_html_filenames = [
-        os.path.join(result.directory, name)
-        for name in fnfilter(os.listdir(result.directory), result.filter)
-    ]
-    with JSONListStream(result.output) as json_stream:
-        for anime_filename in tqdm(anime_html_filenames):
-            with open(anime_filename, "r", encoding="utf8") as anime_fileobj:
-                sel = Selector(text=anime_fileobj.read())
-            json_stream.write(extract_anime_metadata(sel))
+    anime_page_names = \
+        sorted(fnfilter(get_page_store(result.directory), result.filter))
+    extract_page = partial(extract_anime_page, pages_path=result.directory)
+    # pylint: disable=consider-using-with
+    maybe_pool = \
+        nullcontext() if result.no_parallel else Pool(result.processes)
+    with closing_output(result.output), \
+            JSONListStream(result.output,
+                           ndjson=None,
+                           index=result.index) as json_stream, \
+            maybe_pool as pool:
+        if pool is None:
+            metadatas = map(extract_page, anime_page_names)
+        else:
+            # the pool's imap yields each page's metadata as soon as it (and
+            # when ordered, every page before it) has been extracted.
+            imap = pool.imap_unordered if result.unordered else pool.imap
+            metadatas = imap(extract_page, anime_page_names, result.chunksize)
+        for metadata in tqdm(metadatas, total=len(anime_page_names)):
+            json_stream.write(metadata)
 
 if __name__ == "__main__":
     main()
@@ -4,11 +4,9 @@
 #
 # See /LICENCE.md for Copyright information
 """Scraper for myanimelist.net."""
-import os
 import sys
 import argparse
 import re
-import json
 from string import punctuation
 from functools import lru_cache
 
@@ -17,10 +15,14 @@ import scrapy
 from scrapy.spiders import CrawlSpider, Rule
 from scrapy.crawler import CrawlerProcess
 from scrapy.linkextractors import LinkExtractor
-from scrapy.settings.default_settings import RETRY_HTTP_CODES
 
-from animeu.common.file_helpers import JSONListStream
+from animeu.common.file_helpers import JSONListStream, JSONListReader
 from animeu.spiders.base64_helpers import base64_urlencode
+from animeu.spiders.page_store import open_page_store
+from animeu.spiders.crawl_frontier import CrawlFrontier
+from animeu.spiders.adaptive_throttle import get_adaptive_throttle_settings
+from animeu.spiders.conditional_requests import \
+    get_validators, get_conditional_headers, with_saved_body
 
 try:
     # pylint: disable=unused-import
@@ -33,64 +35,163 @@ except ImportError:
 MAL_URL = "https://myanimelist.net"
 
 
+SEARCH_TRANSLATION = str.maketrans("", "", punctuation)
+WHITESPACE_PATTERN = re.compile(r"\s")
+CHARACTER_HREF_PATTERN = re.compile(r"/character/\d+/(?P<name>[^/]+)$")
+
+
+@lru_cache(maxsize=2 ** 16)
 def normalize_text_for_search(text):
     """Normalize text for case/punctutation/whitespace insensitive search."""
-    text = text.translate(str.maketrans("", "", punctuation))
+    text = text.translate(SEARCH_TRANSLATION)
     text = text.lower()
-    text = re.sub(r"\s", "", text)
+    text = WHITESPACE_PATTERN.sub("", text)
     return text
 
-#pylint: disable=too-many-statements
-def make_mal_spider_cls(manifest_file, pages_directory, search_domain, already_downloaded):
-    """Make a MyAnimeListSpider class."""
-    os.makedirs(pages_directory, exist_ok=True)
-
-    def _none_if_character_href_not_in_search_domain(href):
-        match = re.search(r"/character/\d+/(?P<name>[^/]+)$", href)
-        if match:
-            search_name = normalize_text_for_search(match.group("name"))
-            character_url = f"{MAL_URL}{match.group()}"
-            character_filename = f"{base64_urlencode(character_url)}.html"
-            if search_name not in search_domain["name"]:
-                return None
-            if character_filename not in already_downloaded:
-                return href
-            gallery_url = \
-                get_gallery_url_from_character_file(character_filename)
-            gallery_filename = f"{base64_urlencode(character_url)}.pictures.html"
-            if gallery_url and gallery_filename not in already_downloaded:
-                return href
-            manifest_file.write({
-                "character_status": 200,
-                "character_url": character_url,
-                "character_filename": character_filename,
-                "pictures_url": gallery_url,
-                "pictures_filename": gallery_filename,
-            })
-            print(
-                f"Already downloaded character={href}, pictures={gallery_url}",
-                file=sys.stderr
-            )
-        return None
+def get_gallery_url(sel):
+    """Get the url of a character's gallery from their page."""
+    return sel.xpath("//a[text() = 'Pictures']/@href").get()
+
+# pylint: disable=too-many-instance-attributes
+class CharacterLinkFilter():
+    """Filter the links to characters down to those worth downloading.
+
+    A link is kept if the character's name is in the search domain and
+    either the character's page or their pictures page still needs to be
+    downloaded. The characters which are skipped because they have been
+    downloaded are collected (rather than written to the manifest) so that
+    filtering a link has no side effects.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 search_names,
+                 frontier,
+                 page_store,
+                 already_downloaded,
+                 *,
+                 base_url=MAL_URL,
+                 refresh=False):
+        """Initialize a CharacterLinkFilter."""
+        self.search_names = frozenset(search_names)
+        self.frontier = frontier
+        self.page_store = page_store
+        self.already_downloaded = already_downloaded
+        self.base_url = base_url
+        self.refresh = refresh
+        self._character_urls = {}
+        self._skipped_entries = {}
+
+    def get_character_url(self, href):
+        """Get the url of the searched for character an href links to."""
+        # the same links appear on many pages so the parsing is cached.
+        if href not in self._character_urls:
+            match = CHARACTER_HREF_PATTERN.search(href)
+            character_url = None
+            if match and normalize_text_for_search(match.group("name")) \
+                    in self.search_names:
+                character_url = f"{self.base_url}{match.group()}"
+            self._character_urls[href] = character_url
+        return self._character_urls[href]
 
-    @lru_cache(maxsize=None)
-    def get_gallery_url_from_character_file(filename):
-        """Extract the gallery url from a character file."""
-        with open(os.path.join(pages_directory, filename), "r", encoding="utf-8") as file_obj:
-            sel = parsel.Selector(text=file_obj.read())
-        anchor = sel.xpath("//a[text() = 'Pictures']")
-        if anchor is None:
+    def get_downloaded_character(self, character_url, character_filename):
+        """Get the frontier entry of a character which has been downloaded."""
+        entry = self.frontier.get(character_url)
+        if entry is not None and entry.status == 200:
+            return entry
+        if character_filename not in self.already_downloaded:
             return None
-        return anchor.attrib["href"]
+        # the page was saved before the frontier was being used so it has to
+        # be read once to find the gallery url.
+        sel = parsel.Selector(
+            text=self.page_store.get(character_filename).decode("utf-8")
+        )
+        return self.frontier.put(character_url,
+                                 200,
+                                 filename=character_filename,
+                                 gallery_url=get_gallery_url(sel))
+
+    def is_pictures_downloaded(self, pictures_url, pictures_filename):
+        """Test if a character's pictures page has been downloaded."""
+        return pictures_filename in self.already_downloaded or \
+            self.frontier.is_downloaded(pictures_url)
+
+    def __call__(self, href):
+        """Get the href if it should be followed, otherwise None."""
+        character_url = self.get_character_url(href)
+        if character_url is None or character_url in self._skipped_entries:
+            return None
+        if self.refresh:
+            return href
+        b64_character_url = base64_urlencode(character_url)
+        character_filename = f"{b64_character_url}.html"
+        entry = self.get_downloaded_character(character_url, character_filename)
+        if entry is None:
+            return href
+        gallery_url = entry.gallery_url
+        gallery_filename = f"{b64_character_url}.pictures.html"
+        if gallery_url and \
+                not self.is_pictures_downloaded(gallery_url, gallery_filename):
+            return href
+        self._skipped_entries[character_url] = {
+            "character_status": 200,
+            "character_url": character_url,
+            "character_filename": character_filename,
+            "character_etag": entry.etag,
+            "character_last_modified": entry.last_modified,
+            "pictures_url": gallery_url,
+            "pictures_filename": gallery_filename,
+        }
+        print(f"Already downloaded character={href}, pictures={gallery_url}",
+              file=sys.stderr)
+        return None
+
+    def pop_already_downloaded(self):
+        """Get the entries of the skipped characters not yet in the manifest."""
+        entries = [e for e in self._skipped_entries.values() if e is not None]
+        self._skipped_entries = dict.fromkeys(self._skipped_entries)
+        return entries
+
+# pylint: disable=too-many-arguments
+def make_mal_spider_cls(manifest_file,
+                        page_store,
+                        search_domain,
+                        already_downloaded,
+                        *,
+                        frontier,
+                        base_url=MAL_URL,
+                        refresh=False):
+    """Make a MyAnimeListSpider class.
+
+    A refreshing spider revisits the pages it has already downloaded, making
+    the requests conditional on the validators recorded in the frontier.
+    """
+
+    def get_revalidation_headers(url):
+        """Get the headers to revalidate a page rather than download it."""
+        entry = frontier.get(url) if refresh else None
+        if entry is None or entry.status != 200 or \
+                entry.filename not in page_store:
+            return {}
+        return get_conditional_headers(entry.etag, entry.last_modified)
+
+    link_filter = CharacterLinkFilter(search_domain["name"],
+                                      frontier,
+                                      page_store,
+                                      already_downloaded,
+                                      base_url=base_url,
+                                      refresh=refresh)
 
     # pylint: disable=abstract-method
     class MyAnimeListSpider(CrawlSpider):
         """Scraper for myanimelist."""
 
         name = "myanimelist"
+        # a 304 is the response to revalidating an unchanged page.
+        handle_httpstatus_list = [304]
         start_urls = [
             # pylint: disable=line-too-long
-            f"{MAL_URL}/anime.php?q=&type=1&score=0&status=0&p=0&r=0&sm=1&sd=1&sy=1980&em=0&ed=0&ey=0&c[0]=a&c[1]=b&c[2]=c&c[3]=f&gx=0&o=3&w=1&show=0",
+            f"{base_url}/anime.php?q=&type=1&score=0&status=0&p=0&r=0&sm=1&sd=1&sy=1980&em=0&ed=0&ey=0&c[0]=a&c[1]=b&c[2]=c&c[3]=f&gx=0&o=3&w=1&show=0",
         ]
 
         rules = (
@@ -101,124 +202,159 @@ def make_mal_spider_cls(manifest_file, pages_directory, search_domain, already_d
             ),
             # visit animes in table
             Rule(LinkExtractor(allow=r"/anime/\d+/[^/?]+$"),
-                 callback="extract_anime"),
+                 callback="extract_anime",
+                 process_request="add_revalidation_headers"),
             # go to characters tab
             Rule(LinkExtractor(allow=r"/characters$")),
             # go to each character page
             Rule(
                 LinkExtractor(allow=r"/character/\d+/[^/]+$",
-                              process_value=_none_if_character_href_not_in_search_domain),
-                callback="extract_character"
+                              process_value=link_filter),
+                callback="extract_character",
+                process_request="add_revalidation_headers"
             )
         )
 
-        @staticmethod
-        def extract_pictures(response):
-            """Save the pictures page and update manifest entry."""
+        def closed(self, reason):
+            """Write the entries of the characters which were skipped."""
+            # pylint: disable=unused-argument
+            for entry in link_filter.pop_already_downloaded():
+                manifest_file.write(entry)
+
+        def add_revalidation_headers(self, request, response):
+            """Make a request for an already downloaded page conditional."""
+            # pylint: disable=unused-argument
+            request.headers.update(get_revalidation_headers(request.url))
+            return request
+
+        # the callbacks are methods of the spider so that the requests can
+        # be serialized to the JOBDIR of a resumable crawl.
+        def extract_pictures(self, response):
+            """Save the pictures page and write a manifest entry."""
             pictures_filename = response.meta["filename"]
-            if response.status == 200 and not os.path.exists(pictures_filename):
-                with open(os.path.join(pages_directory, pictures_filename), "wb") as html_fileobj:
-                    html_fileobj.write(response.body)
-            response.meta["metadata"].update({
+            if response.status == 200 and \
+                    (refresh or pictures_filename not in page_store):
+                page_store.put(pictures_filename, response.body)
+            response = with_saved_body(response, page_store, pictures_filename)
+            etag, last_modified = get_validators(response)
+            # a 304 need not repeat the validators of the page it revalidated,
+            # so the manifest gets those the frontier has kept.
+            entry = frontier.put(response.url,
+                                 response.status,
+                                 filename=pictures_filename,
+                                 etag=etag,
+                                 last_modified=last_modified)
+            manifest_file.write({
                 "pictures_status": response.status,
                 "pictures_url": response.url,
-                "pictures_filename": pictures_filename
+                "pictures_filename": pictures_filename,
+                "pictures_etag": entry.etag,
+                "pictures_last_modified": entry.last_modified
             })
 
-        @staticmethod
-        def extract_character(response):
+        def extract_character(self, response):
             """Save the character page and write a manifest entry."""
             character_filename = f"{base64_urlencode(response.url)}.html"
-            character_filepath = \
-                os.path.join(pages_directory, character_filename)
-            if response.status == 200:
-                if not os.path.exists(character_filepath):
-                    with open(character_filepath, "wb") as html_fileobj:
-                        html_fileobj.write(response.body)
-                pictures_url = \
-                    get_gallery_url_from_character_file(character_filename)
-                pictures_filename = \
-                    f"{base64_urlencode(response.url)}.pictures.html"
-                if pictures_filename in already_downloaded:
-                    print(f"Skipping already downloaded character "
-                          f"picutes: {pictures_url} -> {pictures_filename}",
-                          file=sys.stderr)
-                else:
-                    yield scrapy.Request(
-                        pictures_url,
-                        callback=MyAnimeListSpider.extract_pictures,
-                        meta={"filename": pictures_filename,
-                              "metadata": response.meta["metadata"]}
-                    )
-            response.meta["metadata"].update({
+            if response.status == 200 and \
+                    (refresh or character_filename not in page_store):
+                page_store.put(character_filename, response.body)
+            response = with_saved_body(response, page_store, character_filename)
+            pictures_url = \
+                get_gallery_url(response) if response.status == 200 else None
+            pictures_filename = \
+                f"{base64_urlencode(response.url)}.pictures.html"
+            etag, last_modified = get_validators(response)
+            entry = frontier.put(response.url,
+                                 response.status,
+                                 filename=character_filename,
+                                 gallery_url=pictures_url,
+                                 etag=etag,
+                                 last_modified=last_modified)
+            manifest_file.write({
                 "character_status": response.status,
                 "character_url": response.url,
-                "character_filename": character_filename
+                "character_filename": character_filename,
+                "character_etag": entry.etag,
+                "character_last_modified": entry.last_modified,
+                "pictures_url": pictures_url,
+                "pictures_filename": pictures_filename
             })
+            if response.status != 200:
+                return
+            if not refresh and \
+                    link_filter.is_pictures_downloaded(pictures_url,
+                                                       pictures_filename):
+                print(f"Skipping already downloaded character "
+                      f"picutes: {pictures_url} -> {pictures_filename}",
+                      file=sys.stderr)
+            elif pictures_url:
+                yield scrapy.Request(
+                    pictures_url,
+                    callback=self.extract_pictures,
+                    headers=get_revalidation_headers(pictures_url),
+                    meta={"filename": pictures_filename}
+                )
 
-        @staticmethod
-        def extract_characters(response):
+        def extract_characters(self, response):
             """Extract all the characters on the page."""
             character_anchors = response.xpath(
                 # pylint: disable=line-too-long
                 "//div[@id = 'content']//a[contains(@href, '/character/') and not(contains(@class, 'fw-n'))]"
             )
-            character_metadatas = []
             for anchor in character_anchors:
                 character_url = anchor.attrib["href"]
-                if _none_if_character_href_not_in_search_domain(character_url):
-                    character_metadata = {}
-                    character_metadatas.append(character_metadata)
+                if link_filter(character_url):
                     yield scrapy.Request(
                         character_url,
-                        callback=MyAnimeListSpider.extract_character,
-                        meta={"metadata": character_metadata}
+                        callback=self.extract_character,
+                        headers=get_revalidation_headers(character_url)
                     )
-            response.meta["metadata"].update({
-                "characters": character_metadatas
-            })
 
         def extract_anime(self, response):
-            """Save the anime page write a manifest entry."""
+            """Save the anime page and write a manifest entry."""
             anime_filename = f"{base64_urlencode(response.url)}.anime.html"
-            anime_filepath = os.path.join(pages_directory, anime_filename)
-            metadata = {
+            if response.status == 200 and \
+                    (refresh or anime_filename not in page_store):
+                page_store.put(anime_filename, response.body)
+            response = with_saved_body(response, page_store, anime_filename)
+            etag, last_modified = get_validators(response)
+            entry = frontier.put(response.url,
+                                 response.status,
+                                 filename=anime_filename,
+                                 etag=etag,
+                                 last_modified=last_modified)
+            manifest_file.write({
                 "anime_url": response.url,
-                "anime_filename": anime_filename
-            }
+                "anime_filename": anime_filename,
+                "anime_etag": entry.etag,
+                "anime_last_modified": entry.last_modified
+            })
             if response.status == 200:
-                if not os.path.exists(anime_filepath):
-                    with open(anime_filepath, "wb") as html_fileobj:
-                        html_fileobj.write(response.body)
                 characters_tab_url = response\
                     .xpath("//div[@id='horiznav_nav']//a[contains(., 'Characters')]")\
                     .attrib["href"]
-                yield scrapy.Request(
-                    characters_tab_url,
-                    callback=MyAnimeListSpider.extract_characters,
-                    meta={"metadata": metadata}
-                )
-            manifest_file.write(metadata)
+                yield scrapy.Request(characters_tab_url,
+                                     callback=self.extract_characters)
 
     return MyAnimeListSpider
 
 def load_search_domain(anime_planet_extract):
     """Load the search domain (characters & animes) from the AP extract."""
     def iter_items():
-        with open(anime_planet_extract, "r", encoding="utf8") as extract_fileobj:
-            extract = json.load(extract_fileobj)
-        for character in extract:
-            if not any(ar["role"] in ("Main", "Secondary")
-                       for ar in character["anime_roles"]):
-                continue
-            for anime in character["anime_roles"]:
-                yield ("anime", anime["name"])
-            for en_name in character["names"]["en"]:
-                yield ("name", en_name)
+        with JSONListReader(anime_planet_extract) as extract:
+            for character in extract:
+                if not any(ar["role"] in ("Main", "Secondary")
+                           for ar in character["anime_roles"]):
+                    continue
+                for anime in character["anime_roles"]:
+                    yield ("anime", anime["name"])
+                for en_name in character["names"]["en"]:
+                    yield ("name", en_name)
     domain = {"anime": set(), "name": set()}
     for item_type, item_value in iter_items():
         domain[item_type].add(normalize_text_for_search(item_value))
-    return domain
+    return {item_type: frozenset(values)
+            for item_type, values in domain.items()}
 
 def main(argv=None):
     """Entry point to the myanimelist link scraper."""
@@ -236,20 +372,63 @@ def main(argv=None):
     parser.add_argument("--pages-directory",
                         metavar="PAGES",
                         type=str,
-                        required=True)
+                        required=True,
+                        help="""A directory or .pack file to save pages in.""")
+    parser.add_argument("--frontier",
+                        metavar="FRONTIER",
+                        type=str,
+                        default=":memory:",
+                        help="""A sqlite file recording the visited urls so """
+                             """a restarted crawl can skip them.""")
+    parser.add_argument("--refresh",
+                        action="store_true",
+                        help="""Revisit the pages which have already been """
+                             """downloaded, only downloading them again if """
+                             """they have changed since the visit recorded """
+                             """in the --frontier file. The validators are """
+                             """also written to the manifest, but only """
+                             """those in the frontier are revalidated.""")
+    parser.add_argument("--job-directory",
+                        metavar="JOBDIR",
+                        type=str,
+                        default=None,
+                        help="""A directory to persist scrapy's scheduler """
+                             """state in so the crawl can be resumed.""")
+    parser.add_argument("--base-url",
+                        type=str,
+                        default=MAL_URL,
+                        help="""The url of the site to crawl, for example """
+                             """that of a local fixture server.""")
+    parser.add_argument("--max-concurrency",
+                        type=int,
+                        default=8,
+                        help="""The most concurrent requests the throttle """
+                             """will make to the site.""")
     result = parser.parse_args(argv)
+    if result.refresh and result.frontier == ":memory:":
+        parser.error("""--refresh needs a --frontier file, the validators """
+                     """to revisit the pages with are recorded in it.""")
     search_domain = load_search_domain(result.anime_planet_extract)
-    already_downloaded = os.listdir(result.pages_directory)
-    with JSONListStream(result.manifest) as manifest_file:
+    with JSONListStream(result.manifest) as manifest_file, \
+            open_page_store(result.pages_directory, writable=True) as page_store, \
+            CrawlFrontier(result.frontier) as frontier:
         spider_cls = make_mal_spider_cls(manifest_file,
-                                         result.pages_directory,
+                                         page_store,
                                          search_domain,
-                                         already_downloaded)
-        process = CrawlerProcess({
+                                         already_downloaded=page_store,
+                                         frontier=frontier,
+                                         base_url=result.base_url.rstrip("/"),
+                                         refresh=result.refresh)
+        settings = {
             "COOKIES_ENABLED": False,
-            "DOWNLOAD_DELAY": 1,
-            "RETRY_HTTP_CODES": RETRY_HTTP_CODES + [429]
-        })
+            **get_adaptive_throttle_settings(
+                start_delay=1.0,
+                max_concurrency=result.max_concurrency
+            )
+        }
+        if result.job_directory:
+            settings["JOBDIR"] = result.job_directory
+        process = CrawlerProcess(settings)
         process.crawl(spider_cls)
         process.start()
         process.join()
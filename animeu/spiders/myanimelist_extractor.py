@@ -19,20 +19,42 @@
 import os
 import sys
 import re
-from functools import partial
-from operator import methodcaller
 from collections import defaultdict
+from contextlib import nullcontext
 
 import argparse
-import parsel
-import parmap
+from lxml import etree
 
-from animeu.common.func_helpers import compose
-from animeu.common.file_helpers import JSONListStream, open_transcoded
-from animeu.spiders.xpath_helpers import get_all_text
+from animeu.common.file_helpers import \
+    JSONListStream, CompressibleFileType, closing_output
+from animeu.spiders import xpath_helpers
+from animeu.spiders.xpath_helpers import \
+    get_all_element_text, parse_html_document
+from animeu.spiders.extraction_cache import \
+    ExtractionCache, get_extractor_version, map_extract_with_cache, hash_pages
+from animeu.spiders.page_store import get_page_store
 
 MALE_PATTERNS = [r"\bhe\b", r"\bhis\b"]
 
+# All of the xpath expressions are compiled once per process, the ones which
+# need to search the entire document are evaluated a single time per page and
+# the rest are evaluated relative to the elements they find.
+# pylint: disable=line-too-long
+NAME_XPATH = etree.XPath("//div[contains(@class, 'breadcrumb')]/following-sibling::div[1]")
+NAME_TEXT_XPATH = etree.XPath("descendant-or-self::text()")
+NAME_SPAN_XPATH = etree.XPath("span")
+INFO_TEXT_XPATH = etree.XPath("following-sibling::text() | following-sibling::b/text()")
+DISPLAY_PICTURE_XPATH = etree.XPath("//a[contains(@href, 'pictures')]/img")
+ROLE_HEADING_XPATH = etree.XPath("//div[text() = 'Animeography' or text() = 'Mangaography']")
+ROLE_HEADING_TEXT_XPATH = etree.XPath("text()")
+ROLE_TABLE_XPATH = etree.XPath("following-sibling::table[1]")
+ROLE_ROW_XPATH = etree.XPath(".//tr")
+ROLE_CELL_XPATH = etree.XPath(".//td")
+ROLE_IMAGE_XPATH = etree.XPath(".//img")
+ROLE_TITLE_XPATH = etree.XPath("./a")
+ROLE_DESCRIPTION_XPATH = etree.XPath("./div")
+GALLERY_PICTURE_XPATH = etree.XPath("//div[@class = 'picSurround']//img/@src")
+
 def strip_field_name(text):
     """Strip the field name section from a piece of text.
 
@@ -42,25 +64,23 @@ def strip_field_name(text):
         return None
     return re.sub(r"[^:]+:\s*", "", text)
 
-def select_name(sel):
-    """Select the element containing the characters name."""
-    # pylint: disable=line-too-long
-    return sel.xpath("//div[contains(@class, 'breadcrumb')]/following-sibling::div[1]")
+def select_name(root):
+    """Select the elements containing the characters name."""
+    return NAME_XPATH(root)
 
-def extract_en_jp_name(sel):
+def extract_en_jp_name(name_els):
     """Extract the character's full name."""
-    name_sel = select_name(sel)
-    english_name = name_sel.css("::text").get().strip()
-    japanese_name = get_all_text(name_sel.xpath("span")).strip("()")
+    name_texts = [t for e in name_els for t in NAME_TEXT_XPATH(e)]
+    english_name = name_texts[0].strip()
+    japanese_name = get_all_element_text(
+        [s for e in name_els for s in NAME_SPAN_XPATH(e)]
+    ).strip("()")
     return {"en": [english_name], "jp": [japanese_name]}
 
-def extract_info_fields_and_description(sel):
+def extract_info_fields_and_description(name_els):
     """Extract the name-value info fields of the character."""
-    name_sel = select_name(sel)
-    # pylint: disable=line-too-long
-    text_fragments = list(map(compose(methodcaller("strip"), methodcaller("get")),
-                              name_sel.xpath("following-sibling::text() | "
-                                             "following-sibling::b/text()")))
+    text_fragments = [str(t).strip()
+                      for e in name_els for t in INFO_TEXT_XPATH(e)]
     text_fragments = list(filter(bool, text_fragments))
     info_key_to_fragments = defaultdict(list)
     current_key = None
@@ -92,37 +112,30 @@ def extract_info_fields_and_description(sel):
         "\n".join(description_fragments).strip() or None
     )
 
-def extract_main_display_picture(sel):
+def extract_main_display_picture(root):
     """Extract the main display picture URL of the character."""
-    return sel.xpath("//a[contains(@href, 'pictures')]/img").attrib["src"]
+    return DISPLAY_PICTURE_XPATH(root)[0].attrib["src"]
 
-def extract_anime_roles(sel):
-    """Extract the animes the character appeared in."""
-    anime_table = \
-        sel.xpath("//div[text() = 'Animeography']/following-sibling::table[1]")
-    roles = []
-    for row in anime_table.xpath(".//tr"):
-        image_sel, text_sel = row.xpath(".//td")
-        picture = image_sel.xpath(".//img").attrib["src"]
-        title = get_all_text(text_sel.xpath("./a"))
-        role = get_all_text(text_sel.xpath("./div"))
-        if re.search(r"main", role, flags=re.IGNORECASE):
-            role = "main"
-        elif re.search(r"support(ing)?|secondary", role, flags=re.IGNORECASE):
-            role = "secondary"
-        roles.append({"name": title, "picture": picture, "role": role})
-    return roles
+def select_role_tables(root):
+    """Select the animeography and mangaography tables of the character."""
+    heading_to_tables = {"Animeography": [], "Mangaography": []}
+    for heading_el in ROLE_HEADING_XPATH(root):
+        for heading_text in set(ROLE_HEADING_TEXT_XPATH(heading_el)):
+            if heading_text not in heading_to_tables:
+                continue
+            tables = heading_to_tables[heading_text]
+            tables.extend(t for t in ROLE_TABLE_XPATH(heading_el)
+                          if t not in tables)
+    return heading_to_tables["Animeography"], heading_to_tables["Mangaography"]
 
-def extract_manga_roles(sel):
-    """Extract the mangas the character appeared in."""
-    anime_table = \
-        sel.xpath("//div[text() = 'Mangaography']/following-sibling::table[1]")
+def extract_roles(table_els):
+    """Extract the animes or mangas the character appeared in."""
     roles = []
-    for row in anime_table.xpath(".//tr"):
-        image_sel, text_sel = row.xpath(".//td")
-        picture = image_sel.xpath(".//img").attrib["src"]
-        title = get_all_text(text_sel.xpath("./a"))
-        role = get_all_text(text_sel.xpath("./div"))
+    for row in (r for t in table_els for r in ROLE_ROW_XPATH(t)):
+        image_el, text_el = ROLE_CELL_XPATH(row)
+        picture = ROLE_IMAGE_XPATH(image_el)[0].attrib["src"]
+        title = get_all_element_text(ROLE_TITLE_XPATH(text_el))
+        role = get_all_element_text(ROLE_DESCRIPTION_XPATH(text_el))
         if re.search(r"main", role, flags=re.IGNORECASE):
             role = "main"
         elif re.search(r"support(ing)?|secondary", role, flags=re.IGNORECASE):
@@ -130,14 +143,24 @@ def extract_manga_roles(sel):
         roles.append({"name": title, "picture": picture, "role": role})
     return roles
 
-def extract_gallery_pictures(sel):
+def extract_gallery_pictures(root):
     """Extract the pictures of the character from the gallery."""
-    return sel.xpath("//div[@class = 'picSurround']//img/@src").getall()
+    return list(map(str, GALLERY_PICTURE_XPATH(root)))
+
+def get_page_names(name):
+    """Get the names of the profile and pictures pages of a character."""
+    return [name, name.replace(".html", ".pictures.html")]
 
-def extract_metadata_from_file(filename):
-    """Extract the metadata from a file."""
+def hash_character_pages(name, pages_path):
+    """Hash the content of a character's profile and pictures pages."""
+    return hash_pages(get_page_store(pages_path), get_page_names(name))
+
+def extract_metadata_from_page(name, pages_path):
+    """Extract the metadata from a character's pages."""
+    filename = os.path.join(pages_path, name)
     # pylint: disable=broad-except
     try:
+        page_store = get_page_store(pages_path)
         metadata = {
             "sources": ["myanimelist"],
             "filenames": [filename],
@@ -154,27 +177,28 @@ def extract_metadata_from_file(filename):
                 "gallery": []
             }
         }
-        profile_filename = filename
-        pictures_filename = filename.replace(".html", ".pictures.html")
-        if os.path.exists(profile_filename):
-            with open_transcoded(filename, "r") as file_obj:
-                profile_sel = parsel.Selector(text=file_obj.read().decode("utf8"))
-            metadata["names"] = extract_en_jp_name(profile_sel)
+        profile_name, pictures_name = get_page_names(name)
+        if profile_name in page_store:
+            profile_root = parse_html_document(page_store.get(profile_name),
+                                               encoding_group=pages_path)
+            name_els = select_name(profile_root)
+            metadata["names"] = extract_en_jp_name(name_els)
             metadata["pictures"]["display"].append(
-                extract_main_display_picture(profile_sel)
+                extract_main_display_picture(profile_root)
             )
-            metadata["anime_roles"].extend(extract_anime_roles(profile_sel))
-            metadata["manga_roles"].extend(extract_manga_roles(profile_sel))
+            anime_tables, manga_tables = select_role_tables(profile_root)
+            metadata["anime_roles"].extend(extract_roles(anime_tables))
+            metadata["manga_roles"].extend(extract_roles(manga_tables))
             info_fields, maybe_description = \
-                extract_info_fields_and_description(profile_sel)
+                extract_info_fields_and_description(name_els)
             metadata["info_fields"].extend(info_fields)
             if maybe_description:
                 metadata["descriptions"].append(maybe_description)
-        if os.path.exists(pictures_filename):
-            with open_transcoded(pictures_filename, "r") as file_obj:
-                pictures_sel = parsel.Selector(text=file_obj.read().decode("utf8"))
+        if pictures_name in page_store:
+            pictures_root = parse_html_document(page_store.get(pictures_name),
+                                                encoding_group=pages_path)
             metadata["pictures"]["gallery"].extend(
-                extract_gallery_pictures(pictures_sel)
+                extract_gallery_pictures(pictures_root)
             )
         return metadata
     except Exception as ex:
@@ -197,26 +221,47 @@ def main(argv=None):
     parser.add_argument("--pages-directory",
                         metavar="PAGES",
                         type=str,
-                        required=False)
+                        required=False,
+                        help="""A directory or .pack file of pages.""")
     parser.add_argument("--output",
                         metavar="OUTPUT",
-                        type=argparse.FileType("w", encoding="utf8"),
+                        type=CompressibleFileType("w", encoding="utf8"),
                         default=sys.stdout)
+    parser.add_argument("--index",
+                        action="store_true",
+                        help="""Write a sidecar .idx file of the offsets of """
+                             """the entries in the output.""")
     parser.add_argument("--no-parallel",
                         action="store_true",
                         help="""Disable parallel processing.""")
+    parser.add_argument("--cache",
+                        metavar="CACHE",
+                        type=str,
+                        default=None,
+                        help="""A sqlite file to cache extracted metadata in """
+                             """so unchanged pages aren't re-extracted.""")
     result = parser.parse_args(argv)
-    basenames = \
-        set(f for f in os.listdir(result.pages_directory) if
-            not (f.endswith(".anime.html") or f.endswith(".pictures.html")))
-    filenames = \
-        list(map(partial(os.path.join, result.pages_directory), basenames))
-    with JSONListStream(result.output) as extract_file:
-        for metadata in parmap.map(extract_metadata_from_file,
-                                   filenames,
-                                   pm_pbar=True,
-                                   pm_parallel=not result.no_parallel,
-                                   pm_chunksize=10):
+    names = [n for n in get_page_store(result.pages_directory) if
+             not (n.endswith(".anime.html") or n.endswith(".pictures.html"))]
+    extractor_version = \
+        get_extractor_version(sys.modules[__name__], xpath_helpers)
+    maybe_cache = ExtractionCache(result.cache, extractor_version) \
+        if result.cache else nullcontext()
+    with closing_output(result.output), \
+            JSONListStream(result.output,
+                           ndjson=None,
+                           index=result.index) as extract_file, \
+            maybe_cache as cache:
+        for metadata in map_extract_with_cache(
+                extract_metadata_from_page,
+                names,
+                result.pages_directory,
+                cache=cache,
+                hash_func=hash_character_pages,
+                pm_pbar=True,
+                pm_parallel=not result.no_parallel,
+                pm_chunksize=10
+        ):
             if not metadata:
                 continue
             if test_is_male_character(metadata):
@@ -225,4 +270,3 @@ def main(argv=None):
                       file=sys.stderr)
                 continue
             extract_file.write(metadata)
-            result.output.flush()
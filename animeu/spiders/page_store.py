@@ -0,0 +1,164 @@
+# /animeu/spiders/page_store.py
+#
+# Stores for the pages saved by the downloaders.
+#
+# See /LICENCE.md for Copyright information
+"""Stores for the pages saved by the downloaders."""
+import os
+import gzip
+from functools import lru_cache
+
+PACK_EXTENSION = ".pack"
+INDEX_EXTENSION = ".idx"
+
+class DirectoryPageStore():
+    """A page store which saves each page to its own file in a directory."""
+
+    def __init__(self, directory, writable=False):
+        """Initialize a DirectoryPageStore for the pages in directory."""
+        if writable:
+            os.makedirs(directory, exist_ok=True)
+        self.path = directory
+        self._names = set(os.listdir(directory))
+
+    def __enter__(self):
+        """Context to start using this DirectoryPageStore."""
+        return self
+
+    def __exit__(self, exc, exc_type, traceback):
+        """Context to stop using this DirectoryPageStore."""
+        self.close()
+
+    def __contains__(self, name):
+        """Test if a page has been saved in this store."""
+        return name in self._names
+
+    def __iter__(self):
+        """Iterate over the names of the pages in this store."""
+        return iter(list(self._names))
+
+    def __len__(self):
+        """Get the number of pages in this store."""
+        return len(self._names)
+
+    def get(self, name):
+        """Get the content of a page."""
+        with open(os.path.join(self.path, name), "rb") as fileobj:
+            return fileobj.read()
+
+    def put(self, name, content):
+        """Save the content of a page."""
+        with open(os.path.join(self.path, name), "wb") as fileobj:
+            fileobj.write(content)
+        self._names.add(name)
+
+    def close(self):
+        """Close this store."""
+
+
+class PackPageStore():
+    """A page store which appends compressed pages to a single pack file.
+
+    Each page is written to the pack file as its own gzip member (so the
+    whole pack is still a valid gzip stream) and an entry of the form
+    ```<offset> <length> <name>``` (tab seperated) is appended to the sidecar
+    index file. When a page is saved more than once the last entry wins.
+    """
+
+    def __init__(self, filename, writable=False, compresslevel=6):
+        """Initialize a PackPageStore for the pack file filename."""
+        self.path = filename
+        self._index_filename = f"{filename}{INDEX_EXTENSION}"
+        self._compresslevel = compresslevel
+        self._name_to_extent = {}
+        self._read_fileobj = None
+        self._pack_fileobj = None
+        self._index_fileobj = None
+        # pylint: disable=consider-using-with
+        if writable:
+            self._pack_fileobj = open(filename, "ab")
+            self._index_fileobj = \
+                open(self._index_filename, "a", encoding="utf8")
+        self._read_index()
+
+    def _read_index(self):
+        """Read the offsets and lengths of the pages from the index file."""
+        if not os.path.exists(self._index_filename):
+            return
+        with open(self._index_filename, "r", encoding="utf8") as fileobj:
+            for line in fileobj:
+                # a partially written trailing entry means the writer was
+                # interrupted, the page it refers to is simply not stored.
+                if not line.endswith("\n"):
+                    break
+                offset, length, name = line.rstrip("\n").split("\t", 2)
+                self._name_to_extent[name] = (int(offset), int(length))
+
+    def __enter__(self):
+        """Context to start using this PackPageStore."""
+        return self
+
+    def __exit__(self, exc, exc_type, traceback):
+        """Context to stop using this PackPageStore."""
+        self.close()
+
+    def __contains__(self, name):
+        """Test if a page has been saved in this store."""
+        return name in self._name_to_extent
+
+    def __iter__(self):
+        """Iterate over the names of the pages in this store."""
+        return iter(list(self._name_to_extent))
+
+    def __len__(self):
+        """Get the number of pages in this store."""
+        return len(self._name_to_extent)
+
+    def get(self, name):
+        """Get the content of a page."""
+        offset, length = self._name_to_extent[name]
+        if self._read_fileobj is None:
+            # pylint: disable=consider-using-with
+            self._read_fileobj = open(self.path, "rb")
+        self._read_fileobj.seek(offset)
+        return gzip.decompress(self._read_fileobj.read(length))
+
+    def put(self, name, content):
+        """Append the content of a page to the pack."""
+        if self._pack_fileobj is None:
+            raise ValueError(f"The page store {self.path} is not writable.")
+        if "\n" in name or "\t" in name:
+            raise ValueError(f"Invalid page name: {name!r}")
+        compressed_content = gzip.compress(content, self._compresslevel)
+        self._pack_fileobj.seek(0, os.SEEK_END)
+        offset = self._pack_fileobj.tell()
+        self._pack_fileobj.write(compressed_content)
+        self._pack_fileobj.flush()
+        self._index_fileobj.write(
+            f"{offset}\t{len(compressed_content)}\t{name}\n"
+        )
+        self._index_fileobj.flush()
+        self._name_to_extent[name] = (offset, len(compressed_content))
+
+    def close(self):
+        """Close this store's files."""
+        for fileobj in (self._read_fileobj,
+                        self._pack_fileobj,
+                        self._index_fileobj):
+            if fileobj is not None:
+                fileobj.close()
+        self._read_fileobj = None
+        self._pack_fileobj = None
+        self._index_fileobj = None
+
+
+def open_page_store(path, writable=False):
+    """Open a page store, paths ending in .pack are opened as pack files."""
+    if path.endswith(PACK_EXTENSION):
+        return PackPageStore(path, writable=writable)
+    return DirectoryPageStore(path, writable=writable)
+
+@lru_cache(maxsize=None)
+def get_page_store(path):
+    """Get a read only page store which is opened once per process."""
+    return open_page_store(path)
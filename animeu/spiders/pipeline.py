@@ -0,0 +1,384 @@
+# /animeu/spiders/pipeline.py
+#
+# Run the downloaders, extractors and matcher as a single pipeline.
+#
+# See /LICENCE.md for Copyright information
+"""Run the downloaders, extractors and matcher as a single pipeline."""
+import os
+import sys
+import ast
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+HASH_BUFFER_SIZE = 1024 * 1024
+# inputs larger than this (e.g the packs of downloaded pages) are
+# fingerprinted by their size and modification time instead of being read.
+FINGERPRINT_SIZE = 64 * 1024
+STATE_FILENAME = "pipeline.state.json"
+PACKAGE = __name__.split(".", maxsplit=1)[0]
+PACKAGE_PARENT = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+
+# A stage is a command which reads its inputs and writes its outputs, it
+# depends on the stages which output any of its inputs. Stages which are
+# always run (the downloaders) are never skipped as their input is a website.
+# The code of a stage is the source files its command runs, so that a stage
+# is re-run when its code changes even if its inputs haven't.
+Stage = namedtuple("Stage",
+                   ["name", "command", "inputs", "outputs", "always_run",
+                    "code"],
+                   defaults=((),))
+
+def entry_point_command(entry_point, *args):
+    """Make the command to run a console script entry point in python."""
+    module, func = entry_point.split(":")
+    return [sys.executable, "-c", f"from {module} import {func}; {func}()",
+            *map(str, args)]
+
+def get_module_path(module_name):
+    """Get the path of the source of a module in this package, if it is one."""
+    path = os.path.join(PACKAGE_PARENT, *module_name.split("."))
+    return f"{path}.py" if os.path.isfile(f"{path}.py") else None
+
+def get_code_paths(module_name, paths=None):
+    """Get the paths of a module's source and the package modules it imports.
+
+    The imports are found by parsing the source rather than importing it,
+    so that hashing a stage doesn't import every library it uses.
+    """
+    paths = {} if paths is None else paths
+    path = get_module_path(module_name)
+    if path is None or path in paths:
+        return paths
+    paths[path] = None
+    with open(path, "rb") as fileobj:
+        tree = ast.parse(fileobj.read(), filename=path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imported_names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            # the names imported from a module may themselves be modules.
+            imported_names = [node.module] + \
+                [f"{node.module}.{alias.name}" for alias in node.names]
+        else:
+            continue
+        for imported_name in imported_names:
+            if imported_name.split(".")[0] == PACKAGE:
+                get_code_paths(imported_name, paths)
+    return paths
+
+def entry_point_code(entry_point, *data_files):
+    """Get the code of a stage which runs a console script entry point."""
+    module, _ = entry_point.split(":")
+    return sorted(get_code_paths(module)) + \
+        [os.path.join(os.path.dirname(get_module_path(module)), f)
+         for f in data_files]
+
+def hash_file(path, digests, fingerprint_size=FINGERPRINT_SIZE):
+    """Get the digest of a file, reusing it while the file is unchanged.
+
+    A file larger than fingerprint_size (if it isn't None) is fingerprinted
+    by its size and modification time, any other is hashed by its content.
+    """
+    stat = os.stat(path)
+    fingerprinted = \
+        fingerprint_size is not None and stat.st_size > fingerprint_size
+    key = (path, stat.st_size, stat.st_mtime_ns, fingerprinted)
+    if key not in digests:
+        if fingerprinted:
+            digests[key] = f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf8")
+        else:
+            blake2b = hashlib.blake2b()
+            with open(path, "rb") as fileobj:
+                for block in iter(lambda: fileobj.read(HASH_BUFFER_SIZE), b""):
+                    blake2b.update(block)
+            digests[key] = blake2b.digest()
+    return digests[key]
+
+def hash_path(path,
+              blake2b=None,
+              digests=None,
+              fingerprint_size=FINGERPRINT_SIZE):
+    """Hash a file or every file in a directory.
+
+    The digest of each file is kept in digests, so that the same file is
+    only read once for as long as it's unchanged.
+    """
+    blake2b = blake2b or hashlib.blake2b()
+    digests = {} if digests is None else digests
+    blake2b.update(os.path.basename(path).encode("utf8") + b"\0")
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            hash_path(os.path.join(path, name),
+                      blake2b,
+                      digests,
+                      fingerprint_size)
+    elif os.path.exists(path):
+        blake2b.update(hash_file(path, digests, fingerprint_size))
+    else:
+        blake2b.update(b"\0")
+    return blake2b
+
+def hash_stage(stage, digests=None):
+    """Hash the command, the code and the inputs of a stage.
+
+    The code is always hashed by its content, while large inputs are only
+    fingerprinted.
+    """
+    digests = {} if digests is None else digests
+    blake2b = hashlib.blake2b()
+    blake2b.update(json.dumps(stage.command[1:]).encode("utf8"))
+    for path in stage.code:
+        hash_path(path, blake2b, digests, fingerprint_size=None)
+    for path in stage.inputs:
+        hash_path(path, blake2b, digests)
+    return blake2b.hexdigest()
+
+def get_stage_dependencies(stages):
+    """Get the names of the stages each stage depends on."""
+    output_to_stage = {o: s.name for s in stages for o in s.outputs}
+    return {s.name: set(output_to_stage[i] for i in s.inputs
+                        if i in output_to_stage)
+            for s in stages}
+
+def load_state(state_filename):
+    """Load the hashes the stages had when they were last run."""
+    if not os.path.exists(state_filename):
+        return {}
+    with open(state_filename, "r", encoding="utf8") as fileobj:
+        return json.load(fileobj)
+
+def save_state(state_filename, state):
+    """Save the hashes the stages had when they were last run."""
+    with open(f"{state_filename}.tmp", "w", encoding="utf8") as fileobj:
+        json.dump(state, fileobj, indent=1, sort_keys=True)
+    os.replace(f"{state_filename}.tmp", state_filename)
+
+def run_stage(stage):
+    """Run the command of a stage, returning its exit code."""
+    print(f"[{stage.name}] running", file=sys.stderr)
+    start = time.monotonic()
+    returncode = subprocess.call(stage.command)
+    print(f"[{stage.name}] exited with {returncode} after "
+          f"{time.monotonic() - start:.1f}s",
+          file=sys.stderr)
+    return returncode
+
+# pylint: disable=too-many-locals
+def run_pipeline(stages, state_filename, *, force=False, max_workers=None):
+    """Run the stages of a pipeline in the order of their dependencies.
+
+    A stage is skipped if its hash is the same as when it last succeeded and
+    all of its outputs exist, and every stage whose dependencies have
+    finished is run concurrently. Returns the names of the stages which were
+    run, or raises a RuntimeError listing the stages which failed.
+    """
+    dependencies = get_stage_dependencies(stages)
+    state = load_state(state_filename)
+    pending = {s.name: s for s in stages}
+    finished, failed, ran = set(), set(), []
+    running = {}
+    # the digests of the files hashed during this run, by their stat.
+    digests = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            progressed = False
+            for name, stage in list(pending.items()):
+                if dependencies[name] & failed:
+                    failed.add(name)
+                    del pending[name]
+                    progressed = True
+                    print(f"[{name}] not run as a dependency failed",
+                          file=sys.stderr)
+                    continue
+                if not dependencies[name] <= finished:
+                    continue
+                del pending[name]
+                progressed = True
+                stage_hash = hash_stage(stage, digests)
+                if not (force or stage.always_run) and \
+                        state.get(name) == stage_hash and \
+                        all(os.path.exists(o) for o in stage.outputs):
+                    print(f"[{name}] skipped as its inputs are unchanged",
+                          file=sys.stderr)
+                    finished.add(name)
+                    continue
+                running[executor.submit(run_stage, stage)] = \
+                    (stage, stage_hash)
+            if not running:
+                if not progressed:
+                    raise ValueError(f"Stages have cyclic dependencies: "
+                                     f"{', '.join(sorted(pending))}")
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, stage_hash = running.pop(future)
+                ran.append(stage.name)
+                if future.result() != 0:
+                    failed.add(stage.name)
+                    continue
+                finished.add(stage.name)
+                # the hash is recomputed in case the stage changed its inputs.
+                state[stage.name] = hash_stage(stage, digests)
+                save_state(state_filename, state)
+    if failed:
+        raise RuntimeError(f"Stages failed: {', '.join(sorted(failed))}")
+    return ran
+
+def make_character_pipeline(work_directory, output, *, refresh=False):
+    """Make the stages which produce a characters.json from the websites."""
+    def path(name):
+        return os.path.join(work_directory, name)
+    ap_pages = path("anime_planet_pages.pack")
+    ap_manifest = path("anime_planet_manifest.json")
+    ap_extract = path("anime_planet_extract.ndjson")
+    mal_pages = path("myanimelist_pages.pack")
+    mal_manifest = path("myanimelist_manifest.json")
+    mal_frontier = path("myanimelist_frontier.sqlite")
+    mal_extract = path("myanimelist_extract.ndjson")
+    anime_extract = path("myanimelist_anime_extract.ndjson")
+    anime_db = path("anime.db")
+    refresh_args = ["--refresh"] if refresh else []
+    return [
+        Stage(
+            name="anime-planet-downloader",
+            command=entry_point_command(
+                "animeu.spiders.anime_planet_downloader:main",
+                "--manifest", ap_manifest,
+                "--pages-directory", ap_pages,
+                *refresh_args
+            ),
+            inputs=[],
+            outputs=[ap_pages, ap_manifest],
+            always_run=True
+        ),
+        Stage(
+            name="anime-planet-extractor",
+            command=entry_point_command(
+                "animeu.spiders.anime_planet_extractor:main",
+                "--pages-directory", ap_pages,
+                "--output", ap_extract,
+                "--cache", path("anime_planet_extract_cache.sqlite"),
+                "--index"
+            ),
+            inputs=[ap_pages],
+            outputs=[ap_extract],
+            always_run=False,
+            code=entry_point_code("animeu.spiders.anime_planet_extractor:main")
+        ),
+        Stage(
+            name="myanimelist-downloader",
+            command=entry_point_command(
+                "animeu.spiders.myanimelist_downloader:main",
+                "--anime-planet-extract", ap_extract,
+                "--manifest", mal_manifest,
+                "--pages-directory", mal_pages,
+                "--frontier", mal_frontier,
+                *refresh_args
+            ),
+            inputs=[ap_extract],
+            outputs=[mal_pages, mal_manifest],
+            always_run=True
+        ),
+        Stage(
+            name="myanimelist-extractor",
+            command=entry_point_command(
+                "animeu.spiders.myanimelist_extractor:main",
+                "--pages-directory", mal_pages,
+                "--output", mal_extract,
+                "--cache", path("myanimelist_extract_cache.sqlite"),
+                "--index"
+            ),
+            inputs=[mal_pages],
+            outputs=[mal_extract],
+            always_run=False,
+            code=entry_point_code(
+                "animeu.spiders.myanimelist_extractor:main"
+            )
+        ),
+        Stage(
+            name="myanimelist-anime-extractor",
+            command=entry_point_command(
+                "animeu.spiders.myanimelist_anime_extractor:main",
+                "--directory", mal_pages,
+                "--output", anime_extract,
+                "--index"
+            ),
+            inputs=[mal_pages],
+            outputs=[anime_extract],
+            always_run=False,
+            code=entry_point_code(
+                "animeu.spiders.myanimelist_anime_extractor:main"
+            )
+        ),
+        Stage(
+            name="anime-db-match",
+            command=entry_point_command(
+                "animeu.spiders.anime_db_generator:match_characters_cli",
+                "--database", anime_db,
+                "--anime-extract", anime_extract,
+                "--character-extracts", ap_extract, mal_extract,
+                "--output", output
+            ),
+            inputs=[anime_extract, ap_extract, mal_extract],
+            outputs=[output],
+            always_run=False,
+            code=entry_point_code(
+                "animeu.spiders.anime_db_generator:match_characters_cli",
+                "schema.sql",
+                "match.sql"
+            )
+        ),
+    ]
+
+def main(argv=None):
+    """Entry point to the character pipeline."""
+    argv = argv or sys.argv[1:]
+    parser = argparse.ArgumentParser("""Produce a characters.json.""")
+    parser.add_argument("--work-directory",
+                        metavar="WORK",
+                        type=str,
+                        required=True,
+                        help="""A directory to keep the pages, extracts and """
+                             """state of the pipeline in between runs.""")
+    parser.add_argument("--output",
+                        metavar="OUTPUT",
+                        type=str,
+                        default="characters.json")
+    parser.add_argument("--refresh",
+                        action="store_true",
+                        help="""Revalidate the pages which have already """
+                             """been downloaded.""")
+    parser.add_argument("--skip-download",
+                        action="store_true",
+                        help="""Only extract from the pages which have """
+                             """already been downloaded.""")
+    parser.add_argument("--force",
+                        action="store_true",
+                        help="""Run every stage even if its inputs have not """
+                             """changed.""")
+    parser.add_argument("--jobs",
+                        type=int,
+                        default=None,
+                        help="""The most stages to run at once.""")
+    result = parser.parse_args(argv)
+    os.makedirs(result.work_directory, exist_ok=True)
+    stages = make_character_pipeline(result.work_directory,
+                                     result.output,
+                                     refresh=result.refresh)
+    if result.skip_download:
+        stages = [s for s in stages if not s.always_run]
+    try:
+        run_pipeline(stages,
+                     os.path.join(result.work_directory, STATE_FILENAME),
+                     force=result.force,
+                     max_workers=result.jobs)
+    except RuntimeError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
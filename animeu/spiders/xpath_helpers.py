@@ -12,12 +12,12 @@ import regex as re
 from lxml import etree
 from parsel import Selector, SelectorList
 
-from animeu.common.func_helpers import identity, constant
-from animeu.common.iter_helpers import window
+from animeu.common.func_helpers import identity
+from animeu.common.file_helpers import decode_bytes, detect_group_encoding
 
-
-def _remove_newlines(text):
-    return re.sub(r"\s+", " ", text)
+# the same parser options ```parsel.Selector``` uses for html documents, but
+# without the overhead of ```lxml.html```'s custom element classes.
+HTML_PARSER = etree.HTMLParser(recover=True, encoding="utf8", huge_tree=True)
 
 
 def xpath_count(selector, xpath):
@@ -73,8 +73,29 @@ def xpath_boolean(selector, xpath):
         return True
     return False
 
+def _element_children(element):
+    """Get the children of an element which an xpath ```*``` would select."""
+    return [c for c in element if isinstance(c.tag, str)]
+
+
+def _sibling_position(position):
+    """Convert a 1-based position into the form of ```xpath_position_of```.
+
+    Note that ```xpath_position_of``` considers both the first and the
+    non-existant elements to be at position 0.
+    """
+    return 0 if position == 1 else position
+
+
+# pylint: disable=too-many-locals
 def xpath_slice_between(selector, lower_xpath, upper_xpath, inclusive=False):
-    """Slice a selector between two bounds."""
+    """Slice a selector between two bounds.
+
+    The boundaries are found by a single walk over the children of the
+    selector. The lower boundary is the first ```lower_xpath``` element with
+    an ```upper_xpath``` element following it, the upper boundary is then the
+    first ```upper_xpath``` element after the lower boundary.
+    """
     if any(not re.match(r"\./(?:\w+|\*)(\[.*?\])?$", xpath)
            for xpath in (lower_xpath, upper_xpath)):
         raise ValueError(
@@ -82,39 +103,47 @@ def xpath_slice_between(selector, lower_xpath, upper_xpath, inclusive=False):
             """expressions which are not supported. All boundary paths must """
             """be of the form ```./e[...]```."""
         )
-    max_lower_position = xpath_position_of(
-        selector,
-        xpath_expr_first(
-            # the idea here is that the 'lower' boundary could actually
-            # also occur after an 'end' boundary so we can't simply
-            # take the last() lower boundary, instead we need to make sure
-            # we take the last() out of those who have an 'upper' boundary
-            # that follows them.
-            # pylint: disable=line-too-long
-            f"({lower_xpath})[following-sibling::*[{xpath_expr_is_subset('.', f'../{upper_xpath}')}]]"
+    selectors = [selector] if isinstance(selector, Selector) else selector
+    results = []
+    for sel in selectors:
+        lower_elements = set(s.root for s in sel.xpath(lower_xpath))
+        upper_elements = set(s.root for s in sel.xpath(upper_xpath))
+        lower_positions = []
+        upper_positions = []
+        for position, child in enumerate(_element_children(sel.root), start=1):
+            if child in lower_elements:
+                lower_positions.append(position)
+            if child in upper_elements:
+                upper_positions.append(position)
+        # the idea here is that the 'lower' boundary could actually
+        # also occur after an 'end' boundary so we can't simply
+        # take the last() lower boundary, instead we need to make sure
+        # we take the first out of those who have an 'upper' boundary
+        # that follows them.
+        max_lower_position = next(
+            (_sibling_position(p) for p in lower_positions
+             if upper_positions and p < upper_positions[-1]),
+            0
         )
-    )
-    upper_boundary_positions = [
-        xpath_position_of(s, '.') for s in  selector.xpath(upper_xpath)
-    ]
-    upper_boundary_positions = [
-        b for b in upper_boundary_positions if b > max_lower_position
-    ]
-    min_upper_position = \
-        upper_boundary_positions[0] if upper_boundary_positions else 0
-    # there is simply no way we can select anything out of (?, 0) unless
-    # the range is inclusive!
-    if min_upper_position == 0 and not inclusive:
-        return SelectorList()
-    lwr_op = ">=" if inclusive else ">"
-    upr_op = "<=" if inclusive else "<"
-    slice_expr = (
-        r"*[ "
-        f"  position() {lwr_op} {max_lower_position} "
-        f"  and position() {upr_op} {min_upper_position} "
-        rf"]"
-    )
-    return selector.xpath(slice_expr)
+        min_upper_position = next(
+            (_sibling_position(p) for p in upper_positions
+             if _sibling_position(p) > max_lower_position),
+            0
+        )
+        # there is simply no way we can select anything out of (?, 0) unless
+        # the range is inclusive!
+        if min_upper_position == 0 and not inclusive:
+            continue
+        lwr_op = ">=" if inclusive else ">"
+        upr_op = "<=" if inclusive else "<"
+        slice_expr = (
+            r"*[ "
+            f"  position() {lwr_op} {max_lower_position} "
+            f"  and position() {upr_op} {min_upper_position} "
+            rf"]"
+        )
+        results.extend(sel.xpath(slice_expr))
+    return SelectorList(results)
 
 
 def xpath_expr_is_subset(set_a_xpath, set_b_xpath):
@@ -135,6 +164,21 @@ def etree_parse_single_element(element_html):
     return elements[0]
 
 
+def parse_html_document(data, encoding_group=None):
+    """Parse the bytes of a html document into an ```etree.Element```.
+
+    Pages which are not valid utf8 are decoded with ```decode_bytes``` (the
+    encoding detected in the ```encoding_group``` is tried first) and
+    transcoded before being parsed, so the resulting tree is the same one
+    ```parsel.Selector(text=...)``` would have produced from the decoded text.
+    """
+    encoding = detect_group_encoding(encoding_group, data)
+    if encoding != "utf8":
+        data = decode_bytes(data, encoding=encoding).encode("utf8")
+    data = data.replace(b"\x00", b"").strip() or b"<html/>"
+    return etree.fromstring(data, parser=HTML_PARSER)
+
+
 def istag(selector, tags):
     """Return True if the selector is for an element which matches any tags."""
     if isinstance(tags, str):
@@ -171,212 +215,77 @@ def xpath_split(selector,
     return SelectorList(list(splits))
 
 
-# pylint: disable=too-many-locals
-def xpath_split_inner(selector,
-                      boundary_xpaths,
-                      child_filter=None,
-                      map_group=None,
-                      filter_results=None):
-    """Split a selectors children up and re-wrap segments in parent.
-
-    ```
-    <div> h2' p p h2" p p <div>
-    becomes
-    [<div> h2' p p </div>, <div> h2" p p </div>]
-    ```
-    """
-    if any(not re.match(r"\./(?:\w+|\*)(\[.*?\])?$", xpath)
-           for xpath in boundary_xpaths):
-        raise ValueError(
-            f"""One or more of {boundary_xpaths} are a nested or non-relative xpath """
-            """expressions which are not supported. All boundary paths must """
-            """be of the form ```./e[...]```."""
-        )
-
-    if isinstance(selector, SelectorList):
-        if len(selector) != 1:
-            raise ValueError(
-                """The provided `selector` was a SelectorList with """
-                """either zero or more than one elements. This is not """
-                """supported, provide either a Selector or SelectorList """
-                """with a single element."""
-            )
-        selector = selector[0]
-    outer_html = selector.extract()
-
-    def map_elements_to_selector(element_htmls):
-        """Wrap elements in a copy of the parent element."""
-        root = etree_parse_single_element(outer_html)
-        for child in list(root):
-            root.remove(child)
-        for element_html in element_htmls:
-            element = etree_parse_single_element(element_html)
-            root.append(element)
-        root_html = etree.tostring(root, encoding="utf8").decode("utf8")
-        root_html = _remove_newlines(root_html)
-        return Selector(text=root_html).xpath("/html/body/*[1]")
-
-    def wrap_if_bare_text(html, wrapper_tag="p"):
-        """Wrap bare text up in a tag."""
-        if not re.match(r"^\<[^>]+\>", html):
-            return "<{tag}>{html}</{tag}>".format(tag=wrapper_tag,
-                                                  html=html)
-        return html
-
-    number_of_splits = sum(
-        map(partial(xpath_count, selector), boundary_xpaths)
-    )
-    if number_of_splits == 0:
-        return [SelectorList([selector])]
-
-    # In this section we collect all the unique boundary positions.
-    # so say for ```h2' p p h2" p p p'``` splitting on ``./h2``` we would get
-    # [1, 4] initally. However we want a list of the form [a, b, c] such that
-    # we have spans [a, b), [b, c) which in total comprise all elements.
-    # To ensure that we end up with such a form
-    # we ensure that the left-most element is added as boundary unless
-    # it already is (h2' in this example), we also ensure the right-most
-    # element is added as a boundary unless it already is - which in this
-    # example would be p' which was not included so we add a position to
-    # include it. Resulting in [1, 4, 8] which corresponds to the spans
-    # [1, 4) = [h2', p, p], [4, 8) = [h2", p, p, p'].
-    #
-    # Another example of ```h2' p h2"``` we would get inital boundaries of
-    # [1, 3] which would be padded to [1, 3, 4] resulting in ranges
-    # [1, 3) = [h2', p] and [3, 4) = [h2"]
-    # pylint: disable=invalid-name
-    unordered_split_boundary_positions = set()
-    maximum_position = xpath_count(
-        selector,
-        "./*"
-    )
-    for boundary_xpath in boundary_xpaths:
-        number_of_boundaries = xpath_count(selector, boundary_xpath)
-        for boundary_number in range(1, number_of_boundaries + 1):
-            boundary_element_xpath = f"({boundary_xpath})[{boundary_number}]"
-            position_relative_to_parent = xpath_position_of(
-                selector,
-                boundary_element_xpath
-            )
-            unordered_split_boundary_positions.add(
-                position_relative_to_parent
-            )
-    # pylint: disable=invalid-name
-    ordered_split_boundary_positions = list(
-        sorted(unordered_split_boundary_positions)
-    )
-    if ordered_split_boundary_positions[0] > 1:
-        ordered_split_boundary_positions.insert(0, 1)
-    if ordered_split_boundary_positions[-1] <= maximum_position:
-        ordered_split_boundary_positions.append(maximum_position + 1)
-
-    results = []
-    for inclusive_start_pos, noninclusive_end_pos in window(
-            ordered_split_boundary_positions
-    ):
-        slice_xpath = (
-            # The second expression here involving ```string-length``` is to
-            # account for leftover text that isn't wrapped in any element.
-            # for example:
-            # ```
-            # <div>
-            #   <h2>h1</h2>
-            #   foo
-            #   <h2>h2</h2>
-            #   ...
-            # </div>
-            # ```
-            # In this scenario the 'foo' text is accessed via /text() not /*.
-            # We grab out these bare text nodes by 'intersecting' 1) all the
-            # text nodes that occur before the end element and 2) all the text
-            # elements that occur after the start element:
-            # <------------------------e
-            #     s------------------------>
-            #     |--------------------|
-            # y y | x t   x  t t   x t | y y
-            (
-                f"./*[position() >= {inclusive_start_pos} and position() < {noninclusive_end_pos}] | "  # pylint: disable=line-too-long
-                f"set:intersection("
-                f"   ./*[position() = {noninclusive_end_pos}]/preceding-sibling::text()[string-length(normalize-space()) > 1], "  # pylint: disable=line-too-long
-                f"   ./*[position() = {inclusive_start_pos}]/following-sibling::text()[string-length(normalize-space()) > 1]"  # pylint: disable=line-too-long
-                f")"   # pylint: disable=line-too-long
-            ).format(start_pos=inclusive_start_pos,
-                     end_pos=noninclusive_end_pos)
-        )
-        # Filter out cruft elements that are not of interested. For example
-        # unused paragraph tags, so as to achieve a more unified structure
-        # in the results.
-        elements_in_slice = selector.xpath(slice_xpath)
-        filtered_elements = SelectorList(
-            filter(child_filter, elements_in_slice)
-        )
-        mapped_elements = map_group(filtered_elements) if map_group else \
-            filtered_elements
-        if not isinstance(mapped_elements, SelectorList):
-            raise TypeError("""Expected the supplied `map_group` function """
-                            """to return a ```parsel.SelectorList``` not """
-                            f"""a {type(mapped_elements)}.""")
-        element_htmls = list(
-            chain.from_iterable(e.getall() for e in mapped_elements)
-        )
-        if not element_htmls:
-            continue
-        element_htmls = map(_remove_newlines, element_htmls)
-        element_htmls = map(wrap_if_bare_text, element_htmls)
-        results.append(map_elements_to_selector(element_htmls))
-    return SelectorList(filter(filter_results, results))
+WHITESPACE_TRANSLATION = str.maketrans({"\xa0": " ",
+                                        "\u2019": "'",
+                                        "\u00c2": " "})
+NBSP_PRESERVING_WHITESPACE_TRANSLATION = str.maketrans({"\u2019": "'",
+                                                        "\u00c2": " "})
+NON_NEWLINE_WHITESPACE_PATTERN = re.compile(r"[^\S\n]+")
+NON_NEWLINE_OR_NBSP_WHITESPACE_PATTERN = re.compile(r"[^\S\n\xa0]+")
 
 
 def normalize_whitespace(text, translate_nbsp=True, only_single_spaces=True):
     """Normalize whitespace and change ```&nbsp;``` to a normal space."""
     if translate_nbsp:
-        text = text.replace("\xa0", " ")
-    text = text.replace("\u2019", "'")
-    text = text.replace("\u00c2", " ")
-    if only_single_spaces:
-        if translate_nbsp:
-            text = re.sub(r"[^\S\n]+", " ", text)
-        else:
-            text = re.sub(r"[^\S\n\xa0]+", " ", text)
-    text = text.strip()
-    return text
+        text = text.translate(WHITESPACE_TRANSLATION)
+        if only_single_spaces:
+            text = NON_NEWLINE_WHITESPACE_PATTERN.sub(" ", text)
+    else:
+        text = text.translate(NBSP_PRESERVING_WHITESPACE_TRANSLATION)
+        if only_single_spaces:
+            text = NON_NEWLINE_OR_NBSP_WHITESPACE_PATTERN.sub(" ", text)
+    return text.strip()
+
+
+def _iter_selector_text(selector):
+    """Iterate over the text ```css("*::text")``` would select in a selector.
+
+    Text selectors have no nodes 'below' them, instead their own content
+    is used.
+    """
+    # pylint: disable=protected-access
+    expr = getattr(selector, "_expr", None)
+    if expr is not None and expr.endswith("text()"):
+        yield selector.get()
+    elif etree.iselement(selector.root):
+        yield from selector.root.itertext()
 
 
 def get_all_text(sel,
                  element_seperator="\n",
-                 element_filter=constant(True),
-                 element_transform=identity,
+                 element_filter=None,
+                 element_transform=None,
                  text_transform=normalize_whitespace) -> str:
     """Get all the text in the selector."""
-    if not isinstance(sel, (Selector, SelectorList)):
-        raise TypeError("""Expected either Selector or SelectorList.""")
-    # The trouble here is that we may be passing in either a list of or single
-    # Selector and we need to peek into the `_expr` property to properly
-    # deal with `/text()` nodes so we normalize both types of arguments
-    # into a SelectorList.
     if isinstance(sel, Selector):
-        selectors = SelectorList([sel])
-    else:
+        selectors = (sel,)
+    elif isinstance(sel, SelectorList):
         selectors = sel
+    else:
+        raise TypeError("""Expected either Selector or SelectorList.""")
+    text_fragments = chain.from_iterable(map(_iter_selector_text, selectors))
+    if element_transform is not None:
+        text_fragments = map(element_transform, text_fragments)
+    if element_filter is not None:
+        text_fragments = filter(element_filter, text_fragments)
+    element_seperator = "" if element_seperator is None else element_seperator
+    return text_transform(element_seperator.join(text_fragments))
+
 
+def get_all_element_text(elements,
+                         element_seperator="\n",
+                         text_transform=normalize_whitespace) -> str:
+    """Get all the text in a list of ```lxml``` elements or text results.
+
+    This is the counterpart of ```get_all_text``` for the results of compiled
+    ```etree.XPath``` expressions, text results are used as is whereas
+    elements contribute all of the text nodes they contain.
+    """
     text_fragments = []
-    for maybe_text_selector in selectors:
-        # text elements have no other elements 'below' them hence
-        # the `*::text()` expression used below to get all text within
-        # a node won't work here! Instead we use `get()` to get the
-        # non-nested content of a single node.
-        #
-        # pylint: disable=protected-access
-        if hasattr(maybe_text_selector, "_expr") and \
-                maybe_text_selector._expr is not None and \
-                maybe_text_selector._expr.endswith("text()"):
-            text_fragments.append(maybe_text_selector.get())
+    for element in elements:
+        if isinstance(element, str):
+            text_fragments.append(element)
         else:
-            text_selectors = maybe_text_selector.css("*::text")
-            text_fragments.extend(text_selectors.extract())
-
+            text_fragments.extend(element.itertext())
     element_seperator = "" if element_seperator is None else element_seperator
-    text_fragments = list(map(element_transform, text_fragments))
-    text_fragments = list(filter(element_filter, text_fragments))
-    text = element_seperator.join(text_fragments)
-    return text_transform(text)
+    return text_transform(element_seperator.join(text_fragments))
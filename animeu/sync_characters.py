@@ -0,0 +1,47 @@
+# /animeu/sync_characters.py
+#
+# CLI app to give the characters of the dataset ids in the database.
+#
+# See /LICENCE.md for Copyright information
+"""CLI app to give the characters of the dataset ids in the database."""
+import sys
+import argparse
+
+from animeu.data_loader import load_character_data
+from animeu.app import db
+from animeu.models import Character
+
+def get_character_ids():
+    """Get a map from the name of every character to its id."""
+    return dict(db.session.query(Character.name, Character.id))
+
+def sync_characters(names=None):
+    """Add the characters without an id, and return a name -> id map.
+
+    By default the characters of the dataset are added, by the (first
+    english) name they are battled and favourited under. A character is
+    never removed once it's been given an id, so that the ids are stable.
+    """
+    if names is None:
+        names = [c["names"]["en"][0] for c in load_character_data()]
+    name_to_id = get_character_ids()
+    new_names = sorted(set(names) - set(name_to_id))
+    if new_names:
+        db.session.execute(Character.__table__.insert(),
+                           [{"name": n} for n in new_names])
+        db.session.commit()
+        name_to_id = get_character_ids()
+    print(f"characters: added {len(new_names)} of {len(name_to_id)}",
+          file=sys.stderr)
+    return name_to_id
+
+def main(argv=None):
+    """Entry point to the character syncer."""
+    argv = argv or sys.argv[1:]
+    parser = argparse.ArgumentParser("""Sync the characters of the dataset
+                                     into the database.""")
+    parser.parse_args(argv)
+    sync_characters()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# /animeu/testing/adaptive_throttle_tests.py
+#
+# Tests for the adaptive throttle downloader middleware.
+#
+# See /LICENCE.md for Copyright information
+"""Tests for the adaptive throttle downloader middleware."""
+import unittest
+import urllib.request
+from http import HTTPStatus
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from urllib.error import HTTPError
+
+from scrapy.core.downloader import Slot
+from scrapy.http import Request, Response
+from scrapy.utils.test import get_crawler
+
+from animeu.spiders.adaptive_throttle import \
+    AdaptiveThrottleMiddleware, get_adaptive_throttle_settings, \
+    parse_retry_after
+from animeu.testing.fixture_server import FixtureServer
+
+SLOT_KEY = "fixture"
+START_DELAY = 1.0
+
+def fetch(url):
+    """Fetch a url, returning the status and headers of the response."""
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, dict(response.headers)
+    except HTTPError as error:
+        return error.code, dict(error.headers)
+
+
+class AdaptiveThrottleTests(unittest.TestCase):
+    """Check the throttle backs off a slot and then speeds it up again."""
+
+    def setUp(self):
+        """Create a throttle with a single download slot."""
+        crawler = get_crawler(settings_dict={
+            **get_adaptive_throttle_settings(start_delay=START_DELAY),
+            "ADAPTIVE_THROTTLE_INCREASE_EVERY": 1
+        })
+        # the third argument is randomize_delay in older versions of scrapy
+        # and the jitter in newer ones, both of which 0 turns off.
+        self.slot = Slot(1, START_DELAY, 0)
+        crawler.engine = SimpleNamespace(
+            downloader=SimpleNamespace(slots={SLOT_KEY: self.slot})
+        )
+        self.throttle = AdaptiveThrottleMiddleware.from_crawler(crawler)
+
+    def respond(self, status=HTTPStatus.OK, headers=None, latency=0.1):
+        """Pass a response from the slot through the throttle."""
+        request = Request("http://127.0.0.1/",
+                          meta={"download_slot": SLOT_KEY,
+                                "download_latency": latency})
+        response = Response(request.url, status=status, headers=headers)
+        self.throttle.process_response(request, response, spider=None)
+
+    def test_backs_off_for_retry_after_then_recovers(self):
+        """Check a 429 pauses for its Retry-After before speeding up."""
+        with TemporaryDirectory() as pages, \
+                FixtureServer(pages,
+                              "http://fixture",
+                              rate_limit=2,
+                              retry_after=5) as server:
+            # the server has no pages, but a 404 doesn't make it back off.
+            for _ in range(2):
+                self.respond(*fetch(server.url))
+            self.assertLess(self.slot.delay, START_DELAY)
+            failed_delay = self.slot.delay
+            status, headers = fetch(server.url)
+            self.respond(status, headers)
+        self.assertEqual(status, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertListEqual(server.rate_limited_paths, ["/"])
+        self.assertEqual(self.slot.delay, 5.0)
+        self.assertEqual(self.slot.concurrency, 1)
+        # once a response gets through it's sped up from the doubled delay,
+        # but only slowly back past the delay which was too short.
+        delays = []
+        for _ in range(10):
+            self.respond()
+            delays.append(self.slot.delay)
+        self.assertGreater(delays[0], failed_delay)
+        self.assertListEqual(delays, sorted(delays, reverse=True))
+        self.assertLess(delays[-1], failed_delay)
+
+    def test_backs_off_on_server_errors(self):
+        """Check a 5xx doubles the delay and halves the concurrency."""
+        self.slot.concurrency = 4
+        self.respond(HTTPStatus.SERVICE_UNAVAILABLE)
+        self.assertEqual(self.slot.delay, 2 * START_DELAY)
+        self.assertEqual(self.slot.concurrency, 2)
+
+    def test_doesnt_speed_up_slow_responses(self):
+        """Check responses slower than the target latency don't speed up."""
+        for _ in range(5):
+            self.respond(latency=10.0)
+        self.assertEqual(self.slot.delay, START_DELAY)
+        self.respond()
+        self.assertLess(self.slot.delay, START_DELAY)
+
+    def test_parses_retry_after(self):
+        """Check a Retry-After can be in seconds or a http-date."""
+        now = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.assertEqual(parse_retry_after(b"120"), 120.0)
+        self.assertEqual(
+            parse_retry_after(format_datetime(now + timedelta(seconds=30),
+                                              usegmt=True),
+                              now=now),
+            30.0
+        )
+        self.assertIsNone(parse_retry_after("soon"))
+        self.assertIsNone(parse_retry_after(None))
@@ -0,0 +1,204 @@
+# /animeu/testing/admin_logic_tests.py
+#
+# Tests for the admin logic and the models it queries.
+#
+# See /LICENCE.md for Copyright information
+# pylint: disable=import-outside-toplevel
+"""Tests for the admin logic and the models it queries."""
+import json
+import unittest
+from unittest import mock
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+
+from animeu.testing.database_fixture import \
+    use_test_database, clear_test_database, enforced_foreign_keys
+
+def setUpModule():  # pylint: disable=invalid-name
+    """Create and migrate a database for the jobs to use."""
+    use_test_database()
+
+
+def add_battles(winner_names, loser_name):
+    """Add a battle won by each of some characters, a day apart."""
+    from animeu.app import db
+    from animeu.models import User, WaifuPickBattle
+    user = User(email="moderator@example.com", password_hash="hash")
+    db.session.add(user)
+    db.session.flush()
+    start = datetime(2020, 1, 1)
+    battles = [WaifuPickBattle(user_id=user.id,
+                               date=start + timedelta(days=i),
+                               winner_name=winner_name,
+                               loser_name=loser_name)
+               for i, winner_name in enumerate(winner_names)]
+    db.session.add_all(battles)
+    db.session.commit()
+    return battles
+
+
+class AdminTestCase(unittest.TestCase):
+    """Base class to use the app with an empty database."""
+
+    def setUp(self):
+        """Clear the database and enforce its foreign keys."""
+        from animeu.app import app
+        stack = ExitStack()
+        self.addCleanup(stack.close)
+        stack.enter_context(app.app_context())
+        clear_test_database()
+        stack.enter_context(enforced_foreign_keys())
+
+
+class BulkDeleteActionTests(AdminTestCase):
+    """Check deleting battles rewinds the rankings which include them."""
+
+    def setUp(self):
+        """Add some battles and the rankings calculated from them."""
+        from animeu.app import db
+        from animeu.models import ELORankingCalculation
+        super().setUp()
+        self.battles = add_battles(["Keeper", "Spammed", "Spammed"], "Keeper")
+        db.session.add(ELORankingCalculation(
+            date=datetime.now(),
+            latest_battle_id=self.battles[-1].id,
+            rankings=json.dumps({"Keeper": 1000, "Spammed": 1000}),
+            algorithim_hash="hash"
+        ))
+        db.session.commit()
+
+    def test_deletes_battles_the_rankings_refer_to(self):
+        """Check the rankings are rewound before their battles are deleted."""
+        from sqlalchemy.exc import IntegrityError
+        from animeu.app import db
+        from animeu.models import WaifuPickBattle, ELORankingCalculation
+        from animeu.admin.logic import \
+            ELO_LOCK_NAME, bulk_delete_action, get_active_job
+        # the battle can't be deleted while a calculation refers to it.
+        with self.assertRaises(IntegrityError):
+            WaifuPickBattle.query\
+                .filter_by(id=self.battles[-1].id)\
+                .delete(synchronize_session=False)
+            db.session.commit()
+        db.session.rollback()
+        bulk_delete_action(lambda done, total: None,
+                           ["battles"],
+                           character_name="Spammed")
+        self.assertListEqual([b.id for b in WaifuPickBattle.query],
+                             [self.battles[0].id])
+        self.assertEqual(ELORankingCalculation.query.count(), 0)
+        self.assertIsNotNone(get_active_job(ELO_LOCK_NAME))
+
+    def test_gives_up_waiting_for_a_running_update(self):
+        """Check a running update is only waited for until the timeout."""
+        from animeu.app import db
+        from animeu.models import ELORankingCalculation
+        from animeu.admin.logic import \
+            ELO_LOCK_NAME, rewind_rankings_when_idle
+        from animeu.jobs.queries import JOB_RUNNING, enqueue_job
+        enqueue_job(ELO_LOCK_NAME).status = JOB_RUNNING
+        db.session.commit()
+        with self.assertRaises(TimeoutError):
+            rewind_rankings_when_idle(self.battles[1].id, timeout=0)
+        self.assertEqual(ELORankingCalculation.query.count(), 1)
+
+
+class DatatablesResponseTests(AdminTestCase):
+    """Check the tables can be sorted and searched by character name."""
+
+    def setUp(self):
+        """Add some battles between characters."""
+        super().setUp()
+        self.battles = add_battles(["Beta", "Alpha", "Gamma"], "Delta")
+
+    def get_winner_names(self, parameters):
+        """Get the winners of the battles in a datatables response."""
+        from animeu.models import WaifuPickBattle
+        from animeu.admin.logic import get_datatables_response
+        response = get_datatables_response(WaifuPickBattle, {
+            "draw": 1,
+            "columns": [{"name": "id"}, {"name": "winner_name"}],
+            **parameters
+        })
+        return [row["winner_name"] for row in response["data"]]
+
+    def test_sorts_by_character_name(self):
+        """Check a table is sorted by the names of its characters."""
+        for direction, names in (("asc", ["Alpha", "Beta", "Gamma"]),
+                                 ("desc", ["Gamma", "Beta", "Alpha"])):
+            with self.subTest(direction=direction):
+                self.assertListEqual(self.get_winner_names({
+                    "order": [{"column": 1, "dir": direction}]
+                }), names)
+
+    def test_searches_by_character_name(self):
+        """Check a table is searched by the names of its characters."""
+        self.assertListEqual(
+            self.get_winner_names({"search": {"value": "amm"}}),
+            ["Gamma"]
+        )
+
+    def test_compares_character_names_by_id(self):
+        """Check names are compared by looking up the characters' ids."""
+        from animeu.models import WaifuPickBattle
+        for condition, names in (
+                (WaifuPickBattle.winner_name != "Beta", ["Alpha", "Gamma"]),
+                (WaifuPickBattle.winner_name != "Nobody",
+                 ["Alpha", "Beta", "Gamma"]),
+                (WaifuPickBattle.winner_name.notin_(["Alpha", "Gamma"]),
+                 ["Beta"])
+        ):
+            with self.subTest(condition=str(condition)):
+                self.assertIn("winner_id NOT IN", str(condition))
+                self.assertListEqual(
+                    sorted(b.winner_name
+                           for b in WaifuPickBattle.query.filter(condition)),
+                    names
+                )
+
+
+class GetOrAddCharacterTests(AdminTestCase):
+    """Check a character is only ever added once."""
+
+    def test_uses_a_character_added_by_another_request(self):
+        """Check a character added since it was looked up is reused."""
+        from flask_sqlalchemy import BaseQuery
+        from sqlalchemy.sql import select
+        from animeu.app import db
+        from animeu.models import Character, get_or_add_character
+        db.engine.execute(Character.__table__.insert(), name="Racer")
+        racer_id = db.engine.execute(
+            select([Character.id]).where(Character.name == "Racer")
+        ).scalar()
+        # the other request adds the character after it's been looked up.
+        with mock.patch.object(BaseQuery,
+                               "first",
+                               side_effect=[None],
+                               autospec=True):
+            character = get_or_add_character("Racer")
+        self.assertEqual(character.id, racer_id)
+        # only the savepoint was rolled back, so the session can be used.
+        add_battles(["Racer"], "Keeper")
+        self.assertEqual(Character.query.filter_by(name="Racer").count(), 1)
+
+
+class CharacterLoadingTests(AdminTestCase):
+    """Check the characters are only joined by the queries reading them."""
+
+    def test_doesnt_join_characters_by_default(self):
+        """Check querying the battles or favourites doesn't join them."""
+        from animeu.models import WaifuPickBattle, FavouritedWaifu
+        for model in (WaifuPickBattle, FavouritedWaifu):
+            with self.subTest(model=model.__name__):
+                self.assertNotIn("JOIN", str(model.query))
+
+    def test_recent_battles_load_their_characters(self):
+        """Check the names of the most recent battles are loaded with them."""
+        from animeu.app import db
+        from animeu.feed.queries import query_most_recent_battles
+        add_battles(["Alpha", "Beta"], "Gamma")
+        battles = query_most_recent_battles()
+        # a detached battle can't lazily load its characters.
+        db.session.expunge_all()
+        self.assertListEqual([(b.winner_name, b.loser_name) for b in battles],
+                             [("Beta", "Gamma"), ("Alpha", "Gamma")])
@@ -0,0 +1,70 @@
+# /animeu/testing/database_fixture.py
+#
+# A migrated database for the tests which use the app.
+#
+# See /LICENCE.md for Copyright information
+"""A migrated database for the tests which use the app."""
+import os
+import sys
+import atexit
+import shutil
+import sqlite3
+import subprocess
+from contextlib import contextmanager
+from tempfile import mkdtemp
+
+PACKAGE_PARENT = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+_DATABASE_DIRECTORY = None
+
+def use_test_database():
+    """Point the app at a migrated temporary database, creating it once.
+
+    The app reads the database to use when it's imported, so this has to be
+    called before the app is, and every test in the process shares it.
+    """
+    global _DATABASE_DIRECTORY  # pylint: disable=global-statement
+    if _DATABASE_DIRECTORY is None:
+        _DATABASE_DIRECTORY = mkdtemp()
+        atexit.register(shutil.rmtree, _DATABASE_DIRECTORY, True)
+        database_filename = os.path.join(_DATABASE_DIRECTORY, "app.db")
+        # the job processes spawned by a test inherit it from the environment.
+        os.environ["DATABASE"] = f"sqlite:///{database_filename}"
+        subprocess.run([sys.executable, "-m", "flask", "db", "upgrade"],
+                       check=True,
+                       cwd=PACKAGE_PARENT,
+                       env={**os.environ, "FLASK_APP": "animeu.app"},
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+    return os.environ["DATABASE"]
+
+def clear_test_database():
+    """Delete the rows of every table of the test database."""
+    from animeu.app import db  # pylint: disable=import-outside-toplevel
+    db.session.rollback()
+    for table in reversed(db.metadata.sorted_tables):
+        db.session.execute(table.delete())
+    db.session.commit()
+
+# pylint: disable=unused-argument
+def _enable_foreign_keys(dbapi_connection, connection_record):
+    """Make a sqlite connection enforce its foreign keys."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute("pragma foreign_keys = on")
+
+@contextmanager
+def enforced_foreign_keys():
+    """Enforce the foreign keys of the test database, like postgres does."""
+    # pylint: disable=import-outside-toplevel
+    from sqlalchemy import event
+    from animeu.app import db
+    db.session.remove()
+    db.engine.dispose()
+    event.listen(db.engine, "connect", _enable_foreign_keys)
+    try:
+        yield
+    finally:
+        db.session.remove()
+        event.remove(db.engine, "connect", _enable_foreign_keys)
+        db.engine.dispose()
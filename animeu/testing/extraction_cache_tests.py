@@ -0,0 +1,97 @@
+# /animeu/testing/extraction_cache_tests.py
+#
+# Tests for the extraction cache.
+#
+# See /LICENCE.md for Copyright information
+"""Tests for the extraction cache."""
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+from animeu.spiders.extraction_cache import \
+    ExtractionCache, map_extract_with_cache
+
+
+class MapExtractWithCacheTests(unittest.TestCase):
+    """Check only the pages without valid cached metadata are extracted."""
+
+    def setUp(self):
+        """Create a set of pages and a cache in a temporary directory."""
+        # pylint: disable=consider-using-with
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache_filename = os.path.join(self.directory.name, "cache.db")
+        self.pages = {"a": "page a", "b": "page b", "c": "page c"}
+        self.extracted = []
+
+    def extract(self, name, pages):
+        """Extract some metadata from a page, recording it was extracted."""
+        self.extracted.append(name)
+        if pages[name] is None:
+            return None
+        return {"name": name, "content": pages[name]}
+
+    def map_extract(self, names, version="1", chunk_size=2):
+        """Extract the metadata of some pages using the cache."""
+        with ExtractionCache(self.cache_filename, version) as cache:
+            return list(map_extract_with_cache(self.extract,
+                                               names,
+                                               self.pages,
+                                               cache=cache,
+                                               hash_func=lambda n, p: p[n],
+                                               chunk_size=chunk_size,
+                                               pm_parallel=False))
+
+    def test_extracts_pages_on_a_miss(self):
+        """Check the pages which have never been extracted are extracted."""
+        metadatas = self.map_extract(["c", "a", "b"])
+        self.assertListEqual([m["name"] for m in metadatas], ["c", "a", "b"])
+        self.assertListEqual(self.extracted, ["c", "a", "b"])
+
+    def test_reuses_metadata_on_a_hit(self):
+        """Check the pages which are unchanged aren't extracted again."""
+        first_metadatas = self.map_extract(["a", "b", "c"])
+        self.extracted.clear()
+        self.assertListEqual(self.map_extract(["a", "b", "c"]),
+                             first_metadatas)
+        self.assertListEqual(self.extracted, [])
+
+    def test_extracts_pages_with_a_changed_hash(self):
+        """Check only the pages whose content has changed are re-extracted."""
+        self.map_extract(["a", "b", "c"])
+        self.extracted.clear()
+        self.pages["b"] = "changed page b"
+        metadatas = self.map_extract(["a", "b", "c"])
+        self.assertListEqual(self.extracted, ["b"])
+        self.assertEqual(metadatas[1]["content"], "changed page b")
+
+    def test_extracts_pages_with_a_changed_version(self):
+        """Check every page is re-extracted when the extractor changes."""
+        self.map_extract(["a", "b", "c"])
+        self.extracted.clear()
+        self.map_extract(["a", "b", "c"], version="2")
+        self.assertListEqual(self.extracted, ["a", "b", "c"])
+
+    def test_doesnt_cache_failed_extractions(self):
+        """Check a page whose extraction failed is retried next time."""
+        self.pages["b"] = None
+        metadatas = self.map_extract(["a", "b", "c"], chunk_size=1)
+        self.assertIsNone(metadatas[1])
+        self.extracted.clear()
+        self.assertIsNone(self.map_extract(["a", "b", "c"])[1])
+        self.assertListEqual(self.extracted, ["b"])
+
+    def test_yields_each_chunk_once_extracted(self):
+        """Check a chunk's metadata is yielded before the next is extracted."""
+        with ExtractionCache(self.cache_filename, "1") as cache:
+            metadatas = map_extract_with_cache(self.extract,
+                                               ["a", "b", "c"],
+                                               self.pages,
+                                               cache=cache,
+                                               hash_func=lambda n, p: p[n],
+                                               chunk_size=2,
+                                               pm_parallel=False)
+            self.assertEqual(next(metadatas)["name"], "a")
+            self.assertListEqual(self.extracted, ["a", "b"])
+            self.assertListEqual([m["name"] for m in metadatas], ["b", "c"])
+        self.assertListEqual(self.extracted, ["a", "b", "c"])
@@ -0,0 +1,146 @@
+# /animeu/testing/file_helpers_tests.py
+#
+# Tests for the file helpers.
+#
+# See /LICENCE.md for Copyright information
+"""Tests for the file helpers."""
+import os
+import gzip
+import json
+import codecs
+import unittest
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from animeu.common.file_helpers import \
+    JSONListReader, JSONListStream, decode_bytes, detect_group_encoding, \
+    open_transcoded
+
+JAPANESE_TEXT = "あいうえお"
+ENTRIES = [{"name": "a", "score": 1.5}, {"name": "b\n]"}, [1, 2], "c", None]
+
+
+class DetectGroupEncodingTests(unittest.TestCase):
+    """Check the encoding of some bytes is only guessed when it must be."""
+
+    def test_utf8_isnt_guessed(self):
+        """Check valid utf8 is detected without guessing."""
+        with mock.patch("animeu.common.file_helpers.guess_encoding") as guess:
+            self.assertEqual(detect_group_encoding(
+                None, JAPANESE_TEXT.encode("utf8")), "utf8")
+            self.assertEqual(detect_group_encoding(
+                None, codecs.BOM_UTF8 + b"text"), "utf-8-sig")
+        guess.assert_not_called()
+
+    def test_reuses_the_encoding_detected_in_a_group(self):
+        """Check a group's multi-byte encoding is tried before guessing."""
+        data = JAPANESE_TEXT.encode("shift_jis")
+        with mock.patch("animeu.common.file_helpers.guess_encoding",
+                        return_value="shift_jis"):
+            self.assertEqual(detect_group_encoding("reuse", data), "shift_jis")
+        with mock.patch("animeu.common.file_helpers.guess_encoding",
+                        return_value="shift_jis") as guess:
+            self.assertEqual(detect_group_encoding("reuse", data), "shift_jis")
+            detect_group_encoding("other", data)
+        guess.assert_called_once()
+
+    def test_doesnt_reuse_single_byte_encodings(self):
+        """Check a single byte encoding is always guessed."""
+        data = "caf\xe9".encode("latin1")
+        with mock.patch("animeu.common.file_helpers.guess_encoding",
+                        return_value="latin1") as guess:
+            detect_group_encoding("single", data)
+            detect_group_encoding("single", data)
+        self.assertEqual(guess.call_count, 2)
+
+
+class DecodeBytesTests(unittest.TestCase):
+    """Check bytes are decoded in their detected encoding."""
+
+    def test_decodes_detected_encoding(self):
+        """Check bytes which aren't utf8 are decoded in the guessed one."""
+        data = JAPANESE_TEXT.encode("euc_jp")
+        with mock.patch("animeu.common.file_helpers.guess_encoding",
+                        return_value="euc_jp"):
+            self.assertEqual(decode_bytes(data), JAPANESE_TEXT)
+
+    def test_unknown_encoding_falls_back(self):
+        """Check an encoding python doesn't know falls back to utf8."""
+        with mock.patch("animeu.common.file_helpers.guess_encoding",
+                        return_value="x-unknown-charset"):
+            self.assertEqual(decode_bytes(b"caf\xe9", group="unknown"),
+                             "caf�")
+
+
+
+class OpenTranscodedTests(unittest.TestCase):
+    """Check a file read through open_transcoded is decoded like bytes are."""
+
+    def setUp(self):
+        """Write a latin1 file to a temporary directory."""
+        # pylint: disable=consider-using-with
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.filename = os.path.join(self.directory.name, "page.html")
+        with open(self.filename, "wb") as fileobj:
+            fileobj.write("caf\xe9".encode("latin1"))
+
+    def read_transcoded(self, **kwargs):
+        """Read the file transcoded to utf8."""
+        with open_transcoded(self.filename, "r", **kwargs) as fileobj:
+            return fileobj.read().decode("utf8")
+
+    def test_unknown_encoding_falls_back(self):
+        """Check an encoding python doesn't know falls back to utf8."""
+        with mock.patch("animeu.common.file_helpers.guess_encoding",
+                        return_value="x-unknown-charset"):
+            self.assertEqual(self.read_transcoded(), "caf\ufffd")
+
+    def test_misdetected_encoding_falls_back(self):
+        """Check bytes invalid in the given encoding fall back to utf8."""
+        self.assertEqual(self.read_transcoded(source_enc="ascii"),
+                         "caf\ufffd")
+        self.assertEqual(self.read_transcoded(source_enc="latin1"), "caf\xe9")
+
+
+class JSONListReaderTests(unittest.TestCase):
+    """Check the entries of json list files are read back."""
+
+    def setUp(self):
+        """Create a temporary directory to write the lists to."""
+        # pylint: disable=consider-using-with
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = lambda name: os.path.join(self.directory.name, name)
+
+    def write_stream(self, filename, index=False):
+        """Write the entries to a file with a JSONListStream."""
+        with open(filename, "w", encoding="utf8") as fileobj, \
+                JSONListStream(fileobj, ndjson=None, index=index) as stream:
+            for entry in ENTRIES:
+                stream.write(entry)
+
+    def test_reads_streamed_lists(self):
+        """Check the lists written by JSONListStream can be read."""
+        for name, index in (("list.json", False),
+                            ("indexed.json", True),
+                            ("list.ndjson", False)):
+            with self.subTest(name=name):
+                self.write_stream(self.path(name), index=index)
+                with JSONListReader(self.path(name)) as reader:
+                    self.assertListEqual(list(reader), ENTRIES)
+                    self.assertEqual(len(reader), len(ENTRIES))
+                    self.assertEqual(reader[-2], "c")
+
+    def test_iterates_other_json_lists(self):
+        """Check a list which isn't one entry per line can be iterated."""
+        for name, indent in (("pretty.json", 2),
+                             ("compact.json", None),
+                             ("pretty.json.gz", 4)):
+            with self.subTest(name=name):
+                filename = self.path(name)
+                with (gzip.open if name.endswith(".gz") else open)(
+                        filename, "wt", encoding="utf8") as fileobj:
+                    json.dump(ENTRIES, fileobj, indent=indent)
+                with JSONListReader(filename) as reader:
+                    self.assertListEqual(list(reader), ENTRIES)
@@ -0,0 +1,177 @@
+# /animeu/testing/fixture_server.py
+#
+# A local http server which serves saved pages to the downloaders.
+#
+# See /LICENCE.md for Copyright information
+"""A local http server which serves saved pages to the downloaders."""
+import sys
+import time
+import hashlib
+import argparse
+import threading
+from collections import deque
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+
+from animeu.spiders.base64_helpers import base64_urlencode
+from animeu.spiders.page_store import open_page_store
+
+PAGE_EXTENSIONS = (".html", ".anime.html", ".pictures.html")
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    """Serve the saved page of the url a request is for."""
+
+    server_version = "FixtureServer"
+
+    def find_page_name(self):
+        """Find the name of the saved page for the requested url."""
+        # the downloaders name pages after the url in the page's links,
+        # which may not have been quoted the same way as the request.
+        for path in (self.path, unquote(self.path)):
+            url = f"{self.server.origin_url}{path}"
+            for extension in PAGE_EXTENSIONS:
+                name = f"{base64_urlencode(url)}{extension}"
+                if name in self.server.page_store:
+                    return name
+        return None
+
+    def send_page(self, status, body=b"", headers=None):
+        """Send a response to the client."""
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """Respond with the saved page, or a 404 if there isn't one."""
+        if not self.server.record_request(self.path):
+            self.send_page(
+                HTTPStatus.TOO_MANY_REQUESTS,
+                headers={"Retry-After": str(self.server.retry_after)}
+            )
+            return
+        name = self.find_page_name()
+        if name is None:
+            self.send_page(HTTPStatus.NOT_FOUND)
+            return
+        body = self.server.page_store.get(name).replace(
+            self.server.origin_url.encode("utf8"),
+            self.server.url.encode("utf8")
+        )
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if etag in self.headers.get("If-None-Match", ""):
+            self.server.not_modified_paths.append(self.path)
+            self.send_page(HTTPStatus.NOT_MODIFIED, headers={"ETag": etag})
+            return
+        self.send_page(HTTPStatus.OK, body, headers={"ETag": etag})
+
+    # pylint: disable=redefined-builtin
+    def log_message(self, format, *args):
+        """Don't log every request to stderr."""
+
+
+# pylint: disable=too-many-instance-attributes
+class FixtureServer(ThreadingHTTPServer):
+    """Serve the pages of a page store as if they were from origin_url.
+
+    Pages are found by the name the downloaders would have saved them as,
+    and any links to the origin in them are rewritten to point at this
+    server instead. When a ```rate_limit``` is given the server simulates a
+    rate limited site, responding to any requests beyond that many per
+    second with a 429 and a Retry-After header. Every page is served with an
+    ETag, and a request whose If-None-Match matches it gets a 304.
+    """
+
+    daemon_threads = True
+
+    # pylint: disable=too-many-arguments
+    def __init__(self,
+                 pages,
+                 origin_url,
+                 *,
+                 host="127.0.0.1",
+                 port=0,
+                 rate_limit=None,
+                 retry_after=1):
+        """Initialize a FixtureServer listening on host and port."""
+        super().__init__((host, port), FixtureRequestHandler)
+        self.page_store = open_page_store(pages)
+        self.origin_url = origin_url.rstrip("/")
+        self.url = f"http://{host}:{self.server_address[1]}"
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.requested_paths = []
+        self.rate_limited_paths = []
+        self.not_modified_paths = []
+        self._recent_request_times = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __enter__(self):
+        """Context to start serving requests in a seperate thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        """Context to stop serving requests."""
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+        self.page_store.close()
+
+    def record_request(self, path):
+        """Record the path of a request, returning False if it is limited."""
+        with self._lock:
+            now = time.monotonic()
+            while self._recent_request_times and \
+                    now - self._recent_request_times[0] >= 1.0:
+                self._recent_request_times.popleft()
+            if self.rate_limit is not None and \
+                    len(self._recent_request_times) >= self.rate_limit:
+                self.rate_limited_paths.append(path)
+                return False
+            self._recent_request_times.append(now)
+            self.requested_paths.append(path)
+            return True
+
+
+def main(argv=None):
+    """Entry point to the fixture server."""
+    argv = argv or sys.argv[1:]
+    parser = argparse.ArgumentParser("""Serve saved pages for testing.""")
+    parser.add_argument("--pages",
+                        type=str,
+                        required=True,
+                        help="""A directory or .pack file of pages.""")
+    parser.add_argument("--origin-url", type=str, required=True)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--rate-limit",
+                        type=float,
+                        default=None,
+                        help="""The most requests to respond to per second.""")
+    parser.add_argument("--retry-after", type=int, default=1)
+    result = parser.parse_args(argv)
+    server = FixtureServer(result.pages,
+                           result.origin_url,
+                           host=result.host,
+                           port=result.port,
+                           rate_limit=result.rate_limit,
+                           retry_after=result.retry_after)
+    print(f"Serving {result.pages} at {server.url}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.page_store.close()
+
+if __name__ == "__main__":
+    main()
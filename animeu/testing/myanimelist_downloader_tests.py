@@ -0,0 +1,230 @@
+# /animeu/testing/myanimelist_downloader_tests.py
+#
+# Tests for the myanimelist downloader.
+#
+# See /LICENCE.md for Copyright information
+"""Tests for the myanimelist downloader."""
+import io
+import os
+import sys
+import json
+import subprocess
+import unittest
+from contextlib import ExitStack, redirect_stderr
+from tempfile import TemporaryDirectory
+
+from animeu.common.file_helpers import JSONListReader
+from animeu.spiders.base64_helpers import base64_urlencode
+from animeu.spiders.myanimelist_downloader import \
+    MAL_URL, make_mal_spider_cls, main
+from animeu.spiders.page_store import open_page_store
+from animeu.testing.fixture_server import FixtureServer
+
+START_URL = make_mal_spider_cls(None,
+                                None,
+                                {"name": []},
+                                set(),
+                                frontier=None).start_urls[0]
+ANIME_PATH = "/anime/1/Fixture_Anime"
+CHARACTER_PATHS = {
+    "Girl One": "/character/10/Girl_One",
+    "Girl Two": "/character/11/Girl_Two",
+    "Boy Three": "/character/12/Boy_Three",
+}
+SEARCHED_NAMES = ["Girl One", "Girl Two"]
+
+def make_page(body):
+    """Make the html of a page with some body."""
+    return f"<html><body>{body}</body></html>".encode("utf8")
+
+def make_link(path, text):
+    """Make the html of a link to a path on the origin site."""
+    return f'<a href="{MAL_URL}{path}">{text}</a>'
+
+def get_fixture_pages():
+    """Get the urls and content of the pages of a tiny myanimelist."""
+    characters_links = "".join(make_link(p, n)
+                               for n, p in CHARACTER_PATHS.items())
+    pages = {
+        START_URL: make_page(make_link(ANIME_PATH, "Fixture Anime")),
+        f"{MAL_URL}{ANIME_PATH}": make_page(
+            '<div id="horiznav_nav">'
+            f'{make_link(f"{ANIME_PATH}/characters", "Characters")}</div>'
+        ),
+        f"{MAL_URL}{ANIME_PATH}/characters": make_page(
+            f'<div id="content">{characters_links}</div>'
+        ),
+    }
+    for name, path in CHARACTER_PATHS.items():
+        pages[f"{MAL_URL}{path}"] = make_page(
+            f"<h1>{name}</h1>{make_link(f'{path}/pictures', 'Pictures')}"
+        )
+        pages[f"{MAL_URL}{path}/pictures"] = make_page(f"<p>{name}</p>")
+    return pages
+
+
+class MyAnimeListDownloaderTestCase(unittest.TestCase):
+    """Base class to crawl a fixture server with the downloader."""
+
+    def setUp(self):
+        """Serve the fixture pages and create the downloader's files."""
+        # pylint: disable=consider-using-with
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = lambda name: os.path.join(self.directory.name, name)
+        with open_page_store(self.path("site"), writable=True) as site:
+            for url, content in get_fixture_pages().items():
+                site.put(f"{base64_urlencode(url)}.html", content)
+        with open(self.path("extract.json"), "w", encoding="utf8") as fileobj:
+            json.dump([{"names": {"en": [name]},
+                        "anime_roles": [{"role": "Main",
+                                         "name": "Fixture Anime"}]}
+                       for name in SEARCHED_NAMES],
+                      fileobj)
+        stack = ExitStack()
+        self.addCleanup(stack.close)
+        self.server = stack.enter_context(FixtureServer(self.path("site"),
+                                                        MAL_URL))
+
+    def crawl(self, *args):
+        """Crawl the fixture server, returning the paths it was sent."""
+        self.server.requested_paths.clear()
+        self.server.not_modified_paths.clear()
+        subprocess.run([sys.executable,
+                        "-c",
+                        "from animeu.spiders.myanimelist_downloader "
+                        "import main; main()",
+                        "--anime-planet-extract", self.path("extract.json"),
+                        "--manifest", self.path("manifest.json"),
+                        "--pages-directory", self.path("pages"),
+                        "--frontier", self.path("frontier.db"),
+                        "--base-url", self.server.url,
+                        *args],
+                       check=True,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        return set(self.server.requested_paths)
+
+    def get_saved_name(self, name, pictures=False):
+        """Get the name a character's page (or pictures) is saved as."""
+        url = f"{self.server.url}{CHARACTER_PATHS[name]}"
+        extension = ".pictures.html" if pictures else ".html"
+        return f"{base64_urlencode(url)}{extension}"
+
+
+class MyAnimeListDownloaderTests(MyAnimeListDownloaderTestCase):
+    """Check the downloader only visits the pages it still needs."""
+
+    def test_only_downloads_searched_characters(self):
+        """Check the characters not in the search domain aren't visited."""
+        requested_paths = self.crawl()
+        for name, path in CHARACTER_PATHS.items():
+            with self.subTest(name=name):
+                if name in SEARCHED_NAMES:
+                    self.assertIn(path, requested_paths)
+                    self.assertIn(f"{path}/pictures", requested_paths)
+                else:
+                    self.assertNotIn(path, requested_paths)
+        with open_page_store(self.path("pages")) as pages:
+            for name in SEARCHED_NAMES:
+                self.assertIn(self.get_saved_name(name), pages)
+                self.assertIn(self.get_saved_name(name, pictures=True), pages)
+
+    def test_skips_visited_characters(self):
+        """Check a second crawl skips the characters in the frontier."""
+        self.crawl()
+        requested_paths = self.crawl()
+        self.assertIn(f"{ANIME_PATH}/characters", requested_paths)
+        for path in CHARACTER_PATHS.values():
+            self.assertNotIn(path, requested_paths)
+            self.assertNotIn(f"{path}/pictures", requested_paths)
+
+    def test_resumes_characters_missing_pictures(self):
+        """Check a second crawl only revisits the unfinished characters."""
+        pictures_url = f"{MAL_URL}{CHARACTER_PATHS['Girl Two']}/pictures"
+        pictures_name = f"{base64_urlencode(pictures_url)}.html"
+        pictures_content = self.server.page_store.get(pictures_name)
+        # the first crawl is served a 404 for the character's pictures.
+        os.remove(os.path.join(self.server.page_store.path, pictures_name))
+        self.server.page_store = open_page_store(self.path("site"))
+        self.crawl()
+        self.server.page_store.put(pictures_name, pictures_content)
+        requested_paths = self.crawl()
+        self.assertNotIn(CHARACTER_PATHS["Girl One"], requested_paths)
+        self.assertIn(CHARACTER_PATHS["Girl Two"], requested_paths)
+        self.assertIn(f"{CHARACTER_PATHS['Girl Two']}/pictures",
+                      requested_paths)
+        with open_page_store(self.path("pages")) as pages:
+            self.assertEqual(
+                pages.get(self.get_saved_name("Girl Two", pictures=True)),
+                pictures_content
+            )
+
+
+class MyAnimeListRefreshTests(MyAnimeListDownloaderTestCase):
+    """Check a refreshing crawl revalidates the pages it downloaded."""
+
+    def get_saved_pages(self):
+        """Get the modification time and content of every saved page."""
+        with open_page_store(self.path("pages")) as pages:
+            return {name: (os.stat(os.path.join(pages.path, name)).st_mtime_ns,
+                           pages.get(name))
+                    for name in pages}
+
+    def test_not_modified_keeps_saved_pages(self):
+        """Check a 304 leaves the saved page as it was."""
+        self.crawl()
+        saved_pages = self.get_saved_pages()
+        requested_paths = self.crawl("--refresh")
+        for name in SEARCHED_NAMES:
+            path = CHARACTER_PATHS[name]
+            self.assertIn(path, requested_paths)
+            self.assertIn(path, self.server.not_modified_paths)
+            self.assertIn(f"{path}/pictures", self.server.not_modified_paths)
+        self.assertDictEqual(self.get_saved_pages(), saved_pages)
+
+    def test_changed_pages_are_downloaded(self):
+        """Check only a page which has changed is saved again."""
+        self.crawl()
+        saved_pages = self.get_saved_pages()
+        path = CHARACTER_PATHS["Girl One"]
+        url = f"{MAL_URL}{path}"
+        changed_page = make_page(
+            f"<h1>Changed</h1>{make_link(f'{path}/pictures', 'Pictures')}"
+        )
+        self.server.page_store.put(f"{base64_urlencode(url)}.html",
+                                   changed_page)
+        self.crawl("--refresh")
+        self.assertNotIn(path, self.server.not_modified_paths)
+        changed_name = self.get_saved_name("Girl One")
+        refreshed_pages = self.get_saved_pages()
+        self.assertIn(b"Changed", refreshed_pages.pop(changed_name)[1])
+        saved_pages.pop(changed_name)
+        self.assertDictEqual(refreshed_pages, saved_pages)
+
+    def test_manifest_records_the_validators(self):
+        """Check the manifest has the etag of every page saved."""
+        self.crawl()
+        # the validators of the pages which weren't modified are kept.
+        self.crawl("--refresh")
+        with JSONListReader(self.path("manifest.json")) as manifest:
+            entries = list(manifest)
+        for name in SEARCHED_NAMES:
+            url = f"{self.server.url}{CHARACTER_PATHS[name]}"
+            for prefix, page_url in (("character", url),
+                                     ("pictures", f"{url}/pictures")):
+                with self.subTest(name=name, page=prefix):
+                    entry = next(e for e in entries
+                                 if e.get(f"{prefix}_status") and
+                                 e[f"{prefix}_url"] == page_url)
+                    self.assertIsNotNone(entry[f"{prefix}_etag"])
+
+    def test_refresh_needs_a_frontier_file(self):
+        """Check a refresh without any recorded validators is refused."""
+        with redirect_stderr(io.StringIO()) as stderr, \
+                self.assertRaises(SystemExit):
+            main(["--anime-planet-extract", self.path("extract.json"),
+                  "--pages-directory", self.path("pages"),
+                  "--refresh"])
+        self.assertIn("--frontier", stderr.getvalue())
+        self.assertListEqual(self.server.requested_paths, [])
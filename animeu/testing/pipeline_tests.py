@@ -0,0 +1,142 @@
+# /animeu/testing/pipeline_tests.py
+#
+# Tests for the pipeline runner.
+#
+# See /LICENCE.md for Copyright information
+"""Tests for the pipeline runner."""
+import os
+import sys
+import time
+import unittest
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from animeu.spiders.pipeline import \
+    FINGERPRINT_SIZE, Stage, get_code_paths, get_module_path, hash_stage, \
+    run_pipeline
+
+def make_stage(name, inputs, outputs, code=None, source_files=()):
+    """Make a stage which concatenates its inputs into each of its outputs."""
+    code = code or (
+        "import sys\n"
+        "inputs, outputs = sys.argv[1].split(','), sys.argv[2].split(',')\n"
+        "content = ''.join(open(i).read() for i in inputs if i)\n"
+        "for output in outputs:\n"
+        "    open(output, 'w').write(content + '.')\n"
+    )
+    return Stage(name=name,
+                 command=[sys.executable, "-c", code,
+                          ",".join(inputs), ",".join(outputs)],
+                 inputs=inputs,
+                 outputs=outputs,
+                 always_run=False,
+                 code=source_files)
+
+
+class PipelineTests(unittest.TestCase):
+    """Check the pipeline runs and skips the right stages."""
+
+    def setUp(self):
+        """Create a diamond shaped pipeline in a temporary directory."""
+        # pylint: disable=consider-using-with
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = lambda name: os.path.join(self.directory.name, name)
+        self.state_filename = self.path("state.json")
+        with open(self.path("source"), "w", encoding="utf8") as fileobj:
+            fileobj.write("source")
+        self.stages = [
+            make_stage("d", [self.path("b"), self.path("c")], [self.path("d")]),
+            make_stage("b", [self.path("a")], [self.path("b")]),
+            make_stage("c", [self.path("a")], [self.path("c")]),
+            make_stage("a", [self.path("source")], [self.path("a")]),
+        ]
+
+    def test_runs_stages_after_their_dependencies(self):
+        """Check every stage is run after the stages it depends on."""
+        ran = run_pipeline(self.stages, self.state_filename)
+        self.assertEqual(ran[0], "a")
+        self.assertEqual(set(ran[1:3]), {"b", "c"})
+        self.assertEqual(ran[3], "d")
+        with open(self.path("d"), "r", encoding="utf8") as fileobj:
+            self.assertEqual(fileobj.read(), "source..source...")
+
+    def test_skips_stages_with_unchanged_inputs(self):
+        """Check only the stages downstream of a changed input are re-run."""
+        run_pipeline(self.stages, self.state_filename)
+        self.assertListEqual(run_pipeline(self.stages, self.state_filename),
+                             [])
+        with open(self.path("b"), "w", encoding="utf8") as fileobj:
+            fileobj.write("changed")
+        self.assertListEqual(run_pipeline(self.stages, self.state_filename),
+                             ["d"])
+        # a stage whose output is rebuilt unchanged doesn't re-run the rest.
+        os.remove(self.path("c"))
+        self.assertListEqual(run_pipeline(self.stages, self.state_filename),
+                             ["c"])
+
+    def test_reruns_stages_whose_code_changed(self):
+        """Check a stage is re-run when its code changes."""
+        with open(self.path("a.py"), "w", encoding="utf8") as fileobj:
+            fileobj.write("version = 1")
+        self.stages[3] = make_stage("a",
+                                    [self.path("source")],
+                                    [self.path("a")],
+                                    source_files=[self.path("a.py")])
+        run_pipeline(self.stages, self.state_filename)
+        self.assertListEqual(run_pipeline(self.stages, self.state_filename),
+                             [])
+        with open(self.path("a.py"), "w", encoding="utf8") as fileobj:
+            fileobj.write("version = 2")
+        self.assertListEqual(run_pipeline(self.stages, self.state_filename),
+                             ["a"])
+
+    def test_reads_each_input_once_per_run(self):
+        """Check large inputs aren't read and small ones are read once."""
+        with open(self.path("pages.pack"), "wb") as fileobj:
+            fileobj.write(b"\0" * (FINGERPRINT_SIZE + 1))
+        stage = make_stage("e",
+                           [self.path("pages.pack"), self.path("source")],
+                           [self.path("e")])
+        digests = {}
+        with mock.patch("animeu.spiders.pipeline.open",
+                        create=True,
+                        wraps=open) as opened:
+            stage_hash = hash_stage(stage, digests)
+            self.assertEqual(hash_stage(stage, digests), stage_hash)
+        self.assertListEqual([c.args[0] for c in opened.call_args_list],
+                             [self.path("source")])
+        # a large input which is written to still changes the hash.
+        os.utime(self.path("pages.pack"), ns=(0, 0))
+        self.assertNotEqual(hash_stage(stage, digests), stage_hash)
+
+    def test_code_includes_imported_package_modules(self):
+        """Check the code of a module includes the package modules it uses."""
+        code_paths = get_code_paths("animeu.spiders.myanimelist_extractor")
+        for module_name in ("animeu.spiders.myanimelist_extractor",
+                            "animeu.spiders.xpath_helpers",
+                            "animeu.spiders.extraction_cache",
+                            "animeu.common.file_helpers"):
+            self.assertIn(get_module_path(module_name), code_paths)
+        self.assertNotIn(get_module_path("animeu.spiders.pipeline"),
+                         code_paths)
+        self.assertIsNone(get_module_path("parsel"))
+
+    def test_runs_independent_stages_concurrently(self):
+        """Check stages which don't depend on each other run at once."""
+        sleep = "import time; time.sleep(1)"
+        stages = [make_stage(n, [], [self.path(n)], code=sleep)
+                  for n in ("x", "y", "z")]
+        start = time.monotonic()
+        run_pipeline(stages, self.state_filename)
+        self.assertLess(time.monotonic() - start, 2.5)
+
+    def test_does_not_run_stages_after_a_failure(self):
+        """Check the stages depending on a failed stage are not run."""
+        self.stages[3] = make_stage("a",
+                                    [self.path("source")],
+                                    [self.path("a")],
+                                    code="raise SystemExit(1)")
+        with self.assertRaisesRegex(RuntimeError, "a, b, c, d"):
+            run_pipeline(self.stages, self.state_filename)
+        self.assertFalse(os.path.exists(self.path("d")))
@@ -4,6 +4,7 @@
 #
 # See /LICENCE.md for Copyright information
 """Utilities for launching a server for testing purposes."""
+import sys
 import subprocess
 import threading
 from urllib import request
@@ -22,11 +23,18 @@ class ServerThread(threading.Thread):
         self.port = port
         self.started_event = threading.Event()
         self.server = None
+        self.worker = None
         self.app = None
 
     def run(self):
         """Start up the server."""
         subprocess.run(["flask", "db", "upgrade"], check=True)
+        # the admin actions are run as jobs by a worker process.
+        # pylint: disable=consider-using-with
+        self.worker = subprocess.Popen([sys.executable,
+                                        "-m", "animeu.jobs.worker",
+                                        "--processes", "1",
+                                        "--poll-interval", "0.5"])
         # pylint: disable=import-outside-toplevel
         import coverage
         coverage.process_startup()
@@ -40,6 +48,9 @@ class ServerThread(threading.Thread):
     def shutdown(self):
         """Shutdown the server."""
         self.server.stop()
+        if self.worker is not None:
+            self.worker.terminate()
+            self.worker.wait()
 
     def url_for(self, *args, **kwargs):
         """Generate a URL for a given route."""
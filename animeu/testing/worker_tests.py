@@ -0,0 +1,173 @@
+# /animeu/testing/worker_tests.py
+#
+# Tests for the job worker.
+#
+# See /LICENCE.md for Copyright information
+# pylint: disable=import-outside-toplevel
+"""Tests for the job worker."""
+import os
+import time
+import signal
+import threading
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+from animeu.testing.database_fixture import \
+    use_test_database, clear_test_database
+
+def setUpModule():  # pylint: disable=invalid-name
+    """Create and migrate a database for the worker to use."""
+    use_test_database()
+
+def is_dying_job(job_id):
+    """Check if a job is a moderation job, whose process is to die."""
+    from animeu.app import app
+    from animeu.models import Job
+    from animeu.admin.logic import MODERATION_LOCK_NAME
+    with app.app_context():
+        return Job.query.get(job_id).lock_name == MODERATION_LOCK_NAME
+
+def run_job_or_die(job_id):
+    """Run a job, unless it's a moderation job whose process is killed."""
+    from animeu.jobs.worker import run_job
+    if is_dying_job(job_id):
+        os.kill(os.getpid(), signal.SIGKILL)
+    return run_job(job_id)
+
+def run_job_or_exit(job_id):
+    """Run a job, unless it's a moderation job whose process exits."""
+    from animeu.jobs.worker import run_job
+    if is_dying_job(job_id):
+        os._exit(1)  # pylint: disable=protected-access
+    return run_job(job_id)
+
+
+class WorkerTests(unittest.TestCase):
+    """Check the worker keeps running jobs when a job's process dies."""
+
+    def setUp(self):
+        """Start each test without any jobs or locks."""
+        from animeu.app import app
+        with app.app_context():
+            clear_test_database()
+
+    @staticmethod
+    def wait_for_job(job_id, timeout=60):
+        """Wait for a job to finish, or the timeout to expire."""
+        from animeu.app import db
+        from animeu.models import Job
+        from animeu.jobs.queries import ACTIVE_JOB_STATUSES
+        start = time.monotonic()
+        while time.monotonic() - start < timeout and \
+                Job.query.get(job_id).status in ACTIVE_JOB_STATUSES:
+            db.session.rollback()
+            time.sleep(0.1)
+
+    def run_worker_until_finished(self, job_id, run_job):
+        """Run the jobs with a worker until a job has finished."""
+        from animeu.app import app
+        from animeu.jobs.worker import run_worker
+        stop_event = threading.Event()
+        with mock.patch("animeu.jobs.worker.run_job", run_job):
+            worker = threading.Thread(target=run_worker,
+                                      args=("test-worker",),
+                                      kwargs={"processes": 1,
+                                              "poll_interval": 0.1,
+                                              "stop_event": stop_event})
+            worker.start()
+            try:
+                with app.app_context():
+                    self.wait_for_job(job_id)
+                self.assertTrue(worker.is_alive())
+            finally:
+                stop_event.set()
+                worker.join()
+
+    def test_runs_jobs_after_a_job_process_is_killed(self):
+        """Check the next job runs after the pool running a job broke."""
+        from animeu.app import app
+        from animeu.models import Job
+        from animeu.admin.logic import ELO_LOCK_NAME, MODERATION_LOCK_NAME
+        from animeu.jobs.queries import JOB_FAILED, JOB_SUCCEEDED, enqueue_job
+        with app.app_context():
+            dying_job_id = enqueue_job(MODERATION_LOCK_NAME, tables=[]).id
+            next_job_id = enqueue_job(ELO_LOCK_NAME).id
+        self.run_worker_until_finished(next_job_id, run_job_or_die)
+        with app.app_context():
+            dying_job = Job.query.get(dying_job_id)
+            self.assertEqual(dying_job.status, JOB_FAILED)
+            self.assertIn("BrokenProcessPool", dying_job.error)
+            self.assertEqual(Job.query.get(next_job_id).status,
+                             JOB_SUCCEEDED)
+
+    def test_replaces_the_pool_after_a_job_process_exits(self):
+        """Check a new pool is made to run the jobs after one broke."""
+        from animeu.app import app
+        from animeu.models import Job
+        from animeu.admin.logic import ELO_LOCK_NAME, MODERATION_LOCK_NAME
+        from animeu.jobs.queries import JOB_FAILED, JOB_SUCCEEDED, enqueue_job
+        from animeu.jobs.worker import make_executor
+        with app.app_context():
+            dying_job_id = enqueue_job(MODERATION_LOCK_NAME, tables=[]).id
+            next_job_id = enqueue_job(ELO_LOCK_NAME).id
+        with mock.patch("animeu.jobs.worker.make_executor",
+                        wraps=make_executor) as make_executor_mock:
+            self.run_worker_until_finished(next_job_id, run_job_or_exit)
+        self.assertEqual(make_executor_mock.call_count, 2)
+        with app.app_context():
+            self.assertEqual(Job.query.get(dying_job_id).status, JOB_FAILED)
+            self.assertEqual(Job.query.get(next_job_id).status,
+                             JOB_SUCCEEDED)
+
+
+class LeaseTests(unittest.TestCase):
+    """Check a lease which has been lost can't be used."""
+
+    def setUp(self):
+        """Start each test without any jobs or locks."""
+        from animeu.app import app
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        clear_test_database()
+
+    def test_expires_a_job_which_stopped_heartbeating(self):
+        """Check a stale running job is failed and its lock reclaimed."""
+        from animeu.models import Job
+        from animeu.admin.logic import ELO_LOCK_NAME
+        from animeu.jobs.queries import \
+            HEARTBEAT_TIMEOUT, JOB_FAILED, claim_next_job, enqueue_job, \
+            expire_stale_jobs
+        stale_job = enqueue_job(ELO_LOCK_NAME)
+        self.assertEqual(claim_next_job("dead-worker").id, stale_job.id)
+        self.assertListEqual(expire_stale_jobs(), [])
+        self.assertIsNone(enqueue_job(ELO_LOCK_NAME))
+        later = datetime.now() + HEARTBEAT_TIMEOUT + timedelta(seconds=1)
+        self.assertListEqual(expire_stale_jobs(now=later), [stale_job.id])
+        self.assertEqual(Job.query.get(stale_job.id).status, JOB_FAILED)
+        next_job = enqueue_job(ELO_LOCK_NAME)
+        self.assertIsNotNone(next_job)
+        self.assertGreater(next_job.fencing_token, stale_job.fencing_token)
+
+    def test_rejects_a_stale_fencing_token(self):
+        """Check a lease which was taken over can't be renewed or released."""
+        from animeu.jobs.locks import \
+            acquire_lock, get_held_lock, release_lock, renew_lock, \
+            update_lock_progress
+        duration = timedelta(seconds=30)
+        stale_lease = acquire_lock("test-lock", "owner", duration)
+        # the same owner takes the lock over once the lease has expired.
+        later = stale_lease.lease_expiry + timedelta(seconds=1)
+        lease = acquire_lock("test-lock", "owner", duration, now=later)
+        self.assertGreater(lease.fencing_token, stale_lease.fencing_token)
+        self.assertIsNone(renew_lock(stale_lease, duration, now=later))
+        self.assertFalse(update_lock_progress(stale_lease, 50))
+        release_lock(stale_lease)
+        self.assertEqual(
+            get_held_lock("test-lock", now=later).fencing_token,
+            lease.fencing_token
+        )
+        self.assertIsNotNone(renew_lock(lease, duration, now=later))
+        release_lock(lease)
+        self.assertIsNone(get_held_lock("test-lock", now=later))
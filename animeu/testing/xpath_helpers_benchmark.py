@@ -0,0 +1,157 @@
+# /animeu/testing/xpath_helpers_benchmark.py
+#
+# Micro-benchmarks for the spider xpath helpers.
+#
+# See /LICENCE.md for Copyright information
+"""Micro-benchmarks for the spider xpath helpers."""
+import sys
+import argparse
+from fnmatch import filter as fnfilter
+from timeit import timeit
+
+import regex as re
+from parsel import Selector, SelectorList
+
+from animeu.common.func_helpers import identity, constant
+from animeu.spiders.page_store import get_page_store
+from animeu.spiders.xpath_helpers import \
+    xpath_slice_between, xpath_position_of, xpath_expr_first, \
+    xpath_expr_is_subset
+
+SIDEBAR_XPATH = "//div[@class='js-scrollfix-bottom']"
+SIDEBAR_SLICES = [
+    ("./h2[. = 'Alternative Titles']", "./br"),
+    ("./h2[. = 'Information']", "./br"),
+    ("./h2[. = 'Statistics']", "./br"),
+]
+
+def counting_xpath_slice_between(selector,
+                                 lower_xpath,
+                                 upper_xpath,
+                                 inclusive=False):
+    """Slice a selector between two bounds using ```count()``` queries.
+
+    This is the original implementation of ```xpath_slice_between``` which
+    is kept as a baseline for the benchmark.
+    """
+    max_lower_position = xpath_position_of(
+        selector,
+        xpath_expr_first(
+            # pylint: disable=line-too-long
+            f"({lower_xpath})[following-sibling::*[{xpath_expr_is_subset('.', f'../{upper_xpath}')}]]"
+        )
+    )
+    upper_boundary_positions = [
+        xpath_position_of(s, '.') for s in selector.xpath(upper_xpath)
+    ]
+    upper_boundary_positions = [
+        b for b in upper_boundary_positions if b > max_lower_position
+    ]
+    min_upper_position = \
+        upper_boundary_positions[0] if upper_boundary_positions else 0
+    if min_upper_position == 0 and not inclusive:
+        return SelectorList()
+    lwr_op = ">=" if inclusive else ">"
+    upr_op = "<=" if inclusive else "<"
+    slice_expr = (
+        r"*[ "
+        f"  position() {lwr_op} {max_lower_position} "
+        f"  and position() {upr_op} {min_upper_position} "
+        rf"]"
+    )
+    return selector.xpath(slice_expr)
+
+def css_normalize_whitespace(text,
+                             translate_nbsp=True,
+                             only_single_spaces=True):
+    """Normalize whitespace and change ```&nbsp;``` to a normal space.
+
+    This is the original implementation of ```normalize_whitespace``` which
+    is kept as a baseline for ```css_get_all_text```.
+    """
+    if translate_nbsp:
+        text = text.replace("\xa0", " ")
+    text = text.replace("\u2019", "'")
+    text = text.replace("\u00c2", " ")
+    if only_single_spaces:
+        if translate_nbsp:
+            text = re.sub(r"[^\S\n]+", " ", text)
+        else:
+            text = re.sub(r"[^\S\n\xa0]+", " ", text)
+    text = text.strip()
+    return text
+
+def css_get_all_text(sel,
+                     element_seperator="\n",
+                     element_filter=constant(True),
+                     element_transform=identity,
+                     text_transform=css_normalize_whitespace):
+    """Get all the text in a selector using ```css("*::text")``` queries.
+
+    This is the original implementation of ```get_all_text``` which is kept
+    as a baseline for the tests.
+    """
+    if not isinstance(sel, (Selector, SelectorList)):
+        raise TypeError("""Expected either Selector or SelectorList.""")
+    if isinstance(sel, Selector):
+        selectors = SelectorList([sel])
+    else:
+        selectors = sel
+    text_fragments = []
+    for maybe_text_selector in selectors:
+        # pylint: disable=protected-access
+        if hasattr(maybe_text_selector, "_expr") and \
+                maybe_text_selector._expr is not None and \
+                maybe_text_selector._expr.endswith("text()"):
+            text_fragments.append(maybe_text_selector.get())
+        else:
+            text_selectors = maybe_text_selector.css("*::text")
+            text_fragments.extend(text_selectors.extract())
+    element_seperator = "" if element_seperator is None else element_seperator
+    text_fragments = list(map(element_transform, text_fragments))
+    text_fragments = list(filter(element_filter, text_fragments))
+    text = element_seperator.join(text_fragments)
+    return text_transform(text)
+
+def slice_sidebars(slice_func, sidebars):
+    """Slice all the sections out of the sidebars."""
+    return [
+        [s.get() for s in slice_func(sidebar, lower, upper, inclusive)]
+        for sidebar in sidebars
+        for lower, upper in SIDEBAR_SLICES
+        for inclusive in (False, True)
+    ]
+
+def main(argv=None):
+    """Benchmark xpath_slice_between against the count() implementation."""
+    argv = argv or sys.argv[1:]
+    parser = argparse.ArgumentParser("""Benchmark xpath_slice_between.""")
+    parser.add_argument("--pages",
+                        type=str,
+                        required=True,
+                        help="""A directory or .pack file of MAL pages.""")
+    parser.add_argument("--filter", type=str, default="*.anime.html")
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    result = parser.parse_args(argv)
+    page_store = get_page_store(result.pages)
+    names = fnfilter(page_store, result.filter)[:result.limit]
+    sidebars = [
+        Selector(text=page_store.get(n).decode("utf8")).xpath(SIDEBAR_XPATH)
+        for n in names
+    ]
+    if slice_sidebars(xpath_slice_between, sidebars) != \
+            slice_sidebars(counting_xpath_slice_between, sidebars):
+        print("xpath_slice_between results differ from the baseline!",
+              file=sys.stderr)
+        return 1
+    for label, slice_func in (("count()", counting_xpath_slice_between),
+                              ("sibling walk", xpath_slice_between)):
+        seconds = timeit(lambda f=slice_func: slice_sidebars(f, sidebars),
+                         number=result.repeat)
+        print(f"{label}: {seconds:.3f}s for {result.repeat} x "
+              f"{len(sidebars)} sidebars")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# /animeu/testing/xpath_helpers_tests.py
+#
+# Tests for the spider xpath helpers.
+#
+# See /LICENCE.md for Copyright information
+"""Tests for the spider xpath helpers."""
+import os
+import unittest
+from fnmatch import filter as fnfilter
+from functools import partial
+from unittest import mock
+
+from lxml import etree
+from parsel import Selector
+
+from animeu.spiders.page_store import get_page_store
+from animeu.spiders.xpath_helpers import \
+    get_all_text, get_all_element_text, normalize_whitespace, \
+    parse_html_document, xpath_slice_between
+from animeu.testing.xpath_helpers_benchmark import \
+    css_get_all_text, css_normalize_whitespace, counting_xpath_slice_between
+
+FIXTURE_PAGES = os.path.join(os.path.dirname(__file__), "fixtures", "pages")
+TEXT_XPATHS = [
+    "//h1",
+    "//h2",
+    "//h3",
+    "//p",
+    "//td",
+    "//li/a",
+    "//div[@itemprop = 'description']",
+    "//div[@class = 'js-scrollfix-bottom']",
+    "//div[@class = 'js-scrollfix-bottom']/text()",
+    "//a/@href",
+]
+# pairs of the get_all_text variants and their baseline counterparts.
+GET_ALL_TEXT_VARIANTS = {
+    "default": (get_all_text, css_get_all_text),
+    "no_seperator": (partial(get_all_text, element_seperator=None),
+                     partial(css_get_all_text, element_seperator=None)),
+    "keep_nbsp": (
+        partial(get_all_text,
+                text_transform=partial(normalize_whitespace,
+                                       translate_nbsp=False)),
+        partial(css_get_all_text,
+                text_transform=partial(css_normalize_whitespace,
+                                       translate_nbsp=False))
+    ),
+    "keep_spaces": (
+        partial(get_all_text,
+                text_transform=partial(normalize_whitespace,
+                                       only_single_spaces=False)),
+        partial(css_get_all_text,
+                text_transform=partial(css_normalize_whitespace,
+                                       only_single_spaces=False))
+    ),
+    "filtered": (
+        partial(get_all_text,
+                element_transform=str.upper,
+                element_filter=lambda t: bool(t.strip())),
+        partial(css_get_all_text,
+                element_transform=str.upper,
+                element_filter=lambda t: bool(t.strip()))
+    ),
+}
+# a description with the markup which trips up extracting its text.
+DESCRIPTION_HTML = (
+    "<html><body><div>One<br>two&nbsp;&nbsp;three"
+    "<script>var x = 1;</script><style>p {}</style><!-- comment -->"
+    "<b>bold</b> tail\u2019s  end</div>after</body></html>"
+)
+DESCRIPTION_TEXT = "One\ntwo three\nvar x = 1;\np {}\nbold\n tail's end"
+
+def get_test_pages():
+    """Get the names and bytes of the pages to compare get_all_text on.
+
+    The fixture pages are always used, and the pages in the directory or
+    .pack file named by ```XPATH_TEST_PAGES``` are used as well if it's set.
+    """
+    pages = {}
+    for pages_path in (FIXTURE_PAGES, os.environ.get("XPATH_TEST_PAGES")):
+        if not pages_path:
+            continue
+        page_store = get_page_store(pages_path)
+        for name in sorted(fnfilter(page_store, "*.html")):
+            pages[f"{pages_path}:{name}"] = page_store.get(name)
+    return pages
+
+
+class GetAllTextTests(unittest.TestCase):
+    """Check get_all_text finds the same text as the css based baseline."""
+
+    def test_get_all_text_matches_baseline(self):
+        """Check every variant of get_all_text matches the baseline."""
+        pages = get_test_pages()
+        self.assertTrue(pages)
+        for name, page in pages.items():
+            sel = Selector(text=page.decode("utf8", errors="ignore"))
+            for xpath in TEXT_XPATHS:
+                selectors = sel.xpath(xpath)
+                for variant, (func, baseline) in \
+                        GET_ALL_TEXT_VARIANTS.items():
+                    with self.subTest(name=name,
+                                      xpath=xpath,
+                                      variant=variant):
+                        self.assertListEqual(
+                            [func(s) for s in selectors],
+                            [baseline(s) for s in selectors]
+                        )
+                        self.assertEqual(func(selectors),
+                                         baseline(selectors))
+
+    def test_get_all_text_of_description(self):
+        """Check the text around breaks, scripts and styles is found."""
+        sel = Selector(text=DESCRIPTION_HTML)
+        for xpath, separator, text in (
+                ("//div", "\n", DESCRIPTION_TEXT),
+                ("//div", None, "Onetwo threevar x = 1;p {}bold tail's end"),
+                ("//div/text()", "\n", "One\ntwo three\n tail's end"),
+        ):
+            with self.subTest(xpath=xpath, separator=separator):
+                selectors = sel.xpath(xpath)
+                self.assertEqual(
+                    get_all_text(selectors, element_seperator=separator),
+                    text
+                )
+                self.assertEqual(
+                    css_get_all_text(selectors, element_seperator=separator),
+                    text
+                )
+
+    def test_get_all_element_text_of_description(self):
+        """Check the text of elements and text nodes matches get_all_text."""
+        tree = etree.HTML(DESCRIPTION_HTML)
+        self.assertEqual(get_all_element_text(tree.xpath("//div")),
+                         DESCRIPTION_TEXT)
+        self.assertEqual(
+            get_all_element_text(tree.xpath("//div/text() | //div/b")),
+            "One\ntwo three\nbold\n tail's end"
+        )
+
+    def test_normalize_whitespace(self):
+        """Check the spaces are collapsed and the newlines are kept."""
+        text = " a\xa0\xa0b \t\n c\u2019 "
+        for kwargs, normalized in (
+                ({}, "a b \n c'"),
+                ({"translate_nbsp": False}, "a\xa0\xa0b \n c'"),
+                ({"only_single_spaces": False}, "a  b \t\n c'"),
+        ):
+            with self.subTest(**kwargs):
+                self.assertEqual(normalize_whitespace(text, **kwargs),
+                                 normalized)
+                self.assertEqual(css_normalize_whitespace(text, **kwargs),
+                                 normalized)
+
+
+class XpathSliceBetweenTests(unittest.TestCase):
+    """Check the sibling walk slices like the ```count()``` baseline."""
+
+    def assert_slices_match_baseline(self, sels, lower_xpath, upper_xpath):
+        """Check each selector is sliced the same as by the baseline."""
+        for inclusive in (False, True):
+            with self.subTest(inclusive=inclusive):
+                self.assertListEqual(
+                    xpath_slice_between(sels,
+                                        lower_xpath,
+                                        upper_xpath,
+                                        inclusive=inclusive).getall(),
+                    [text
+                     for sel in sels
+                     for text in counting_xpath_slice_between(
+                         sel,
+                         lower_xpath,
+                         upper_xpath,
+                         inclusive=inclusive
+                     ).getall()]
+                )
+
+    def test_slices_every_selector_of_a_list(self):
+        """Check each selector in a list is sliced by its own boundaries."""
+        sels = Selector(text=(
+            "<div><h2>A</h2><p>1</p><br/></div>"
+            "<div><p>0</p><h2>A</h2><p>2</p><p>3</p><br/><p>4</p></div>"
+            "<div><p>5</p></div>"
+        )).xpath("//div")
+        self.assert_slices_match_baseline(sels, "./h2", "./br")
+        # a lower boundary which is the first child is at position 0, so
+        # like the baseline it's included.
+        self.assertListEqual(
+            xpath_slice_between(sels, "./h2", "./br").getall(),
+            ["<h2>A</h2>", "<p>1</p>", "<p>2</p>", "<p>3</p>"]
+        )
+
+    def test_upper_boundary_never_appears(self):
+        """Check nothing is sliced when the upper boundary is missing."""
+        sels = Selector(
+            text="<div><p>0</p><h2>A</h2><p>1</p><p>2</p></div>"
+        ).xpath("//div")
+        self.assert_slices_match_baseline(sels, "./h2", "./br")
+        self.assertFalse(xpath_slice_between(sels, "./h2", "./br"))
+
+    def test_ignores_nested_boundaries(self):
+        """Check only the boundaries which are children are used."""
+        sels = Selector(text=(
+            "<div>"
+            "<p><h2>A</h2></p><span><br/></span>"
+            "<h2>A</h2><div><h2>A</h2><p>n</p><br/></div><p>1</p><br/>"
+            "<p>2</p><h2>A</h2><p>3</p>"
+            "</div>"
+        )).xpath("/html/body/div")
+        self.assert_slices_match_baseline(sels, "./h2", "./br")
+        self.assert_slices_match_baseline(sels, "./*[./h2]", "./br")
+
+
+class ParseHtmlDocumentTests(unittest.TestCase):
+    """Check the bytes of a page are decoded before it's parsed."""
+
+    def test_transcodes_guessed_encoding(self):
+        """Check a page which isn't utf8 is decoded with a guess."""
+        page = "<html><body><p>caf\xe9</p></body></html>".encode("latin1")
+        with mock.patch("animeu.common.file_helpers.guess_encoding",
+                        return_value="latin1"):
+            tree = parse_html_document(page)
+        self.assertEqual(tree.xpath("string(//p)"), "caf\xe9")
+
+    def test_unknown_guessed_encoding_falls_back_to_utf8(self):
+        """Check a guess python doesn't know doesn't fail the page."""
+        page = b"<html><body><p>caf\xe9</p></body></html>"
+        with mock.patch("animeu.common.file_helpers.guess_encoding",
+                        return_value="x-unknown-charset"):
+            tree = parse_html_document(page)
+        self.assertEqual(tree.xpath("string(//p)"), "caf\ufffd")
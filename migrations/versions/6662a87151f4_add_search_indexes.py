@@ -0,0 +1,89 @@
+"""add search indexes
+
+Revision ID: 6662a87151f4
+Revises: 11a3a03d56bb
+Create Date: 2026-10-19 14:02:47.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6662a87151f4'
+down_revision = '11a3a03d56bb'
+branch_labels = None
+depends_on = None
+
+# the columns the admin page searches, by table.
+SEARCH_COLUMNS = {
+    'users': ['email', 'username'],
+    'waifu_battles': ['winner_name', 'loser_name'],
+    'favourited_waifu': ['character_name'],
+}
+
+
+# b1fd3795ec09_add_characters keeps a copy of the search index helpers, so
+# the triggers it recreates match the ones made here.
+def sqlite_has_trigram_tokenizer(bind):
+    # the trigram tokenizer was added to fts5 in sqlite 3.34.
+    try:
+        bind.execute("create virtual table temp.trigram_check "
+                     "using fts5(text, tokenize='trigram')")
+    except sa.exc.OperationalError:
+        return False
+    bind.execute("drop table temp.trigram_check")
+    return True
+
+
+def create_sqlite_search_table(table, columns):
+    search_table = f'{table}_search'
+    column_list = ', '.join(columns)
+    new_values = ', '.join(f'new.{c}' for c in columns)
+    old_values = ', '.join(f'old.{c}' for c in columns)
+    op.execute(f"create virtual table {search_table} using fts5("
+               f"{column_list}, content='{table}', content_rowid='id', "
+               f"tokenize='trigram')")
+    op.execute(f"create trigger {search_table}_insert after insert on {table} "
+               f"begin insert into {search_table} (rowid, {column_list}) "
+               f"values (new.id, {new_values}); end")
+    op.execute(f"create trigger {search_table}_delete after delete on {table} "
+               f"begin insert into {search_table} "
+               f"({search_table}, rowid, {column_list}) "
+               f"values ('delete', old.id, {old_values}); end")
+    op.execute(f"create trigger {search_table}_update after update on {table} "
+               f"begin insert into {search_table} "
+               f"({search_table}, rowid, {column_list}) "
+               f"values ('delete', old.id, {old_values}); "
+               f"insert into {search_table} (rowid, {column_list}) "
+               f"values (new.id, {new_values}); end")
+    op.execute(f"insert into {search_table} ({search_table}) values ('rebuild')")
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute('create extension if not exists pg_trgm')
+        for table, columns in SEARCH_COLUMNS.items():
+            for column in columns:
+                op.create_index(f'ix_{table}_{column}_trgm',
+                                table,
+                                [column],
+                                postgresql_using='gin',
+                                postgresql_ops={column: 'gin_trgm_ops'})
+    elif bind.dialect.name == 'sqlite' and sqlite_has_trigram_tokenizer(bind):
+        for table, columns in SEARCH_COLUMNS.items():
+            create_sqlite_search_table(table, columns)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        for table, columns in SEARCH_COLUMNS.items():
+            for column in columns:
+                op.drop_index(f'ix_{table}_{column}_trgm', table_name=table)
+    elif bind.dialect.name == 'sqlite':
+        for table in SEARCH_COLUMNS:
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f'drop trigger if exists {table}_search_{trigger}')
+            op.execute(f'drop table if exists {table}_search')
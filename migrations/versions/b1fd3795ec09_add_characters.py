@@ -0,0 +1,165 @@
+"""add characters
+
+Revision ID: b1fd3795ec09
+Revises: 22a45c50ffc4
+Create Date: 2026-10-19 13:42:26.532781
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b1fd3795ec09'
+down_revision = '22a45c50ffc4'
+branch_labels = None
+depends_on = None
+
+# the columns which named a character, and the id columns replacing them.
+CHARACTER_COLUMNS = {
+    'waifu_battles': [('winner_name', 'winner_id'), ('loser_name', 'loser_id')],
+    'favourited_waifu': [('character_name', 'character_id')],
+}
+# the indexes of the name columns, other than the ones made by op.f.
+COMPOSITE_INDEXES = {
+    'favourited_waifu': ('ix_favourited_waifu_user_id_character_{}',
+                         ['user_id', 'character_{}']),
+}
+
+
+# the search index helpers are deliberately copied from
+# 6662a87151f4_add_search_indexes rather than imported, so this migration
+# stays frozen whatever later happens to that one. They recreate the same
+# fts5 table and triggers, so a fix to the triggers of one has to be made to
+# the other, and applied by a new migration.
+def sqlite_has_trigram_tokenizer(bind):
+    # the trigram tokenizer was added to fts5 in sqlite 3.34.
+    try:
+        bind.execute("create virtual table temp.trigram_check "
+                     "using fts5(text, tokenize='trigram')")
+    except sa.exc.OperationalError:
+        return False
+    bind.execute("drop table temp.trigram_check")
+    return True
+
+
+def create_search_index(bind, table, columns):
+    if bind.dialect.name == 'postgresql':
+        for column in columns:
+            op.create_index(f'ix_{table}_{column}_trgm',
+                            table,
+                            [column],
+                            postgresql_using='gin',
+                            postgresql_ops={column: 'gin_trgm_ops'})
+    elif bind.dialect.name == 'sqlite' and sqlite_has_trigram_tokenizer(bind):
+        search_table = f'{table}_search'
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f'new.{c}' for c in columns)
+        old_values = ', '.join(f'old.{c}' for c in columns)
+        op.execute(f"create virtual table {search_table} using fts5("
+                   f"{column_list}, content='{table}', content_rowid='id', "
+                   f"tokenize='trigram')")
+        op.execute(f"create trigger {search_table}_insert after insert on {table} "
+                   f"begin insert into {search_table} (rowid, {column_list}) "
+                   f"values (new.id, {new_values}); end")
+        op.execute(f"create trigger {search_table}_delete after delete on {table} "
+                   f"begin insert into {search_table} "
+                   f"({search_table}, rowid, {column_list}) "
+                   f"values ('delete', old.id, {old_values}); end")
+        op.execute(f"create trigger {search_table}_update after update on {table} "
+                   f"begin insert into {search_table} "
+                   f"({search_table}, rowid, {column_list}) "
+                   f"values ('delete', old.id, {old_values}); "
+                   f"insert into {search_table} (rowid, {column_list}) "
+                   f"values (new.id, {new_values}); end")
+        op.execute(f"insert into {search_table} ({search_table}) values ('rebuild')")
+
+
+def drop_search_index(bind, table, columns):
+    if bind.dialect.name == 'postgresql':
+        for column in columns:
+            op.execute(f'drop index if exists ix_{table}_{column}_trgm')
+    elif bind.dialect.name == 'sqlite':
+        # the triggers would stop the columns they read from being dropped.
+        for trigger in ('insert', 'delete', 'update'):
+            op.execute(f'drop trigger if exists {table}_search_{trigger}')
+        op.execute(f'drop table if exists {table}_search')
+
+
+def upgrade():
+    bind = op.get_bind()
+    characters = op.create_table('characters',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_characters_name'), 'characters', ['name'], unique=True)
+    # every character which has been battled or favourited is given an id,
+    # the rest are added when the characters are synced from the dataset.
+    names = sa.union(*[
+        sa.select([sa.column(name_column).label('name')])
+        .select_from(sa.table(table))
+        for table, columns in CHARACTER_COLUMNS.items()
+        for name_column, _ in columns
+    ]).alias('names')
+    op.execute(characters.insert().from_select(
+        ['name'],
+        sa.select([names.c.name]).order_by(names.c.name)
+    ))
+
+    for table, columns in CHARACTER_COLUMNS.items():
+        drop_search_index(bind, table, [n for n, _ in columns])
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for _, id_column in columns:
+                batch_op.add_column(sa.Column(id_column, sa.Integer(), nullable=True))
+        for name_column, id_column in columns:
+            op.execute(f'update {table} set {id_column} = '
+                       f'(select id from characters '
+                       f'where characters.name = {table}.{name_column})')
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            if table in COMPOSITE_INDEXES:
+                index_name, index_columns = COMPOSITE_INDEXES[table]
+                batch_op.drop_index(index_name.format('name'))
+                batch_op.create_index(index_name.format('id'),
+                                      [c.format('id') for c in index_columns],
+                                      unique=False)
+            for name_column, id_column in columns:
+                batch_op.drop_index(f'ix_{table}_{name_column}')
+                batch_op.alter_column(id_column, existing_type=sa.Integer(), nullable=False)
+                batch_op.create_index(batch_op.f(f'ix_{table}_{id_column}'), [id_column], unique=False)
+                batch_op.create_foreign_key(f'fk_{table}_{id_column}_characters',
+                                            'characters', [id_column], ['id'])
+                batch_op.drop_column(name_column)
+
+    create_search_index(bind, 'characters', ['name'])
+
+
+def downgrade():
+    bind = op.get_bind()
+    drop_search_index(bind, 'characters', ['name'])
+
+    for table, columns in CHARACTER_COLUMNS.items():
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for name_column, _ in columns:
+                batch_op.add_column(sa.Column(name_column, sa.VARCHAR(), nullable=True))
+        for name_column, id_column in columns:
+            op.execute(f'update {table} set {name_column} = '
+                       f'(select name from characters '
+                       f'where characters.id = {table}.{id_column})')
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            if table in COMPOSITE_INDEXES:
+                index_name, index_columns = COMPOSITE_INDEXES[table]
+                batch_op.drop_index(index_name.format('id'))
+                batch_op.create_index(index_name.format('name'),
+                                      [c.format('name') for c in index_columns],
+                                      unique=False)
+            for name_column, id_column in columns:
+                batch_op.drop_constraint(f'fk_{table}_{id_column}_characters', type_='foreignkey')
+                batch_op.drop_index(batch_op.f(f'ix_{table}_{id_column}'))
+                batch_op.alter_column(name_column, existing_type=sa.VARCHAR(), nullable=False)
+                batch_op.create_index(f'ix_{table}_{name_column}', [name_column], unique=False)
+                batch_op.drop_column(id_column)
+        create_search_index(bind, table, [n for n, _ in columns])
+
+    op.drop_index(op.f('ix_characters_name'), table_name='characters')
+    op.drop_table('characters')
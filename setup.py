@@ -22,8 +22,12 @@ setup(
             "myanimelist-anime-extractor=animeu.spiders.myanimelist_anime_extractor:main",
             "anime-db-create=animeu.spiders.anime_db_generator:create_anime_db_cli",
             "anime-db-match=animeu.spiders.anime_db_generator:match_characters_cli",
+            "anime-pipeline=animeu.spiders.pipeline:main",
             "seed-battles=animeu.seed_battles:main",
+            "sync-characters=animeu.sync_characters:main",
             "update-elo-rankings=animeu.elo.elo_leaderboard_updater:update_rankings",
+            "animeu-worker=animeu.jobs.worker:main",
+            "animeu-index-advisor=animeu.index_advisor:main",
             "b64e=animeu.spiders.base64_helpers:base64_encode_cli"
         ]
     }